@@ -0,0 +1,66 @@
+## Benchmark the yearly loop: xr.concat accumulation vs the preallocated applyByYear driver
+## runtime of the driver should grow linearly with the number of years
+## use: python3 benchYears.py [--years 10 20 40 80] [--nlat 90] [--nlon 180]
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from tools.DHWtools import getDHWmax
+from tools.yearTools import applyByYear
+
+
+def syntheticDHW(nYears, nLat, nLon, yearStart=1985, seed=0):
+    '''
+    Make a synthetic daily DHW data array with a land block
+    :param nYears: number of years
+    :param nLat: number of latitudes
+    :param nLon: number of longitudes
+    :param yearStart: first year of the series
+    :param seed: random seed
+    :return: data array DHW[time,lat,lon]
+    '''
+    rng = np.random.default_rng(seed)
+    time = pd.date_range(str(yearStart) + '-01-01', str(yearStart + nYears - 1) + '-12-31', freq='D')
+    values = rng.gamma(1.0, 3.0, size=(len(time), nLat, nLon)).astype('float32')
+    values[:, :nLat // 4, :nLon // 4] = np.nan
+    return xr.DataArray(values, dims=('time', 'lat', 'lon'), name='DHW',
+                        coords={'time': time,
+                                'lat': np.linspace(-35, 35, nLat),
+                                'lon': np.linspace(-180, 180, nLon, endpoint=False)})
+
+
+def concatLoop(da, func):
+    '''
+    The per-year xr.concat accumulation, as it was done in the processing scripts
+    :param da: data array of daily values [time,lat,lon]
+    :param func: yearly function
+    :return: data array [time,lat,lon]
+    '''
+    daYear = da.groupby('time.year')
+    years = list(daYear.groups)
+    out = func(daYear[years[0]])
+    for yy in years[1:]:
+        out = xr.concat([out, func(daYear[yy])], 'time')
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='benchmark the yearly loop')
+    parser.add_argument('--years', type=int, nargs='+', default=[10, 20, 40, 80])
+    parser.add_argument('--nlat', type=int, default=90)
+    parser.add_argument('--nlon', type=int, default=180)
+    args = parser.parse_args()
+
+    print('%6s %12s %12s %14s %14s' % ('years', 'concat_s', 'driver_s', 'concat_s/yr', 'driver_s/yr'))
+    for nYears in args.years:
+        da = syntheticDHW(nYears, args.nlat, args.nlon)
+        t0 = time.perf_counter()
+        concatLoop(da, getDHWmax)
+        tConcat = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        applyByYear(da, getDHWmax)
+        tDriver = time.perf_counter() - t0
+        print('%6d %12.3f %12.3f %14.5f %14.5f' % (nYears, tConcat, tDriver, tConcat / nYears, tDriver / nYears))
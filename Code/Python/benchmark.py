@@ -0,0 +1,48 @@
+## Benchmark every DHWtools metric and the processNC, ensemble and region clipping stages on synthetic DHW cubes
+## wall time, peak RSS and bytes read/written of every metric and stage, written as JSON to compare across commits
+## use: python3 benchmark.py --config laptop --out bench.json [--workdir /tmp/bppBench] [--compare old.json]
+##      [--years 5 --resolution 1 --land 0.3 --models 4] [--stages metrics processNC ensemble clip]
+
+import os
+import json
+import argparse
+
+from tools.benchTools import benchConfigs, benchStages, benchMetrics, runBenchmark, compareReports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='benchmark the DHW metrics and pipeline stages')
+    parser.add_argument('--config', choices=list(benchConfigs), default='laptop', help='size of the synthetic data')
+    parser.add_argument('--years', type=int, default=None, help='number of years')
+    parser.add_argument('--resolution', type=float, default=None, help='cell size in degrees')
+    parser.add_argument('--land', type=float, default=None, help='fraction of land cells')
+    parser.add_argument('--models', type=int, default=None, help='number of models of the ensemble')
+    parser.add_argument('--repeat', type=int, default=None, help='runs of every metric. The best one is kept')
+    parser.add_argument('--stages', nargs='+', choices=benchStages, default=benchStages, help='stages to run')
+    parser.add_argument('--metrics', nargs='+', choices=list(benchMetrics), default=None, help='metrics to run')
+    parser.add_argument('--workdir', default='/tmp/bppBench',
+                        help='directory of the synthetic data, kept between runs, and of the outputs')
+    parser.add_argument('--out', default=None, help='JSON report')
+    parser.add_argument('--compare', default=None, help='JSON report to compare with, e.g. of the previous commit')
+    args = parser.parse_args()
+
+    config = dict(benchConfigs[args.config], name=args.config)
+    for key, value in [('years', args.years), ('resolution', args.resolution), ('landFraction', args.land),
+                       ('models', args.models), ('repeat', args.repeat)]:
+        if value is not None:
+            config[key] = value
+
+    report = runBenchmark(config, args.workdir, stages=args.stages, metrics=args.metrics)
+    if args.out is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print('\n%-16s %-22s %10s %10s %7s %10s %10s' % ('stage', 'name', 'old_s', 'new_s', 'ratio', 'old_MB',
+                                                        'new_MB'))
+        for stage, name, oldWall, newWall, ratio, oldRSS, newRSS in compareReports(old, report):
+            print('%-16s %-22s %10.3f %10.3f %7.2f %10.1f %10.1f' % (stage, name, oldWall, newWall, ratio,
+                                                                     (oldRSS or 0) / 1e6, (newRSS or 0) / 1e6))
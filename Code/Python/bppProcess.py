@@ -0,0 +1,196 @@
+## bpp-process: process all the model/scenario daily files of one or more scenario directories in parallel
+## use: python3 bppProcess.py Data/raw/ssp126 Data/raw/ssp245 'Data/raw/ssp585/*.nc' --outdir Data/DHWmax --workers 8
+
+import os
+import glob
+import time
+import argparse
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+from processNC import processFile, profileFile, processParams, outputPrefixes, DHWbleach, DHWdead, climFileName
+from tools.DHWtools import viewNames
+from tools.cacheTools import ResultCache
+from tools.ioTools import outputName
+from tools.refTools import ReferenceDOY
+
+
+## result caches of each worker process: (cache directory, max size) -> ResultCache
+workerCaches = {}
+
+
+def workerCache(cacheDir, cacheSize):
+    '''
+    Get the result cache of a worker process, scanned once by the worker instead of once per file
+    :param cacheDir: cache directory
+    :param cacheSize: max cache size in GB
+    :return: ResultCache
+    '''
+    key = (os.path.abspath(cacheDir), cacheSize)
+    if key not in workerCaches:
+        workerCaches[key] = ResultCache(cacheDir, maxBytes=cacheSize * 1e9)
+    return workerCaches[key]
+
+
+def listFiles(inputs):
+    '''
+    List the model daily files of scenario directories or glob patterns
+    :param inputs: list of directories or glob patterns
+    :return: sorted list of files
+    '''
+    fileList = []
+    for item in inputs:
+        if os.path.isdir(item):
+            fileList.extend(glob.glob(os.path.join(item, '*.nc')))
+        else:
+            fileList.extend(glob.glob(item))
+    return sorted(set(fileList))
+
+
+def outputParams(outFileName):
+    '''
+    Get the processing parameters an output was made with
+    :param outFileName: output file or Zarr store
+    :return: bpp_params attribute, None if the output has none or cannot be read
+    '''
+    try:
+        if outFileName.rstrip('/').endswith('.zarr'):
+            ds = xr.open_zarr(outFileName)
+        else:
+            ds = xr.open_dataset(outFileName, decode_times=False, decode_timedelta=False)
+        with ds:
+            return ds.attrs.get('bpp_params')
+    except Exception:
+        return None
+
+
+def isUpToDate(fileName, outFileName, dependencies=(), params=None):
+    '''
+    Check if an output file is newer than its input file and its other dependencies,
+    and was made with the same processing parameters
+    :param fileName: input file
+    :param outFileName: output file
+    :param dependencies: other files the output depends on
+    :param params: processing parameters (see processNC.processParams). Not checked if None
+    :return: True if the output does not need to be processed again
+    '''
+    if not os.path.exists(outFileName):
+        return False
+    outTime = os.path.getmtime(outFileName)
+    if not all(os.path.getmtime(dep) <= outTime for dep in (fileName,) + tuple(dependencies) if dep is not None):
+        return False
+    return params is None or outputParams(outFileName) == params
+
+
+def outputsUpToDate(fileName, outDir, views, outFormat, dependencies=(), params=None):
+    '''
+    Check that all the outputs processFile writes for the views of an input file are up to date (see isUpToDate)
+    :param fileName: input file
+    :param outDir: output directory
+    :param views: views computed, after the defaults
+    :param outFormat: output format
+    :param dependencies: other files the outputs depend on
+    :param params: processing parameters. Not checked if None
+    :return: True if the file does not need to be processed again
+    '''
+    return all(isUpToDate(fileName, outputName(os.path.join(outDir, prefix + os.path.basename(fileName)), outFormat),
+                          dependencies, params) for prefix in outputPrefixes(views))
+
+
+def processTask(fileName, outDir, climFile, thresholds, quantiles, cacheDir=None, cacheSize=10.0,
+                outFormat='netcdf', tile=90, packed=False, events=False, views=None, profile=False,
+                profileMemory=False, prefetch=2):
+    '''
+    Process one file in a worker process
+    :return: file name, output file name, elapsed seconds, error message or None, profile table or None
+    '''
+    start = time.perf_counter()
+    try:
+        ## loaded once by worker process, and aligned once by model grid. The cache is also scanned once by worker
+        SSTmin = None if climFile is None else ReferenceDOY.fromFile(climFile)
+        cache = None if cacheDir is None else workerCache(cacheDir, cacheSize)
+        options = dict(thresholds=thresholds, quantiles=quantiles, verbose=False, cache=cache, outFormat=outFormat,
+                       tile=tile, packed=packed, events=events, views=views, prefetch=prefetch)
+        table = None
+        if profile:
+            outFileName, prof = profileFile(fileName, outDir, SSTmin, memory=profileMemory, **options)
+            table = prof.table()
+        else:
+            outFileName = processFile(fileName, outDir, SSTmin, **options)
+        return fileName, outFileName, time.perf_counter() - start, None, table
+    except Exception as err:
+        return fileName, None, time.perf_counter() - start, repr(err), None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='bpp-process',
+                                     description='extract the yearly DHW statistics of all the model/scenario '
+                                                 'daily files of scenario directories, in parallel')
+    parser.add_argument('inputs', nargs='+', help='scenario directories or glob patterns of model daily files')
+    parser.add_argument('--outdir', required=True, help='output directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[DHWbleach, DHWdead],
+                        help='DHW thresholds for the DOY and the number of days')
+    parser.add_argument('--quantiles', type=float, nargs='*', default=[0.99], help='DHW quantiles')
+    parser.add_argument('--clim', default=climFileName,
+                        help='SST climatology file with SSTmin_doy. "none" to skip the relative DOY')
+    parser.add_argument('--cache', default=None,
+                        help='directory of the cache of per-year results. Only the missing metrics are computed')
+    parser.add_argument('--cache-size', dest='cacheSize', type=float, default=10.0, help='max cache size in GB')
+    parser.add_argument('--format', choices=['netcdf', 'zarr'], default='netcdf', help='output format')
+    parser.add_argument('--tile', type=int, default=90, help='lat/lon tile size of the output chunks')
+    parser.add_argument('--packed', action='store_true',
+                        help='float32 computation, int16 storage of DHW (scale factor 0.1), DOY and days')
+    parser.add_argument('--events', action='store_true',
+                        help='also the last day above each threshold and the longest run of days above')
+    parser.add_argument('--views', nargs='+', choices=list(viewNames), default=None,
+                        help='views computed in the same read of every file: raw and rel in DHW_<file>, shifted in '
+                             'DHW_shifted_<file>. raw rel by default')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time of every stage of every file and write it in <output>.profile.json')
+    parser.add_argument('--profile-memory', dest='profileMemory', action='store_true',
+                        help='with --profile, also the tracemalloc peak of memory of every stage')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='number of years read ahead by every worker while it computes. 0 to read them in turn')
+    parser.add_argument('--force', action='store_true', help='process the files even if the output is up to date')
+    args = parser.parse_args()
+
+    climFile = None if args.clim.lower() == 'none' else args.clim
+    os.makedirs(args.outdir, exist_ok=True)
+
+    fileList = listFiles(args.inputs)
+    ## views as processFile sets them, to compare with the parameters of the outputs
+    views = args.views if args.views is not None else ('raw',) if climFile is None else ('raw', 'rel')
+    params = processParams(args.thresholds, args.quantiles, args.packed, args.events, views, args.format)
+    todo = []
+    for fileName in fileList:
+        if args.force or not outputsUpToDate(fileName, args.outdir, views, args.format, (climFile,), params):
+            todo.append(fileName)
+    print('%d files, %d up to date, %d to process with %d workers' %
+          (len(fileList), len(fileList) - len(todo), len(todo), args.workers))
+
+    start = time.perf_counter()
+    nBytes = 0
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(processTask, fileName, args.outdir, climFile, tuple(args.thresholds),
+                               tuple(args.quantiles), args.cache, args.cacheSize, args.format, args.tile,
+                               args.packed, args.events, args.views, args.profile, args.profileMemory,
+                               args.prefetch)
+                   for fileName in todo]
+        for future in as_completed(futures):
+            fileName, outFileName, elapsed, error, table = future.result()
+            size = os.path.getsize(fileName)
+            if error is None:
+                nBytes += size
+                print('%-60s %8.1f s %8.1f MB/s' % (os.path.basename(fileName), elapsed, size / 1e6 / elapsed))
+                if table is not None:
+                    print(table)
+            else:
+                failed.append(fileName)
+                print('%-60s FAILED %s' % (os.path.basename(fileName), error))
+
+    elapsed = time.perf_counter() - start
+    print('%d files processed, %d failed in %.1f s: %.1f MB/s' %
+          (len(todo) - len(failed), len(failed), elapsed, nBytes / 1e6 / elapsed if elapsed > 0 else 0.0))
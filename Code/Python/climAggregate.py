@@ -0,0 +1,56 @@
+## Decadal and rolling climatologies of the yearly DHW products of processNC, pooling the models of each scenario:
+## mean, frequency of the years with DHW >= 4 and 8, and trend per cell
+## use: python3 climAggregate.py 'Data/DHWmax/*/DHW_*.nc' --out Data/clim --window 10 --mode rolling decadal
+
+import os
+import glob
+import argparse
+import xarray as xr
+
+from tools.climTools import climatology
+from tools.ioTools import writeDataset
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='decadal and rolling climatologies of the yearly DHW products')
+    parser.add_argument('inputs', nargs='+', help='processNC output files or glob patterns')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--vars', nargs='+', default=['DHW_max', 'nDays_DHW4', 'DoY_DHW4'], help='variables')
+    parser.add_argument('--window', type=int, default=10, help='window length in years')
+    parser.add_argument('--mode', nargs='+', choices=['rolling', 'decadal'], default=['rolling', 'decadal'],
+                        help='rolling windows and/or calendar periods')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[4.0, 8.0],
+                        help='thresholds of the exceedance frequencies of the DHW variables. Inclusive')
+    parser.add_argument('--per-model', dest='perModel', action='store_true',
+                        help='also write the climatology of every model')
+    args = parser.parse_args()
+    os.makedirs(args.out, exist_ok=True)
+
+    ## group the files by scenario
+    fileList = sorted(set(fileName for item in args.inputs for fileName in glob.glob(item)))
+    scenarios = {}
+    for fileName in fileList:
+        with xr.open_dataset(fileName) as nc:
+            scenarios.setdefault(nc.attrs.get('IPCC_scenario', 'scenario'), []).append(fileName)
+
+    for scenario, scenarioFiles in scenarios.items():
+        print(scenario, '%d models' % len(scenarioFiles))
+        models = []
+        for fileName in scenarioFiles:
+            with xr.open_dataset(fileName, decode_timedelta=False) as nc:
+                models.append({varName: nc[varName].load() for varName in args.vars if varName in nc.data_vars})
+
+        for mode in args.mode:
+            groups = [(scenario, models)]
+            if args.perModel:
+                groups += [(os.path.splitext(os.path.basename(fileName))[0], [model])
+                           for fileName, model in zip(scenarioFiles, models)]
+            for name, group in groups:
+                ds = xr.merge([climatology([model[varName] for model in group], window=args.window, mode=mode,
+                                           thresholds=args.thresholds if varName.startswith('DHW') else ())
+                               for varName in args.vars if varName in group[0]], combine_attrs='override')
+                ds.attrs = {'title': 'DHW ' + mode + ' climatology', 'IPCC_scenario': scenario,
+                            'models': ', '.join(os.path.basename(fileName) for fileName in scenarioFiles)
+                            if len(group) > 1 else name,
+                            'window': args.window}
+                writeDataset(ds, os.path.join(args.out, 'clim_%s_%s%d' % (name, mode, args.window)))
@@ -1,8 +1,14 @@
 ## clip DHW files by the IPCC areas
-## save as clipped netcdf
+## the IPCC polygons are rasterized once into a region-id grid of the model grid, cached in the cache directory
+## save the statistics of DHW_max per region and year, and optionally the clipped netcdf of every polygon
+## use: python3 clipIPCC.py [fileName] [--basepath Data] [--outpath Data] [--clips]
+
 import os
+import argparse
 import xarray as xr
-import geopandas
+
+from tools.regionTools import regionGrid, clipRegion, regionStats
+
 
 def clipMap(nc, geometry, type="Polygon", crs=4326):
     '''
@@ -30,26 +36,35 @@ def clipMap(nc, geometry, type="Polygon", crs=4326):
     return nc_clip
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='clip and summarise DHW files by the IPCC areas')
+    parser.add_argument('fileName', nargs='?', default='test_DHWmax.nc')
+    parser.add_argument('--basepath', default='Data', help='directory of the input file')
+    parser.add_argument('--outpath', default='Data', help='output directory')
+    parser.add_argument('--shapefile', default='GIS/IPPC_corals.shp', help='IPCC polygons')
+    parser.add_argument('--cachedir', default='Data/cache', help='cache of the region grids')
+    parser.add_argument('--varname', default=None,
+                        help='variable of the region statistics. DHW_max, or DHW for the day2year files, by default')
+    parser.add_argument('--clips', action='store_true', help='also save the clipped netcdf of every polygon')
+    args = parser.parse_args()
+    fileName = args.fileName
 
-## read IPCC polygons
-ipcc = geopandas.read_file("GIS/IPPC_corals.shp").explode(ignore_index=True)
+    with xr.open_dataset(os.path.join(args.basepath, fileName)) as nc:
+        varName = args.varname
+        if varName is None:
+            varName = 'DHW_max' if 'DHW_max' in nc.data_vars else 'DHW'
 
-basePath = 'Data'
-outPath = 'Data'
-fileName = 'test_DHWmax.nc'
-with xr.open_dataset(os.path.join(basePath, fileName)) as nc:
-    ## make a list of coordinates for each polygon
-    oldAcronym = ""
-    for area in range(len(ipcc)):
-        print(ipcc.Name[area])
-        outFileName = ipcc.Acronym[area]
-        if outFileName == oldAcronym:
-            outFileName = outFileName + "-1"
-        outFileName = "IPCC-" + outFileName
-        oldAcronym = ipcc.Acronym[area]
-        coords = list(ipcc.geometry[area].exterior.coords)
-        coords_list = [list(item) for item in coords]
-        ncClip = clipMap(nc, coords_list)
-        ncClip.to_netcdf(os.path.join(outPath, outFileName + "_" + fileName))
+        ## read IPCC polygons, as a region grid of the file grid
+        latDim, lonDim = nc[varName].dims[-2:]
+        grid, names = regionGrid(args.shapefile, nc[latDim].values, nc[lonDim].values, cacheDir=args.cachedir)
 
+        ## statistics of all the regions and years at once
+        stats = regionStats(nc[varName], grid, names)
+        stats.to_netcdf(os.path.join(args.outpath, "IPCC-stats_" + fileName))
 
+        if args.clips:
+            for area, outFileName in enumerate(names):
+                print(outFileName)
+                ncClip = clipRegion(nc, grid, area)
+                if ncClip is not None:
+                    ncClip.to_netcdf(os.path.join(args.outpath, outFileName + "_" + fileName))
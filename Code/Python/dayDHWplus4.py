@@ -1,7 +1,9 @@
 ## Extract the first day when the DHW is > 4  in any year.
 
-import xarray as xr
-import numpy as np
+from tools.yearTools import applyByYear
+from tools.maskTools import GridMask
+from tools.DHWtools import getYdayDHWmax
+
 
 def dayDHWmax(nc, varName="DHW"):
     '''
@@ -15,32 +17,14 @@ def dayDHWmax(nc, varName="DHW"):
     nc = nc.drop_vars("time_bnds")
     nc['time'] = nc.time.dt.year
 
-    ## create land mask
-    mask = nc[varName][1,:,:].values
-    mask[~np.isnan(mask)] = 1
-
-    # replace NaN by zero to avoid argmax all-NaN slice error
-    nc0 = nc.fillna(0)
+    ## create land mask, once for all the years
+    mask = GridMask.fromData(nc[varName])
 
-    ## group and extract the day of DHW>4 per year
-    DHWyear = nc0.DHW.groupby("time")
-    years = list(DHWyear.groups)
-
-    ## create the first dataarray
-    dayDHWmax = DHWyear[years[0]].argmax(dim="time").astype("int")
-    dayDHWmax = dayDHWmax * mask
-    for yy in years[1:]:
-        print(yy)
-        DHWmaxyear = DHWyear[yy].argmax(dim="time")
-        # apply mask
-        DHWmaxyear = DHWmaxyear * mask
-        dayDHWmax = xr.concat([dayDHWmax, DHWmaxyear], "time")
+    ## extract the day of DHWmax per year, on the ocean cells
+    dayDHWmax = applyByYear(nc[varName], getYdayDHWmax, mask=mask, verbose=True)
 
     ## add 1 to the index to start the year at 1
     dayDHWmax = dayDHWmax + 1
 
-    ## add time coordinate
-    dayDHWmax = dayDHWmax.assign_coords({'time': years})
-
     return dayDHWmax
 
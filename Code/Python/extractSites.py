@@ -0,0 +1,42 @@
+## Yearly DHW statistics of the models at reef sites, as one tidy table
+## use: python3 extractSites.py 'Data/DHWmax/*/DHW_*.nc' --sites Data/reefSites.csv --out Data/site_DHW.parquet
+
+import os
+import glob
+import argparse
+import pandas as pd
+import xarray as xr
+
+from tools.siteTools import readSites, extractSites
+from tools.regionTools import writeTable
+from tools.queryTools import productEntry
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='yearly DHW products at reef sites, snapped to the nearest ocean cell')
+    parser.add_argument('inputs', nargs='+', help='processNC or ensemble output files or glob patterns')
+    parser.add_argument('--sites', required=True, help='table of the sites, .csv or .parquet')
+    parser.add_argument('--id', dest='idField', default='site', help='field of the site id')
+    parser.add_argument('--latfield', default='lat', help='field of the site latitude')
+    parser.add_argument('--lonfield', default='lon', help='field of the site longitude')
+    parser.add_argument('--vars', nargs='+', default=None, help='variables. All the yearly variables by default')
+    parser.add_argument('--max-distance', dest='maxDistance', type=float, default=None,
+                        help='max distance from a site to its ocean cell, km')
+    parser.add_argument('--out', required=True, help='output table, .parquet or .csv')
+    parser.add_argument('--cachedir', default='Data/cache', help='cache of the site indexes')
+    args = parser.parse_args()
+
+    sites = readSites(args.sites, idField=args.idField, latField=args.latfield, lonField=args.lonfield)
+    fileList = sorted(set(fileName for item in args.inputs for fileName in glob.glob(item)))
+    tables = []
+    for fileName in fileList:
+        print(fileName)
+        with xr.open_dataset(fileName) as ds:
+            table = extractSites(ds, sites, varNames=args.vars, maxDistance=args.maxDistance, cacheDir=args.cachedir)
+            entry = productEntry(fileName) or {}
+            table.insert(0, 'model', ds.attrs.get('model_name', entry.get('model', '')))
+            table.insert(0, 'scenario', ds.attrs.get('IPCC_scenario', entry.get('scenario', '')))
+            table.insert(0, 'file', os.path.basename(fileName))
+        tables.append(table)
+
+    writeTable(pd.concat(tables, ignore_index=True), args.out)
@@ -0,0 +1,36 @@
+## Convert a model daily DHW file into a cell store: only the ocean (or reef) cells, as a memory mapped [cell,time] array
+## processNC.py and makeEnsemble.py read the stores as they read the daily files
+## use: python3 makeCellStore.py fileName [--out DIR] [--reef reefFile.nc --reefvar reef]
+
+import os
+import argparse
+import xarray as xr
+import numpy as np
+
+from tools.maskTools import GridMask
+from tools.cellTools import writeCellStore, cellStoreSuffix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='convert a model daily DHW file into a reef-cell store')
+    parser.add_argument('fileName', help='model daily DHW file')
+    parser.add_argument('--out', default=None, help='output directory. The directory of the file by default')
+    parser.add_argument('--varname', default='DHW', help='variable name')
+    parser.add_argument('--reef', default=None,
+                        help='file of the reef mask on the model grid: cells with a non zero value are kept')
+    parser.add_argument('--reefvar', default='reef', help='variable of the reef mask')
+    args = parser.parse_args()
+
+    with xr.open_dataset(args.fileName) as nc:
+        da = nc[args.varname]
+        reef = None
+        if args.reef is not None:
+            with xr.open_dataset(args.reef) as ncReef:
+                reef = np.nan_to_num(ncReef[args.reefvar].values) != 0
+        mask = GridMask.fromData(da, reef=reef)
+        print(args.fileName, '%d of %d cells' % (mask.nCells, mask.mask.size))
+
+        outDir = args.out or os.path.dirname(args.fileName)
+        storeName = os.path.join(outDir, os.path.splitext(os.path.basename(args.fileName))[0] + cellStoreSuffix)
+        writeCellStore(da, storeName, mask=mask, source=os.path.basename(args.fileName), globalAttrs=nc.attrs,
+                       verbose=True)
@@ -1,77 +1,66 @@
 ## Make model ensemble by averaging daily DHW from all models
+## use: python3 makeEnsemble.py [scenario] [--workers 4] [--executor thread|process] [--no-daily] [--cells] [--bands 10]
+##      [--regrid conservative|bilinear] [--weights-cache DIR] [--profile [--profile-memory]]
 
 import os
 import glob
-import xarray as xr
-
-scenario = "ssp245"
-
-dataDir = "Data/raw/" + scenario
-outDir = "Data/raw/ensemble/" + scenario
-fileList = glob.glob("Data/raw/" + scenario + "/*.nc")
-yearList = list(range(1985, 2101))
-
-
-## do the first year
-yy = yearList[0]
-print(yy)
-# do the first two models
-nc0 = xr.open_dataset(fileList[0])
-nc1 = xr.open_dataset(fileList[1])
-
-nc0 = nc0.drop_vars("time_bnds")
-nc1 = nc1.drop_vars("time_bnds")
-dhwSum = nc0['DHW'].where(nc0.time.dt.year == yy, drop=True) + nc1['DHW'].where(nc1.time.dt.year == yy, drop=True)
-
-nc0.close()
-nc1.close()
-
-# loop over the rest of the models
-for ff in fileList[2:]:
-    print(ff)
-    with xr.open_dataset(ff) as nc0:
-        nc0 = nc0.drop_vars("time_bnds")
-        dhwSum = dhwSum + nc0['DHW'].where(nc0.time.dt.year == yy, drop=True)
-
-dhwSum = dhwSum / len(fileList)
-dhwMax = dhwSum.max(dim="time")
-dhwMax = dhwMax.assign_coords(year=yy)
-dhwMax = dhwMax.expand_dims({'year': 1})
-
-## loop over the rest of the years
-for yy in yearList[1:]:
-    print(yy)
-    # do the first two models
-    nc0 = xr.open_dataset(fileList[0])
-    nc1 = xr.open_dataset(fileList[1])
-
-    nc0 = nc0.drop_vars("time_bnds")
-    nc1 = nc1.drop_vars("time_bnds")
-    dhwSum = nc0['DHW'].where(nc0.time.dt.year == yy, drop=True) + nc1['DHW'].where(nc1.time.dt.year == yy, drop=True)
-
-    nc0.close()
-    nc1.close()
-
-    # loop over the rest of the models
-    for ff in fileList[2:]:
-        print(ff)
-        with xr.open_dataset(ff) as nc0:
-            nc0 = nc0.drop_vars("time_bnds")
-            dhwSum = dhwSum + nc0['DHW'].where(nc0.time.dt.year == yy, drop=True)
-
-    dhwSum = dhwSum / len(fileList)
-    dhwMax0 = dhwSum.max(dim="time")
-    dhwMax0 = dhwMax0.assign_coords(year=yy)
-    dhwMax0 = dhwMax0.expand_dims({'year': 1})
-
-    dhwMax = xr.concat([dhwMax, dhwMax0], dim="year")
-
-dhwMax.attrs = dict(description='Ensemble maximum value of the Degree Heating Week of the year',
-                    longname='Degree Heating Week', units='degC.week',
-                    comment='this ensemble corresponds to the {0} scenario'.format(scenario))
-
-
-dhwMax.to_netcdf(os.path.join(outDir, (scenario + "_ensemble.nc")))
-
-
-
+import argparse
+
+from tools.ensembleTools import makeEnsemble, ensembleQuantiles
+from tools.profTools import stage, startProfile, stopProfile, profileName
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='make the model ensemble of the daily DHW of a scenario')
+    parser.add_argument('scenario', nargs='?', default='ssp245')
+    parser.add_argument('--workers', type=int, default=4, help='number of parallel model readers')
+    parser.add_argument('--executor', choices=['thread', 'process'], default='thread', help='pool of model readers')
+    parser.add_argument('--no-daily', dest='writeDaily', action='store_false',
+                        help='do not write the ensemble daily files')
+    parser.add_argument('--cells', action='store_true',
+                        help='read the cell stores of the models (see makeCellStore.py) instead of the daily files')
+    parser.add_argument('--bands', type=int, default=None, metavar='YEARS',
+                        help='also write the percentile bands of the daily DHW of all the models by periods of YEARS')
+    parser.add_argument('--band-quantiles', dest='bandQuantiles', type=float, nargs='+', default=[0.05, 0.5, 0.95],
+                        help='quantiles of the percentile bands')
+    parser.add_argument('--regrid', choices=['conservative', 'bilinear'], default=None,
+                        help='regrid the models that are not on the grid of the first one. An error if not set')
+    parser.add_argument('--weights-cache', dest='weightsDir', default=None,
+                        help='cache directory of the regridding weights')
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help='number of years read ahead of the year being accumulated (model years for --bands)')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time of every stage and write it in <scenario>_ensemble.profile.json')
+    parser.add_argument('--profile-memory', dest='profileMemory', action='store_true',
+                        help='with --profile, also the tracemalloc peak of memory of every stage')
+    args = parser.parse_args()
+    scenario = args.scenario
+
+    dataDir = "Data/raw/" + scenario
+    outDir = "Data/raw/ensemble/" + scenario
+    fileList = sorted(glob.glob(os.path.join(dataDir, "*.cells" if args.cells else "*.nc")))
+    yearList = list(range(1985, 2101))
+
+    outFileName = os.path.join(outDir, (scenario + "_ensemble.nc"))
+    if args.profile:
+        startProfile(memory=args.profileMemory)
+    try:
+        dhwMax = makeEnsemble(fileList, outDir, scenario, years=yearList, workers=args.workers,
+                              executor=args.executor, writeDaily=args.writeDaily, regrid=args.regrid,
+                              weightsDir=args.weightsDir, prefetch=args.prefetch)
+
+        with stage('write'):
+            dhwMax.to_netcdf(outFileName)
+
+        if args.bands is not None:
+            periods = [(yy, min(yy + args.bands - 1, yearList[-1])) for yy in yearList[::args.bands]]
+            bands = ensembleQuantiles(fileList, periods, quantiles=args.bandQuantiles, regrid=args.regrid,
+                                       weightsDir=args.weightsDir, prefetch=args.prefetch)
+            with stage('write'):
+                bands.to_netcdf(os.path.join(outDir, (scenario + "_ensemble_bands.nc")))
+    finally:
+        profile = stopProfile()
+
+    if profile is not None:
+        profile.write(profileName(outFileName), scenario=scenario, files=fileList, outFileName=outFileName)
+        print(profile.table())
@@ -0,0 +1,39 @@
+## Make the coarsened overview levels (0.5, 1 and 2 degrees) of the yearly DHW products of processNC or the ensemble
+## for fast portal rendering and summary statistics. The regridding weights are cached per grid pair
+## use: python3 makeOverviews.py 'Data/DHWmax/ssp245/DHW_*.nc' --out Data/overviews --resolutions 0.5 1 2 --cache Data/weights
+
+import os
+import glob
+import argparse
+import xarray as xr
+
+from tools.regridTools import overviews, overviewResolutions, resolutionName
+from tools.ioTools import writeDataset
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='coarsened overview levels of the yearly DHW products')
+    parser.add_argument('inputs', nargs='+', help='yearly files or glob patterns')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--resolutions', type=float, nargs='+', default=list(overviewResolutions),
+                        help='cell sizes of the levels in degrees. Levels finer than the source are skipped')
+    parser.add_argument('--method', choices=['conservative', 'bilinear'], default='conservative',
+                        help='regridding method')
+    parser.add_argument('--min-coverage', dest='minCoverage', type=float, default=0.0,
+                        help='min fraction of a level cell on valid (ocean) source cells')
+    parser.add_argument('--cache', default=None, help='cache directory of the regridding weights')
+    parser.add_argument('--format', choices=['netcdf', 'zarr'], default='netcdf', help='output format')
+    args = parser.parse_args()
+    os.makedirs(args.out, exist_ok=True)
+
+    fileList = sorted(set(fileName for item in args.inputs for fileName in glob.glob(item)))
+    for fileName in fileList:
+        print(fileName)
+        name = os.path.splitext(os.path.basename(fileName.rstrip('/')))[0]
+        with xr.open_dataset(fileName, decode_timedelta=False) as nc:
+            levels = overviews(nc.load(), resolutions=args.resolutions, method=args.method, cacheDir=args.cache,
+                               minCoverage=args.minCoverage)
+        for resolution, ds in levels.items():
+            ds.attrs['overview_resolution'] = resolution
+            ds.attrs['overview_method'] = args.method
+            writeDataset(ds, os.path.join(args.out, name + '_' + resolutionName(resolution)), format=args.format)
@@ -0,0 +1,60 @@
+## Make the XYZ web map tiles of the yearly DHW layers of processNC (or ensemble) outputs
+## tiles are written in outDir/scenario/model/variable/year/z/x/y.png
+## use: python3 makeTiles.py Data/DHWmax/ssp245/DHW_*.nc --out Data/tiles --vars DHW_max DoY_DHW4 --zoom 0 5 --workers 8
+
+import os
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import xarray as xr
+
+from tools.tileTools import renderLayer, writeTileMetadata
+
+
+def layerTask(fileName, varName, index, outDir, zooms, cmapName, format):
+    '''
+    Render the tiles of one year of a variable in a worker process
+    :return: year, number of tiles
+    '''
+    with xr.open_dataset(fileName) as nc:
+        da = nc[varName]
+        latDim, lonDim = da.dims[-2:]
+        layer = da.isel({da.dims[0]: index})
+        year = str(layer[da.dims[0]].values)
+        nTiles = renderLayer(layer.values, nc[latDim].values, nc[lonDim].values, os.path.join(outDir, year),
+                             zooms=zooms, varName=varName, cmapName=cmapName, format=format)
+    return year, nTiles
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='make the XYZ tiles of yearly DHW layers')
+    parser.add_argument('inputs', nargs='+', help='yearly files or glob patterns')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--vars', nargs='+', default=['DHW_max'], help='variables')
+    parser.add_argument('--zoom', type=int, nargs=2, default=[0, 5], help='min and max zoom')
+    parser.add_argument('--cmap', default='hot_r', help='matplotlib colormap')
+    parser.add_argument('--format', choices=['png', 'webp'], default='png', help='tile format')
+    parser.add_argument('--scenario', default=None, help='scenario name. From the file attributes by default')
+    parser.add_argument('--model', default=None, help='model name. From the file attributes, or ensemble, by default')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    args = parser.parse_args()
+    zooms = list(range(args.zoom[0], args.zoom[1] + 1))
+
+    fileList = sorted(set(fileName for item in args.inputs for fileName in glob.glob(item)))
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = []
+        for fileName in fileList:
+            with xr.open_dataset(fileName) as nc:
+                scenario = args.scenario or nc.attrs.get('IPCC_scenario', 'scenario')
+                model = args.model or nc.attrs.get('model_name', 'ensemble')
+                for varName in args.vars:
+                    varDir = os.path.join(args.out, scenario, model, varName)
+                    os.makedirs(varDir, exist_ok=True)
+                    writeTileMetadata(varDir, varName, zooms, args.cmap, args.format)
+                    for index in range(nc[varName].shape[0]):
+                        futures.append(pool.submit(layerTask, fileName, varName, index, varDir, zooms,
+                                                   args.cmap, args.format))
+        for future in as_completed(futures):
+            year, nTiles = future.result()
+            print(year, '%d tiles' % nTiles)
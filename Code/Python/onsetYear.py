@@ -0,0 +1,46 @@
+## Onset year of annual severe bleaching (DHW_max >= 8 every year from then on, or N of M years) of every reef cell,
+## model and scenario, with the trend of DHW_max and the spread across the models
+## use: python3 onsetYear.py 'Data/DHWmax/*/DHW_*.nc' --out Data/onset [--var DHW_max --threshold 8 --nyears 8 --window 10]
+
+import os
+import glob
+import argparse
+import xarray as xr
+
+from tools.climTools import onsetEnsemble
+from tools.ioTools import writeDataset
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='onset year of annual severe bleaching by cell, model and scenario')
+    parser.add_argument('inputs', nargs='+', help='processNC output files or glob patterns')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--var', default='DHW_max', help='yearly variable, e.g. DHW_max or nDays_DHW8')
+    parser.add_argument('--threshold', type=float, default=8.0, help='threshold of the variable. Inclusive')
+    parser.add_argument('--nyears', type=int, default=1, help='min number of years above the threshold in a window')
+    parser.add_argument('--window', type=int, default=1, help='window length in years. 1: every year')
+    args = parser.parse_args()
+    if args.nyears > args.window:
+        parser.error('--nyears must not be more than --window')
+    os.makedirs(args.out, exist_ok=True)
+
+    ## group the files by scenario
+    fileList = sorted(set(fileName for item in args.inputs for fileName in glob.glob(item)))
+    scenarios = {}
+    for fileName in fileList:
+        with xr.open_dataset(fileName) as nc:
+            scenarios.setdefault(nc.attrs.get('IPCC_scenario', 'scenario'), []).append(fileName)
+
+    for scenario, scenarioFiles in scenarios.items():
+        print(scenario, '%d models' % len(scenarioFiles))
+        dataArrays = []
+        models = []
+        for fileName in scenarioFiles:
+            with xr.open_dataset(fileName, decode_timedelta=False) as nc:
+                dataArrays.append(nc[args.var].load())
+                models.append(nc.attrs.get('model_name', os.path.basename(fileName)))
+        ds = onsetEnsemble(dataArrays, threshold=args.threshold, nYears=args.nyears, window=args.window,
+                           models=models)
+        ds.attrs['IPCC_scenario'] = scenario
+        writeDataset(ds, os.path.join(args.out, 'onset_%s_%s%g_%dof%d' % (scenario, args.var, args.threshold,
+                                                                        args.nyears, args.window)))
@@ -1,13 +1,24 @@
 ## process IPCC model/scenario daily files
 ## returns dataset with DHWmax, DHWdoy and DHWdoyrel, DHWNDays
+## use: python3 processNC.py [fileName] [--outdir DIR] [--chunks 90 --workers 4 [--scheduler distributed]] [--cache DIR] [--format zarr] [--packed] [--events]
+##      [--views raw rel shifted] [--profile [--profile-memory]]
 
 import os
 import sys
+import json
+import argparse
 import xarray as xr
 import numpy as np
 from datetime import datetime
 
 from tools.DHWtools import *
+from tools.yearTools import applyByYear, applyByYearLazy
+from tools.maskTools import GridMask
+from tools.cellTools import CellStore, isCellStore
+from tools.refTools import ReferenceDOY
+from tools.profTools import stage, startProfile, stopProfile, profileName
+from tools.cacheTools import ResultCache, cachedYearlyStats, sourceSignature
+from tools.ioTools import writeDataset
 
 
 DHWbleach = 4.0
@@ -18,110 +29,263 @@ fileRoot = '/home/eklein/Proyectos/Camille/Data/raw/ssp245_may22/'
 outFileRoot = '/home/eklein/Proyectos/Camille/Data/DHWmax/ssp245_may22/'
 
 filePrefix = 'ssp245_BCC-CSM2-MR_DHW.nc'
-fileName = os.path.join(fileRoot + filePrefix)
-print(fileName)
-
-## load SST climatology
-with xr.open_dataset("Data/SSTminmax_DOY.nc") as nc:
-    SSTmin = nc.SSTmin_doy
-
-## load model data
-with xr.open_dataset(fileName) as nc:
-    if "time_bnds" in nc.data_vars:
-        nc = nc.drop_vars("time_bnds")
-    yearMin = int(nc.time.dt.year.min())
-    yearMax = int(nc.time.dt.year.max())
-    nc['time'] = nc.time.dt.year
-    DHW = nc['DHW']
-
-## group and extract the day of DHWmax per year
-DHWyear = DHW.groupby("time")
-years = list(DHWyear.groups)
-
-## create the first data arrays
-DHWyear_tmp = DHWyear[years[0]]
-DHWmax = getDHWmax(DHWyear_tmp)
-DHWq99 = getDHWp99(DHWyear_tmp, 0.99)
-DHWdoy_4 = getDOY(DHWyear_tmp, 4)
-DHWdoy_8 = getDOY(DHWyear_tmp, 8)
-DHWdoyrel_4 = getDOYrel(DHWyear_tmp, 4, SSTmin)
-DHWdoyrel_8 = getDOYrel(DHWyear_tmp, 8, SSTmin)
-DHWndays_4 = getNDays(DHWyear_tmp, 4)
-DHWndays_8 = getNDays(DHWyear_tmp, 8)
-
-## process the rest of the years
-for yy in years[1:]:
-    print(yy)
-    DHWyear_tmp = DHWyear[yy]
-    DHWmax = xr.concat([DHWmax, getDHWmax(DHWyear_tmp)], 'time')
-    DHWq99 = xr.concat([DHWq99, getDHWp99(DHWyear_tmp, 0.99)], 'time')
-    DHWdoy_4 = xr.concat([DHWdoy_4, getDOY(DHWyear_tmp, 4)], 'time')
-    DHWdoy_8 = xr.concat([DHWdoy_8, getDOY(DHWyear_tmp, 8)], 'time')
-    DHWdoyrel_4 = xr.concat([DHWdoyrel_4, getDOYrel(DHWyear_tmp, 4, SSTmin)], 'time')
-    DHWdoyrel_8 = xr.concat([DHWdoyrel_8, getDOYrel(DHWyear_tmp, 8, SSTmin)], 'time')
-    DHWndays_4 = xr.concat([DHWndays_4, getNDays(DHWyear_tmp, 4)], 'time')
-    DHWndays_8 = xr.concat([DHWndays_8, getNDays(DHWyear_tmp, 8)], 'time')
-
-## make data sewt
-ds = xr.Dataset({'DHW_max': DHWmax,
-                 'DHW_q99': DHWq99,
-                 'DoY_DHW4': DHWdoy_4,
-                 'DoY_DHW8': DHWdoy_8,
-                 'DoYrel_DHW4': DHWdoyrel_4,
-                 'DoYrel_DHW8': DHWdoyrel_8,
-                 'nDays_DHW4': DHWndays_4,
-                 'nDays_DHW8': DHWndays_8})
-
-## code fillValue as 9999
-
-
-## add variable attributes
-ds.DHW_max.attrs = {'long_name': 'Maximum yearly value of Degree Heating Week',
-                    'units': 'degrees celsius-week'}
-ds.DHW_q99.attrs = {'long_name': '99th quantile of the Degree Heating Week',
-                    'units': 'degrees celsius-week'}
-ds.DoY_DHW4.attrs = {'long_name': 'first day of the year when DHW exceeds 4 degree-weeks',
-                     'units': 'day of the year',
-                     'comment': 'considering January 1st the first day of the year'}
-ds.DoY_DHW8.attrs = {'long_name': 'first day of the year when DHW exceeds 8 degree-weeks',
-                     'units': 'day of the year',
-                     'comment': 'considering January 1st the first day of the year'}
-ds.DoYrel_DHW4.attrs = {'long_name': 'first day of the year when DHW exceeds 4 degree-weeks, relative to the climatological coldest DOY',
-                     'units': 'day of the year',
-                     'comment': 'considering the coldest climatological DoY as the first day of the year'}
-ds.DoYrel_DHW8.attrs = {'long_name': 'first day of the year when DHW exceeds 8 degree-weeks, relative to the climatological coldest DOY',
-                     'units': 'day of the year',
-                     'comment': 'considering the coldest climatological DoY as the first day of the year'}
-ds.nDays_DHW4.attrs = {'long_name': 'number of days above 4 degrees-week',
-                       'units': 'days'}
-ds.nDays_DHW8.attrs = {'long_name': 'number of days above 8 degrees-week',
-                       'units': 'days'}
-
-
-## add global attributes
-modelString = filePrefix.split('.nc')[0].split('_')
-scenario = modelString[0]
-modelName = modelString[1]
-ds.attrs = {'title': 'DHW general yearly statistics',
-            'abstract': 'Projections of future coral bleaching risk, expressed as annual maximum Degree Heating Weeks (DHW), '
-                        'onset and duration of severe bleaching in every year between 1985 and 2100. '
-                        'For details on the methods and results, please cite. '
-                        'This project is a collaboration between University of Adelaide, James Cook University and Ocean Analytics',
-            'source_file': filePrefix,
-            'model_name': modelName,
-            'IPCC_scenario': scenario,
-            'time_coverage_start': yearMin,
-            'time_coverage_end': yearMax,
-            'creation_date': str(datetime.now()),
-            'citation': '',
-            'author_name': 'Klein, Eduardo',
-            'author_email': 'eklein at ocean-analytics dot com.au'}
-
-## add compression
-comp = dict(zlib=True, complevel=5)
-encoding = {var: comp for var in ds.data_vars}
-
-ds.to_netcdf(os.path.join(outFileRoot, ('DHW_' + filePrefix)), encoding=encoding)
 
+climFileName = 'Data/SSTminmax_DOY.nc'
 
 
+def outputPrefixes(views):
+    '''
+    Prefixes of the outputs processFile writes for views: DHW_ for the raw and rel views, DHW_shifted_ for shifted
+    :param views: views computed, after the defaults (see processFile)
+    :return: list of prefixes
+    '''
+    prefixes = []
+    if 'raw' in views or 'rel' in views:
+        prefixes.append('DHW_')
+    if 'shifted' in views:
+        prefixes.append('DHW_shifted_')
+    return prefixes
+
+
+def processParams(thresholds, quantiles, packed, events, views, outFormat):
+    '''
+    Processing parameters that change the products, written in the bpp_params attribute of the outputs
+    so bppProcess can tell an output made with other parameters
+    :param thresholds: DHW thresholds
+    :param quantiles: DHW quantiles
+    :param packed: packed mode
+    :param events: last day and longest run extracted
+    :param views: views computed, after the defaults (see processFile)
+    :param outFormat: output format
+    :return: JSON string
+    '''
+    return json.dumps({'thresholds': sorted(float(threshold) for threshold in thresholds),
+                       'quantiles': sorted(float(q) for q in quantiles),
+                       'packed': bool(packed), 'events': bool(events), 'views': sorted(views),
+                       'format': outFormat}, sort_keys=True)
+
+
+def processFile(fileName, outFileRoot, SSTmin, chunks=None, thresholds=(DHWbleach, DHWdead), quantiles=(0.99,),
+                verbose=True, cache=None, outFormat='netcdf', tile=90, packed=False, events=False, views=None,
+                prefetch=2):
+    '''
+    Extract the yearly DHW statistics of a model/scenario daily file and save them as netCDF
+    :param fileName: model daily DHW file, named scenario_model_*.nc, or its cell store (see makeCellStore.py)
+    :param outFileRoot: output directory
+    :param SSTmin: ReferenceDOY or data array of the DOY of the min climatological SST [lat,lon],
+                   aligned to the model grid. No relative DOY if None
+    :param chunks: lat/lon tile size. If given, the file is processed lazily by tiles with dask. Not used with
+                   cell stores
+    :param thresholds: DHW thresholds for the DOY and the number of days
+    :param quantiles: DHW quantiles
+    :param verbose: print the file and the year being processed
+    :param cache: ResultCache of the per-year results. Only the missing (year, metric) cells are computed.
+                  Not used with chunks
+    :param outFormat: output format, 'netcdf' or 'zarr'
+    :param tile: lat/lon tile size of the output chunks
+    :param packed: compute in float32, keep the DOY and days as int16 and store the DHW values as int16
+                   with scale_factor 0.1
+    :param events: also extract the last day above each threshold and the longest run of consecutive days above
+    :param views: views of the statistics computed in the same read of the file (see compute_view_stats):
+                  'raw' and 'rel' (DoYrel_ variables) are written in DHW_<file>, 'shifted' in DHW_shifted_<file>.
+                  ('raw', 'rel') if None, or ('raw',) without SSTmin. The shifted view is not available with chunks
+                  and is not cached
+    :param prefetch: number of years read ahead on a background thread while the statistics are computed.
+                     Not used with chunks or cache
+    :return: name of the output file or store, the shifted one if only the shifted view is requested
+    '''
+    if views is None:
+        views = ('raw',) if SSTmin is None else ('raw', 'rel')
+    if 'shifted' in views and chunks is not None:
+        raise ValueError('the shifted view is not available with chunks')
+    if verbose:
+        print(fileName)
+
+    if isCellStore(fileName):
+        ## reef cells only, memory mapped. The results are put back on the grid when written
+        store = CellStore(fileName)
+        nc = None
+        chunks = None
+        filePrefix = store.source
+        DHW = store.dataArray()
+        yearMin = int(store.years.min())
+        yearMax = int(store.years.max())
+        if SSTmin is not None:
+            grid = xr.DataArray(np.empty(store.mask.shape, dtype='int8'), dims=store.mask.dims,
+                                coords=store.mask.coords)
+            SSTmin = xr.DataArray(ReferenceDOY.fromData(SSTmin).cells(grid, store.mask), dims=('cell',))
+        mask = None
+        source = sourceSignature(store.valuesPath)
+    else:
+        ## load model data. With chunks, the time axis is kept in one chunk and the tiles are read when written
+        store = None
+        filePrefix = os.path.basename(fileName)
+        with stage('open'):
+            nc = xr.open_dataset(fileName, chunks=None if chunks is None else {})
+            if "time_bnds" in nc.data_vars:
+                nc = nc.drop_vars("time_bnds")
+            yearMin = int(nc.time.dt.year.min())
+            yearMax = int(nc.time.dt.year.max())
+            nc['time'] = nc.time.dt.year
+            DHW = nc['DHW']
+
+        ## the climatology is checked against the model grid, flipped or reindexed once per grid
+        with stage('reference'):
+            if SSTmin is not None:
+                SSTmin = ReferenceDOY.fromData(SSTmin).align(DHW)
+        with stage('land mask'):
+            mask = GridMask.fromData(DHW) if chunks is None else None
+        source = sourceSignature(fileName)
+
+    ## extract all the statistics for each year. All the statistics of a year are computed in one pass
+    ## on the ocean cells of the land mask, built once for all the years. Each tile builds its own with chunks
+    outputs = {}
+    if 'rel' not in views and 'shifted' not in views:
+        SSTmin = None
+    if 'shifted' in views or 'raw' not in views:
+        ## every year is read once for all the views
+        viewStats = compute_view_stats(DHW, views=views, thresholds=thresholds, quantiles=quantiles, ref=SSTmin,
+                                       packed=packed, mask=mask, events=events, verbose=verbose,
+                                       prefetch=prefetch)
+        yearly = [viewStats[view] for view in ('raw', 'rel') if view in viewStats]
+        if yearly:
+            ## the raw and rel views have distinct variables on the same years and grid
+            outputs['DHW_'] = xr.merge(yearly, compat='override', join='exact')
+        if 'shifted' in viewStats:
+            outputs['DHW_shifted_'] = viewStats['shifted']
+    elif cache is not None and chunks is None:
+        outputs['DHW_'] = cachedYearlyStats(DHW, cache, source, thresholds=thresholds, quantiles=quantiles,
+                                            ref=SSTmin, packed=packed, mask=mask, events=events, verbose=verbose)
+    elif chunks is None:
+        outputs['DHW_'] = applyByYear(DHW, compute_yearly_stats, thresholds=thresholds, quantiles=quantiles,
+                                      ref=SSTmin, packed=packed, mask=mask, events=events, verbose=verbose,
+                                      prefetch=prefetch)
+    else:
+        DHW = DHW.chunk({'time': -1, DHW.dims[1]: chunks, DHW.dims[2]: chunks})
+        outputs['DHW_'] = applyByYearLazy(DHW, compute_yearly_stats, thresholds=thresholds, quantiles=quantiles,
+                                          ref=SSTmin, packed=packed, events=events)
+
+    ## add global attributes
+    modelString = filePrefix.split('.nc')[0].split('_')
+    scenario = modelString[0]
+    modelName = modelString[1]
+    globalAttrs = {'title': 'DHW general yearly statistics',
+                'abstract': 'Projections of future coral bleaching risk, expressed as annual maximum Degree Heating Weeks (DHW), '
+                            'onset and duration of severe bleaching in every year between 1985 and 2100. '
+                            'For details on the methods and results, please cite. '
+                            'This project is a collaboration between University of Adelaide, James Cook University and Ocean Analytics',
+                'source_file': filePrefix,
+                'model_name': modelName,
+                'IPCC_scenario': scenario,
+                'time_coverage_start': yearMin,
+                'time_coverage_end': yearMax,
+                'creation_date': str(datetime.now()),
+                'citation': '',
+                'author_name': 'Klein, Eduardo',
+                'author_email': 'eklein at ocean-analytics dot com.au',
+                'bpp_params': processParams(thresholds, quantiles, packed, events, views, outFormat)}
+
+    ## write with compression, chunked by year and lat/lon tiles
+    ## a lazy dataset is computed and streamed to the file tile by tile
+    outFileNames = []
+    for prefix, ds in outputs.items():
+        ds.attrs = dict(globalAttrs)
+        if prefix == 'DHW_shifted_':
+            ds.attrs['title'] = 'DHW yearly statistics of the shifted year'
+            ds.attrs['comment'] = 'the shifted year of every cell starts the day after the climatological coldest DoY'
+        if store is not None:
+            ds = store.toGrid(ds)
+        outFileNames.append(writeDataset(ds, os.path.join(outFileRoot, (prefix + filePrefix)), format=outFormat,
+                                         latTile=tile, lonTile=tile, packed=packed))
+    if nc is not None:
+        nc.close()
+
+    return outFileNames[0]
+
+
+def profileFile(fileName, outFileRoot, SSTmin, memory=False, **kwargs):
+    '''
+    processFile with the time of every stage (open, read and decode, quantile, exceedance, expand, write...)
+    the per-stage breakdown is written as JSON next to the output, in <output>.profile.json
+    :param fileName: model daily DHW file or cell store
+    :param outFileRoot: output directory
+    :param SSTmin: reference DOY, see processFile
+    :param memory: also track the tracemalloc peak of every stage. Slows down the processing
+    :param kwargs: other arguments of processFile
+    :return: name of the output file, Profile
+    '''
+    startProfile(memory=memory)
+    try:
+        outFileName = processFile(fileName, outFileRoot, SSTmin, **kwargs)
+    finally:
+        profile = stopProfile()
+    profile.write(profileName(outFileName), fileName=fileName, outFileName=outFileName)
+    return outFileName, profile
+
+
+def setScheduler(workers=None, scheduler='threads'):
+    '''
+    Set the dask scheduler for the chunked mode
+    :param workers: number of workers. All the cores if None
+    :param scheduler: 'threads' for the local threaded scheduler, 'distributed' for a local dask distributed cluster
+    :return: the distributed client, or None for the threaded scheduler
+    '''
+    import dask
+    if scheduler == 'distributed':
+        from dask.distributed import Client, LocalCluster
+        return Client(LocalCluster(n_workers=workers, threads_per_worker=1))
+    dask.config.set(scheduler='threads', num_workers=workers)
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='extract the yearly DHW statistics of a model/scenario daily file')
+    parser.add_argument('fileName', nargs='?', default=os.path.join(fileRoot + filePrefix),
+                        help='model daily DHW file')
+    parser.add_argument('--outdir', default=outFileRoot, help='output directory')
+    parser.add_argument('--clim', default=climFileName, help='SST climatology file with SSTmin_doy')
+    parser.add_argument('--chunks', type=int, default=None,
+                        help='lat/lon tile size. Process the file lazily by tiles with dask')
+    parser.add_argument('--workers', type=int, default=None, help='number of dask workers in chunked mode')
+    parser.add_argument('--scheduler', choices=['threads', 'distributed'], default='threads',
+                        help='dask scheduler in chunked mode')
+    parser.add_argument('--cache', default=None, help='directory of the cache of per-year results')
+    parser.add_argument('--cache-size', dest='cacheSize', type=float, default=10.0, help='max cache size in GB')
+    parser.add_argument('--format', choices=['netcdf', 'zarr'], default='netcdf', help='output format')
+    parser.add_argument('--tile', type=int, default=90, help='lat/lon tile size of the output chunks')
+    parser.add_argument('--packed', action='store_true',
+                        help='float32 computation, int16 storage of DHW (scale factor 0.1), DOY and days')
+    parser.add_argument('--events', action='store_true',
+                        help='also the last day above each threshold and the longest run of days above')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time of every stage and write it in <output>.profile.json')
+    parser.add_argument('--profile-memory', dest='profileMemory', action='store_true',
+                        help='with --profile, also the tracemalloc peak of memory of every stage')
+    parser.add_argument('--views', nargs='+', choices=list(viewNames), default=None,
+                        help='views computed in the same read: raw and rel in DHW_<file>, shifted in '
+                             'DHW_shifted_<file>. raw rel by default')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='number of years read ahead on a background thread. 0 to read them in turn')
+    args = parser.parse_args()
+
+    ## load SST climatology
+    SSTmin = ReferenceDOY.fromFile(args.clim)
+
+    client = None
+    if args.chunks is not None:
+        client = setScheduler(args.workers, args.scheduler)
+
+    cache = None
+    if args.cache is not None:
+        cache = ResultCache(args.cache, maxBytes=args.cacheSize * 1e9)
+
+    options = dict(chunks=args.chunks, cache=cache, outFormat=args.format, tile=args.tile, packed=args.packed,
+                   events=args.events, views=args.views, prefetch=args.prefetch)
+    if args.profile:
+        outFileName, profile = profileFile(args.fileName, args.outdir, SSTmin, memory=args.profileMemory, **options)
+        print(profile.table())
+    else:
+        processFile(args.fileName, args.outdir, SSTmin, **options)
+
+    if client is not None:
+        client.close()
@@ -0,0 +1,128 @@
+## Local HTTP query API over the processed DHW products for the portal backend, as a plain ASGI app (no framework)
+## GET /catalog
+## GET /point?scenario=ssp245&var=DHW_max&lat=-18.3&lon=147.7[&models=A,B][&years=2020,2050][&product=shifted]
+## GET /bbox?scenario=ssp245&model=ensemble&var=DoY_DHW4&lat=-25,-10&lon=142,155[&year=2050]
+## GET /region?scenario=ssp245&var=DHW_max&region=IPCC-AUS[&models=A,B]
+## GET /stats
+## use: python3 queryService.py --root Data/DHWmax [--regions GIS/IPPC_corals.shp] [--port 8000]   (requires uvicorn)
+##      or BPP_DATA=Data/DHWmax uvicorn queryService:app
+
+import os
+import json
+import asyncio
+import argparse
+from urllib.parse import parse_qs
+
+from tools.queryTools import ProductStore
+
+
+def floatPair(text):
+    low, high = (float(value) for value in text.split(','))
+    return min(low, high), max(low, high)
+
+
+def intPair(text):
+    first, last = (int(value) for value in text.split(','))
+    return first, last
+
+
+def listParam(text):
+    return None if text is None else text.split(',')
+
+
+def resolutionParam(text):
+    return None if text is None else float(text)
+
+
+def handlePoint(store, params):
+    return store.point(params['scenario'], params['var'], float(params['lat']), float(params['lon']),
+                       product=params.get('product', 'yearly'), models=listParam(params.get('models')),
+                       years=intPair(params['years']) if 'years' in params else None,
+                       resolution=resolutionParam(params.get('resolution')))
+
+
+def handleBbox(store, params):
+    return store.bbox(params['scenario'], params.get('model', 'ensemble'), params['var'],
+                      floatPair(params['lat']), floatPair(params['lon']),
+                      year=int(params['year']) if 'year' in params else None,
+                      product=params.get('product', 'yearly'), resolution=resolutionParam(params.get('resolution')))
+
+
+def handleRegion(store, params):
+    return store.region(params['scenario'], params['var'], params['region'], product=params.get('product', 'yearly'),
+                        models=listParam(params.get('models')),
+                        years=intPair(params['years']) if 'years' in params else None,
+                        resolution=resolutionParam(params.get('resolution')))
+
+
+## handlers by path
+routes = {'/point': handlePoint, '/bbox': handleBbox, '/region': handleRegion,
+          '/catalog': lambda store, params: store.catalog(refresh='refresh' in params),
+          '/stats': lambda store, params: store.stats()}
+
+
+def makeApp(store):
+    '''
+    Make the ASGI app of a ProductStore. The queries run in the default thread pool, so the file reads do not
+    block the event loop
+    :param store: ProductStore
+    :return: ASGI app
+    '''
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    store.close()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        params = {key: values[-1] for key, values in parse_qs(scope.get('query_string', b'').decode()).items()}
+        handler = routes.get(scope['path'].rstrip('/') or '/')
+        if scope['method'] != 'GET':
+            status, body = 405, {'error': 'only GET'}
+        elif handler is None:
+            status, body = 404, {'error': 'unknown path', 'paths': sorted(routes)}
+        else:
+            try:
+                body = await asyncio.get_running_loop().run_in_executor(None, handler, store, params)
+                status = 200
+            except KeyError as err:
+                status, body = 404, {'error': 'not found: ' + str(err)}
+            except ValueError as err:
+                status, body = 400, {'error': str(err)}
+        payload = json.dumps(body).encode()
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(payload)).encode()),
+                                (b'access-control-allow-origin', b'*')]})
+        await send({'type': 'http.response.body', 'body': payload})
+
+    return app
+
+
+## app of the products in $BPP_DATA, for an ASGI server: uvicorn queryService:app
+app = makeApp(ProductStore(os.environ.get('BPP_DATA', 'Data/DHWmax'), regions=os.environ.get('BPP_REGIONS'),
+                           cacheDir=os.environ.get('BPP_CACHE')))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='query API over the processed DHW products')
+    parser.add_argument('--root', default='Data/DHWmax', help='directory of the products, searched recursively')
+    parser.add_argument('--regions', default=None, help='shapefile of the regions of the region queries')
+    parser.add_argument('--cachedir', default=None, help='cache of the region grids')
+    parser.add_argument('--max-datasets', dest='maxDatasets', type=int, default=32, help='max open datasets')
+    parser.add_argument('--cache-mb', dest='cacheMB', type=float, default=512.0,
+                        help='max size of the decoded blocks in memory, MB')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    import uvicorn
+    store = ProductStore(args.root, maxDatasets=args.maxDatasets, maxBytes=args.cacheMB * 1e6, regions=args.regions,
+                         cacheDir=args.cachedir)
+    uvicorn.run(makeApp(store), host=args.host, port=args.port)
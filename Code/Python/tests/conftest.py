@@ -0,0 +1,5 @@
+## the tests import the tools package and the scripts from Code/Python
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
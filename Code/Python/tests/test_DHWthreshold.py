@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from tools.DHWtools import DHWthreshold
+from tools.refTools import ReferenceDOY
+
+
+def makeDHW():
+    rng = np.random.default_rng(0)
+    time = pd.date_range('2019-01-01', '2021-12-31')
+    lat = np.arange(-10.0, 10.0, 2.0)
+    lon = np.arange(140.0, 160.0, 2.0)
+    values = np.abs(np.sin(np.arange(len(time)) / 58.0))[:, None, None] * 12 * rng.uniform(0.3, 1, (1, 10, 10))
+    values[:, 0, 0] = np.nan
+    return xr.DataArray(values, dims=('time', 'lat', 'lon'), coords={'time': time, 'lat': lat, 'lon': lon})
+
+
+def makeClimatology(da):
+    ## the climatology is stored north to south, the opposite of the model grid
+    rng = np.random.default_rng(1)
+    return xr.DataArray(rng.integers(1, 366, (10, 10)).astype(float), dims=('lat', 'lon'), name='SSTmin_doy',
+                        coords={'lat': da.lat.values[::-1], 'lon': da.lon.values})
+
+
+def bruteRelativeDOY(nc, DOYref, threshold):
+    ## first day above the threshold of every cell and year, relative to the reference flipped to the model grid:
+    ## the day after the reference is day 1, rolled by the length of the year
+    ref = np.flipud(DOYref.values)
+    years = nc.time.dt.year.values
+    out = []
+    for yy in np.unique(years):
+        values = nc.values[years == yy]
+        nDays = values.shape[0]
+        DOY = np.full(values.shape[1:], np.nan)
+        for i in range(values.shape[1]):
+            for j in range(values.shape[2]):
+                above = np.nonzero(values[:, i, j] > threshold)[0]
+                if len(above):
+                    DOY[i, j] = (above[0] + 1 - ref[i, j] - 1) % nDays + 1
+        out.append(DOY)
+    return np.array(out)
+
+
+def test_relative_doy_is_rolled_and_aligned():
+    da = makeDHW()
+    ref = makeClimatology(da)
+    expected = bruteRelativeDOY(da, ref, 4)
+    assert np.nanmin(expected) >= 1 and np.nanmax(expected) <= 366
+    for DOYref in (ref, ReferenceDOY.fromData(ref)):
+        result = DHWthreshold(da.copy(), DOYref, DHWthreshold=4, relativeDOY=True)
+        np.testing.assert_array_equal(result.values, expected)
+
+
+def test_absolute_doy_ignores_reference():
+    da = makeDHW()
+    result = DHWthreshold(da.copy(), None, DHWthreshold=4, relativeDOY=False)
+    assert np.nanmin(result.values) >= 1
@@ -0,0 +1,39 @@
+from bppProcess import isUpToDate, outputsUpToDate, workerCache
+from processNC import processFile, processParams, outputPrefixes
+
+from test_packed import writeModel
+
+
+def upToDate(fileName, outDir, views):
+    return outputsUpToDate(fileName, outDir, views, 'netcdf',
+                           params=processParams((4, 8), (0.99,), False, False, views, 'netcdf'))
+
+
+def test_output_with_other_parameters_is_out_of_date(tmp_path):
+    fileName = str(tmp_path / 'ssp245_M_DHW.nc')
+    writeModel(fileName)
+    outFileName = processFile(fileName, str(tmp_path), None, verbose=False, thresholds=(4, 8), quantiles=(0.99,))
+    params = processParams((4, 8), (0.99,), False, False, ('raw',), 'netcdf')
+    assert isUpToDate(fileName, outFileName, params=params)
+    assert not isUpToDate(fileName, outFileName, params=processParams((4, 8, 12), (0.99,), False, False, ('raw',),
+                                                                      'netcdf'))
+    assert not isUpToDate(fileName, outFileName, params=processParams((4, 8), (0.99,), True, False, ('raw',),
+                                                                      'netcdf'))
+
+
+def test_every_view_output_is_checked(tmp_path):
+    ## the shifted output is missing: the file is not up to date for the raw rel shifted views
+    fileName = str(tmp_path / 'ssp245_M_DHW.nc')
+    writeModel(fileName)
+    outDir = tmp_path / 'out'
+    outDir.mkdir()
+    processFile(fileName, str(outDir), None, verbose=False, views=('raw',))
+    views = ('raw', 'rel', 'shifted')
+    assert outputPrefixes(views) == ['DHW_', 'DHW_shifted_']
+    assert not upToDate(fileName, str(outDir), views)
+    assert upToDate(fileName, str(outDir), ('raw',))
+
+
+def test_worker_cache_is_built_once(tmp_path):
+    cache = workerCache(str(tmp_path), 1.0)
+    assert workerCache(str(tmp_path), 1.0) is cache
@@ -0,0 +1,33 @@
+import os
+
+import numpy as np
+
+from tools import cacheTools
+from tools.cacheTools import ResultCache
+
+
+def diskBytes(cacheDir):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(cacheDir)
+               for name in files if name.endswith('.npy'))
+
+
+def test_get_survives_eviction_by_another_process(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path))
+    cache.put('ab01', np.arange(10.0))
+
+    def evicted(path, *args):
+        os.remove(path)
+        raise FileNotFoundError(path)
+    monkeypatch.setattr(cacheTools.os, 'utime', evicted)
+    np.testing.assert_array_equal(cache.get('ab01'), np.arange(10.0))
+    assert cache.get('ab01') is None
+
+
+def test_shared_directory_stays_bounded(tmp_path):
+    ## two workers on the same directory, each with its own index
+    entry = np.zeros(1000)
+    maxBytes = 10 * (entry.nbytes + 128)
+    caches = [ResultCache(str(tmp_path / 'cache'), maxBytes=maxBytes) for _ in range(2)]
+    for i in range(60):
+        caches[i % 2].put('%04x' % i, entry)
+    assert diskBytes(str(tmp_path / 'cache')) <= maxBytes + 2 * (entry.nbytes + 128)
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from tools.climTools import onsetYear, linearTrend, onsetEnsemble
+
+years = np.arange(2020, 2040)
+
+
+def yearlyValues(onset=2025):
+    '''
+    [year,cell] DHW_max of 3 cells: above the threshold every year from the onset, above every other year
+    (the last year below) and land
+    '''
+    values = np.full((len(years), 3), np.nan)
+    values[:, 0] = np.where(years >= onset, 10.0, 2.0) + 0.1 * (years - years[0])
+    values[:, 1] = np.where(years % 2 == 0, 10.0, 2.0)
+    return values
+
+
+def test_onset_year():
+    values = yearlyValues()
+    np.testing.assert_array_equal(onsetYear(values, years, threshold=8), [2025, np.nan, np.nan])
+    ## one year above in every 2 years: the intermittent cell has its onset from the first year
+    np.testing.assert_array_equal(onsetYear(values, years, threshold=8, nYears=1, window=2), [2024, 2020, np.nan])
+    np.testing.assert_array_equal(onsetYear(values, years, threshold=8, nYears=2, window=2), [2025, np.nan, np.nan])
+
+
+def test_onset_year_needs_nyears_in_window():
+    with pytest.raises(ValueError):
+        onsetYear(yearlyValues(), years, nYears=3, window=2)
+
+
+def test_linear_trend():
+    values = yearlyValues()
+    trend = linearTrend(values, years)
+    np.testing.assert_allclose(trend[:2], [np.polyfit(years, values[:, j], 1)[0] for j in range(2)])
+    assert np.isnan(trend[2])
+
+
+def test_onset_ensemble():
+    dataArrays = [xr.DataArray(yearlyValues(onset).reshape(len(years), 1, 3), name='DHW_max', dims=('time', 'lat', 'lon'),
+                               coords={'time': years, 'lat': [0.0], 'lon': [0.0, 1.0, 2.0]}, attrs={'units': 'degC week'})
+                  for onset in [2025, 2030]]
+    ds = onsetEnsemble(dataArrays, threshold=8, models=['A', 'B'])
+
+    np.testing.assert_array_equal(ds.onset.values[:, 0, :2], [[2025, np.nan], [2030, np.nan]])
+    assert np.isnan(ds.onset.values[:, 0, 2]).all()
+    assert ds.onset_median.values[0, 0] == 2027.5
+    assert ds.onset_min.values[0, 0] == 2025 and ds.onset_max.values[0, 0] == 2030
+    np.testing.assert_array_equal(ds.onset_fraction.values[0], [1.0, 0.0, np.nan])
+    expected = np.mean([np.polyfit(years, da.values[:, 0, 0], 1)[0] for da in dataArrays])
+    np.testing.assert_allclose(ds.trend_mean.values[0, 0], expected, rtol=1e-5)
+    assert np.isnan(ds.trend_mean.values[0, 2])
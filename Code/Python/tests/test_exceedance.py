@@ -0,0 +1,46 @@
+from importlib.util import find_spec
+
+import numpy as np
+import pytest
+
+from tools.DHWtools import exceedanceEvents
+
+
+def bruteForceEvents(values, thresholds):
+    nTime, nCells = values.shape
+    events = {name: np.zeros((len(thresholds), nCells), dtype='int32') for name in ['first', 'last', 'nDays', 'longestRun']}
+    for k, threshold in enumerate(thresholds):
+        for j in range(nCells):
+            days = [i + 1 for i in range(nTime) if values[i, j] > threshold]
+            run = longest = 0
+            for i in range(nTime):
+                run = run + 1 if values[i, j] > threshold else 0
+                longest = max(longest, run)
+            if days:
+                events['first'][k, j], events['last'][k, j] = days[0], days[-1]
+            events['nDays'][k, j] = len(days)
+            events['longestRun'][k, j] = longest
+    return events
+
+
+def eventValues():
+    rng = np.random.default_rng(1)
+    values = rng.uniform(0, 12, size=(365, 6)).astype('float32')
+    ## a land cell, a cell never above the thresholds and a cell with NaN days inside a run
+    values[:, 0] = np.nan
+    values[:, 1] = 1.0
+    values[100:110, 2] = 10.0
+    values[105, 2] = np.nan
+    return values
+
+
+@pytest.mark.parametrize('useNumba', [False, pytest.param(True, marks=pytest.mark.skipif(
+    find_spec('numba') is None, reason='requires numba'))])
+def test_exceedance_events(useNumba):
+    values = eventValues()
+    thresholds = [4, 8]
+    events = exceedanceEvents(values, thresholds, useNumba=useNumba)
+    expected = bruteForceEvents(values, thresholds)
+    for name in expected:
+        np.testing.assert_array_equal(events[name], expected[name], err_msg=name)
+    assert (events['nDays'][:, :2] == 0).all() and (events['first'][:, :2] == 0).all()
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from processNC import processFile
+
+
+def writeModel(fileName):
+    rng = np.random.default_rng(0)
+    time = pd.date_range('2019-01-01', '2020-12-31')
+    lat = np.arange(-10.0, 10.0, 2.0)
+    lon = np.arange(140.0, 160.0, 2.0)
+    values = np.abs(np.sin(np.arange(len(time)) / 58.0))[:, None, None] * 12 * rng.uniform(0.3, 1, (1, 10, 10))
+    values[:, :3, :3] = np.nan
+    xr.Dataset({'DHW': (('time', 'lat', 'lon'), values)},
+               coords={'time': time, 'lat': lat, 'lon': lon}).to_netcdf(fileName)
+
+
+def test_packed_output_opens_as_numbers(tmp_path):
+    ## the packed int16 day counts must not be decoded as timedelta by a default open
+    fileName = str(tmp_path / 'ssp245_M_DHW.nc')
+    writeModel(fileName)
+    (tmp_path / 'packed').mkdir()
+    (tmp_path / 'plain').mkdir()
+    packedName = processFile(fileName, str(tmp_path / 'packed'), None, verbose=False, packed=True, events=True)
+    plainName = processFile(fileName, str(tmp_path / 'plain'), None, verbose=False, events=True)
+    with xr.open_dataset(packedName) as packed, xr.open_dataset(plainName) as plain:
+        for name in ['nDays_DHW4', 'nDays_DHW8', 'maxRun_DHW4', 'DoY_DHW4']:
+            assert packed[name].dtype.kind == 'f', name
+            assert np.isnan(packed[name].values[:, :3, :3]).all(), name
+            np.testing.assert_array_equal(packed[name].values, plain[name].values)
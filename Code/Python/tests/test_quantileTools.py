@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from tools.quantileTools import partitionQuantiles, HistogramQuantiles
+
+quantiles = [0.1, 0.5, 0.9, 0.99]
+
+
+def dailyValues(nTime=365, nCells=50, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.gamma(2.0, 3.0, size=(nTime, nCells)).clip(0, 39.9)
+
+
+def test_partition_quantiles_match_numpy():
+    values = dailyValues()
+    expected = np.quantile(values, quantiles, axis=0)
+    np.testing.assert_allclose(partitionQuantiles(values, quantiles), expected, rtol=1e-12, atol=0)
+    ## in place on a copy, the result is the same
+    np.testing.assert_allclose(partitionQuantiles(values.copy(), quantiles, overwrite=True), expected, rtol=1e-12,
+                               atol=0)
+
+
+def test_histogram_quantiles_within_one_bin():
+    values = dailyValues()
+    values[:, 0] = np.nan
+    ## two years added by two workers and merged
+    first, second = HistogramQuantiles(values.shape[1]), HistogramQuantiles(values.shape[1])
+    first.update(values[:200])
+    second.update(values[200:])
+    first.merge(second)
+
+    out = first.quantiles(quantiles)
+    assert np.isnan(out[:, 0]).all()
+    expected = np.quantile(values[:, 1:], quantiles, axis=0, method='inverted_cdf')
+    assert np.abs(out[:, 1:] - expected).max() <= first.binWidth
+
+
+def test_histogram_merge_needs_the_same_bins():
+    with pytest.raises(ValueError):
+        HistogramQuantiles(10).merge(HistogramQuantiles(10, binWidth=0.2))
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from tools.regridTools import Regridder, conservativeWeights
+
+srcLat = np.arange(-89.5, 90.0, 1.0)
+srcLon = np.arange(0.5, 360.0, 1.0)
+dstLat = np.arange(-89.0, 90.0, 2.0)
+dstLon = np.arange(1.0, 360.0, 2.0)
+
+
+def cosLatMean(values, lat):
+    weights = np.broadcast_to(np.cos(np.deg2rad(lat))[:, None], values.shape)
+    return np.nansum(values * weights) / np.sum(weights[~np.isnan(values)])
+
+
+@pytest.mark.parametrize('method', ['conservative', 'bilinear'])
+def test_constant_field_stays_constant(method):
+    values = np.full((3, len(srcLat), len(srcLon)), 28.5)
+    ## land cells are left out, not averaged as zeros
+    values[:, 80:100, 100:140] = np.nan
+    out = Regridder(srcLat, srcLon, dstLat, dstLon, method=method)(xr.DataArray(values, dims=('time', 'lat', 'lon'),
+                                                                                coords={'lat': srcLat, 'lon': srcLon}))
+    assert out.shape == (3, len(dstLat), len(dstLon))
+    ## only the target cells inside the land are NaN
+    land = np.isnan(out.values)
+    assert land.any() and land[:, 41:49, 51:69].all()
+    np.testing.assert_allclose(out.values[~land], 28.5, rtol=1e-12)
+
+
+def test_conservative_weights_cover_the_target():
+    weights = conservativeWeights(srcLat, srcLon, dstLat, dstLon)
+    np.testing.assert_allclose(np.asarray(weights.sum(axis=1)).ravel(), 1.0, rtol=1e-12)
+
+
+def test_conservative_mean_is_conserved():
+    rng = np.random.default_rng(0)
+    values = 25.0 + 5.0 * np.cos(np.deg2rad(srcLat))[:, None] + rng.normal(0.0, 1.0, (len(srcLat), len(srcLon)))
+    out = Regridder(srcLat, srcLon, dstLat, dstLon).regridValues(values)
+    np.testing.assert_allclose(cosLatMean(out, dstLat), cosLatMean(values, srcLat), rtol=1e-4)
@@ -1,136 +1,182 @@
 ## Functions to extract DHWmax and associated variables from a yearly DHW[time,lat,lon] data array
+## the metrics run on the compressed [time,cell] array of the ocean cells of a GridMask
 #
 
+from importlib.util import find_spec
+
 import xarray as xr
 import numpy as np
 
-def getDHWmax(da):
+from .yearTools import applyByYear, yearBounds, readYears
+from .maskTools import GridMask, CellMask
+from .quantileTools import partitionQuantiles
+from .profTools import stage, profiled
+
+
+def gridMask(da, mask=None):
+    '''
+    Get the mask of the grid of a data array, without touching the data
+    data already compressed to the valid cells [time,cell] get a CellMask and the results stay on the cells
+    :param da: data array [time,lat,lon] or [time,cell]
+    :param mask: GridMask already built for the grid, returned as is
+    :return: GridMask or CellMask
+    '''
+    if da.dims[-1] == 'cell':
+        return mask if isinstance(mask, CellMask) else CellMask.fromData(da)
+    if mask is None:
+        return GridMask.fromData(da)
+    if not mask.matches(da):
+        raise ValueError('data array is not on the grid of the mask')
+    return mask
+
+
+def relativeDOY(doy, ref, yearLength):
+    '''
+    Make a DOY relative to a reference DOY: the day after the reference is day 1 and the reference is the last day.
+    The days are rolled by the length of the year, so leap years go up to 366
+    :param doy: DOY, numpy array. NaN stays NaN
+    :param ref: reference DOY, numpy array
+    :param yearLength: number of days in the year
+    :return: relative DOY, from 1 to yearLength
+    '''
+    return (doy - ref - 1) % yearLength + 1
+
+
+def referenceCells(ref, da, mask):
+    '''
+    Get the reference DOY of the cells of a mask
+    :param ref: DOY data array [lat,lon], or ReferenceDOY aligned and compressed once per grid
+    :param da: data array of the grid
+    :param mask: GridMask or CellMask of da
+    :return: numpy array [cell]
+    '''
+    if hasattr(ref, 'cells'):
+        return ref.cells(da, mask)
+    return mask.compress(np.asarray(ref))
+
+
+@profiled()
+def getDHWmax(da, mask=None):
     '''
     Get the max DHW of the year
     :param da: one-year data array of DHW daily values [time,lat,lon]
+    :param mask: GridMask of the grid. Built from da if None
     :return: data array DHWmax[lat.lon] as integer with a scale factor = 0.1
     '''
-    dhwMax = da.max(dim='time')
-    dhwMax = dhwMax.rename("DHW_max")
-    dhwMax.attrs = {'long name': 'Maximum DHW',
-                     'units': 'degree Celsius - week'}
-
+    mask = gridMask(da, mask)
+    dhwMax = mask.toDataArray(np.fmax.reduce(mask.compress(da), axis=0), name="DHW_max",
+                              attrs={'long name': 'Maximum DHW',
+                                     'units': 'degree Celsius - week'})
     return dhwMax
 
-def getDHWmin(da):
+@profiled()
+def getDHWmin(da, mask=None):
     '''
     Get the min DHW of the year
     :param da: one-year data array of DHW daily values [time,lat,lon]
+    :param mask: GridMask of the grid. Built from da if None
     :return: data array DHWmax[lat.lon] as integer with a scale factor = 0.1
     '''
-    dhwMax = da.min(dim='time')
-    dhwMax = dhwMax.rename("DHW_min")
-    dhwMax.attrs = {'long name': 'Minimum DHW',
-                     'units': 'degree Celsius - week'}
+    mask = gridMask(da, mask)
+    dhwMax = mask.toDataArray(np.fmin.reduce(mask.compress(da), axis=0), name="DHW_min",
+                              attrs={'long name': 'Minimum DHW',
+                                     'units': 'degree Celsius - week'})
     return dhwMax
 
 
-def getDHWp99(da, q=0.99):
+@profiled()
+def getDHWp99(da, q=0.99, mask=None):
     '''
     Get the 99th quantile DHW of the year
     :param da: one-year data array of DHW daily values [time,lat,lon]
-    :param q: quantile requested
-    :return: data array DHWmax[lat.lon] as integer with a scale factor = 0.1
+    :param q: quantile requested, or list of quantiles
+    :param mask: GridMask of the grid. Built from da if None
+    :return: data array DHWmax[lat.lon] as integer with a scale factor = 0.1. Dataset of DHW_qXX for a list
     '''
-    ## create land mask
-    mask = da[1, :, :].values
-    mask[~np.isnan(mask)] = 1
-    da = da.fillna(0.0)
-
-    daQ = da.quantile(q, dim='time') * mask
-    daQ = daQ.rename('DHW_q' + str(q).split(".")[1])
-    daQ = daQ.drop_vars('quantile')
-    daQ.attrs = {'long name': 'DHW quantile ' + str(q),
-                 'units': 'degree Celsius - week'}
-    return daQ
-
-
-def getYdayDHWmax(da):
+    mask = gridMask(da, mask)
+    values = np.nan_to_num(mask.compress(da), nan=0.0)
+    quantiles = np.atleast_1d(q)
+
+    ## all the quantiles from one selection of the filled copy
+    valuesQ = partitionQuantiles(values, quantiles, overwrite=True)
+    daQ = [mask.toDataArray(values, name='DHW_q' + str(qq).split(".")[1],
+                            attrs={'long name': 'DHW quantile ' + str(qq),
+                                   'units': 'degree Celsius - week'})
+           for qq, values in zip(quantiles, valuesQ)]
+    if np.ndim(q) == 0:
+        return daQ[0]
+    return xr.merge(daQ)
+
+
+@profiled()
+def getYdayDHWmax(da, mask=None):
     '''
     Get the first day when the max DHW is reached in a year
     :param da: one-year data array of DHW daily values [time,lat,lon]
+    :param mask: GridMask of the grid. Built from da if None
     :return: data array DHWmax[lat.lon] as integer with a scale factor = 0.1
     '''
-
-    ## create land mask
-    mask = da[1, :, :].values
-    mask[~np.isnan(mask)] = 1
+    mask = gridMask(da, mask)
 
     ## get max value
-    da = da.fillna(0.0)
-    DHWmax = da.argmax(dim="time").astype("int") * mask
-    DHWmax.attrs = {'long name': 'maximum DHW value in a year',
-                   'units': 'degree Celsius - week',
-                  'scale factor': 0.1}
-    DHWmax = DHWmax.rename('DHWmax')
-
+    values = np.nan_to_num(mask.compress(da), nan=0.0)
+    DHWmax = mask.toDataArray(values.argmax(axis=0), name='DHWmax',
+                              attrs={'long name': 'maximum DHW value in a year',
+                                     'units': 'degree Celsius - week',
+                                     'scale factor': 0.1})
     return DHWmax
 
 
-def getYdayDHWmax_rel(da, ref):
+@profiled()
+def getYdayDHWmax_rel(da, ref, mask=None):
     '''
     Get the first day when the max DHW is reached in a year
     and make it relative to a reference, usually the coldest climatological DOY
-    :param ref: DOY data array to reference the start of the year
+    :param ref: DOY data array [lat,lon] or ReferenceDOY to reference the start of the year
     :param da: one-year data array of DHW daily values [time,lat,lon]
+    :param mask: GridMask of the grid. Built from da if None
     :return: data array DHWmax[lat.lon] as integer with a scale factor = 0.1
     '''
-    ## mask zero DHWvalues
-    da = da.where(da>0, np.nan, drop=False)
+    mask = gridMask(da, mask)
 
-    ## create land mask
-    mask = da[1, :, :].values
-    mask[~np.isnan(mask)] = 1
-
-    ## get max value
-    da = da.fillna(0.0)
-    DHWmax = da.argmax(dim="time").astype("int") * mask
+    ## get max value, zero DHW values masked
+    values = mask.compress(da)
+    values = np.where(values > 0, values, 0.0)
+    DHWmax = values.argmax(axis=0)
 
     ## make it relative
-    DHWmax = DHWmax - ref.values
-    DHWmax = DHWmax.where(DHWmax>0, DHWmax + 365, drop=False)
-    DHWmax.attrs = {'long name': 'day of maximum DHW value in a year, relative to climatology',
-                   'units': 'days'}
-    DHWmax = DHWmax.rename('DOYmax')
-
+    DHWmax = relativeDOY(DHWmax, referenceCells(ref, da, mask), values.shape[0])
+    DHWmax = mask.toDataArray(DHWmax, name='DOYmax',
+                              attrs={'long name': 'day of maximum DHW value in a year, relative to climatology',
+                                     'units': 'day of the year'})
     return DHWmax
 
 def landMask(da):
     '''
     Cretate a land mask
     :param da: data array
-    :return: numpy array: mask 0 land, 1 value
+    :return: numpy array: mask NaN land, 1 value
     '''
-    ## create land mask
-    mask = da[1, :, :].values
-    mask[~np.isnan(mask)] = 1
-    return mask
+    ## create land mask, without touching the data
+    return np.where(GridMask.fromData(da).mask, 1.0, np.nan)
 
 
-def getYdayDHWmin(da):
+@profiled()
+def getYdayDHWmin(da, mask=None):
     '''
     Get the first day when the min DHW is reached in a year
     :param da: one-year data array of DHW daily values [time,lat,lon]
+    :param mask: GridMask of the grid. Built from da if None
     :return: data array DHWmax[lat.lon] as integer with a scale factor = 0.1
     '''
-
-    ## create land mask
-    mask = da[1, :, :].values
-    mask[~np.isnan(mask)] = 1
-
-    ## get max value
-    da = da.fillna(0.0)
-    DHWmax = da.argmin(dim="time").astype("int") * mask
-    DHWmax.attrs = {'long name': 'maximum DHW value in a year',
-                   'units': 'degree Celsius - week',
-                  'scale factor': 0.1}
-    DHWmax = DHWmax.rename('DHWmax')
-
+    mask = gridMask(da, mask)
+
+    ## get min value
+    values = np.nan_to_num(mask.compress(da), nan=0.0)
+    DHWmax = mask.toDataArray(values.argmin(axis=0), name='DHWmax',
+                              attrs={'long name': 'maximum DHW value in a year',
+                                     'units': 'degree Celsius - week',
+                                     'scale factor': 0.1})
     return DHWmax
 
 
@@ -143,125 +189,437 @@ def getTdayDHWp99(da):
     '''
     return
 
-def getDOY(da, threshold):
+
+## numba kernel of exceedanceEvents, compiled on first use
+numbaKernels = {}
+
+
+def numbaEventsKernel():
+    '''
+    Compile the numba kernel of exceedanceEvents: one pass over the days of every cell, all the thresholds at once
+    requires numba
+    :return: compiled function
+    '''
+    if 'events' not in numbaKernels:
+        import numba
+
+        @numba.njit(parallel=True)
+        def events(cellValues, thresholds, first, last, nDays, longestRun):
+            nCells, nTime = cellValues.shape
+            for j in numba.prange(nCells):
+                for k in range(len(thresholds)):
+                    run = 0
+                    for i in range(nTime):
+                        if cellValues[j, i] > thresholds[k]:
+                            if nDays[k, j] == 0:
+                                first[k, j] = i + 1
+                            last[k, j] = i + 1
+                            nDays[k, j] += 1
+                            run += 1
+                            if run > longestRun[k, j]:
+                                longestRun[k, j] = run
+                        else:
+                            run = 0
+
+        numbaKernels['events'] = events
+    return numbaKernels['events']
+
+
+@profiled('exceedance')
+def exceedanceEvents(values, thresholds, useNumba=None):
+    '''
+    Detect the days above every list of thresholds in one call over a year of the compressed array:
+    first and last day above, number of days above and length of the longest run of consecutive days above
+    :param values: numpy array of daily values [time,cell]. NaN is never above
+    :param thresholds: list of thresholds. Exclusive
+    :param useNumba: use the numba kernel. If None, only if numba is installed
+    :return: dictionary of int arrays [threshold,cell]: first, last (DOY starting at 1, 0 if never above),
+             nDays and longestRun
+    '''
+    thresholds = np.asarray(thresholds, dtype=values.dtype if values.dtype.kind == 'f' else 'float64')
+    if useNumba is None:
+        useNumba = find_spec('numba') is not None
+    nTime, nCells = values.shape
+    shape = (len(thresholds), nCells)
+
+    events = {name: np.zeros(shape, dtype='int32') for name in ['first', 'last', 'nDays', 'longestRun']}
+    if useNumba:
+        ## the days of every cell contiguous, as in the cell stores
+        numbaEventsKernel()(np.ascontiguousarray(values.T), thresholds, events['first'], events['last'], events['nDays'],
+                            events['longestRun'])
+        return events
+
+    ## one pass over the days, vectorized over the thresholds and the cells
+    values = np.ascontiguousarray(values)
+    run = np.zeros(shape, dtype='int32')
+    thresholds = thresholds[:, None]
+    for i in range(nTime):
+        above = values[i] > thresholds
+        events['nDays'] += above
+        np.copyto(events['first'], i + 1, where=above & (events['first'] == 0))
+        np.copyto(events['last'], i + 1, where=above)
+        ## length of the current run of days above
+        run += 1
+        run *= above
+        np.maximum(events['longestRun'], run, out=events['longestRun'])
+    return events
+
+
+@profiled()
+def getDOY(da, threshold, mask=None):
     '''
     get the first day of the year when the variable surpass the threshold value
     takes care of the all-NAN slices error by masking
     :param threshold: threshold value
     :param da: data array
+    :param mask: GridMask of the grid. Built from da if None
     :return: data array with the DOY
     '''
-    mask = landMask(da)
-    daThreshold = da.where(da > threshold, np.nan, drop=False).squeeze()
-    ## Create mask for values below threshold
-    da_min = daThreshold.min(dim='time')
-    maskMin = da_min.values
-    maskMin[~np.isnan(maskMin)] = 1
-    ## get the first doy
-    daThreshold = daThreshold.fillna(9999)
-    daDOY = daThreshold.argmin(dim='time').astype('int') + 1
-    ## apply maskMin
-    daDOY = daDOY * (maskMin) * mask
-    daDOY.attrs = {'long name': 'absolute first day of the year when DHW reaches ' +
-                                str(threshold)}
-    daDOY = daDOY.rename('DoY_DHW' + str(threshold))
-
+    mask = gridMask(da, mask)
+    first = exceedanceEvents(mask.compress(da), [threshold])['first'][0]
+    daDOY = mask.toDataArray(np.where(first > 0, first, np.nan), name='DoY_DHW' + str(threshold),
+                             attrs={'long name': 'absolute first day of the year when DHW reaches ' +
+                                                 str(threshold)})
     return daDOY
 
-def getDOYrel(da, threshold, ref, q=None):
+@profiled()
+def getDOYrel(da, threshold, ref, q=None, mask=None):
     '''
     get the first day of the year when the variable surpass the threshold value
     relative to a climatological reference
     takes care of the all-NAN slices error by masking
-    :param ref: climatological start of the year day
+    :param ref: climatological start of the year day, data array [lat,lon] or ReferenceDOY
     :param threshold: threshold value
     :param da: data array
+    :param mask: GridMask of the grid. Built from da if None
     :return: data array with the DOY
     '''
-
-    mask = landMask(da)
+    mask = gridMask(da, mask)
+    values = mask.compress(da)
     if q!=None:
-        da = da.where(da <= da.quantile(q), np.nan, drop=False)
-
-    daThreshold = da.where(da > threshold, np.nan, drop=False)
+        values = np.where(values <= np.nanquantile(values, q), values, np.nan)
 
-    ## Create mask for values below threshold
-    da_min = daThreshold.min(dim='time')
-    maskMin = da_min.values
-    maskMin[~np.isnan(maskMin)] = 1
     ## get the first doy
-    daThreshold = daThreshold.fillna(9999)
-    daDOY = daThreshold.argmin(dim='time').astype('int') + 1
+    first = exceedanceEvents(values, [threshold])['first'][0]
+    daDOY = np.where(first > 0, first, np.nan)
 
     ## make it relative
-    daDOY = daDOY - ref.values
-    daDOY = daDOY.where(daDOY > 0, daDOY + 365, drop=False)
-
-    ## apply maskMin
-    daDOY = daDOY * maskMin * mask
-    daDOY.attrs = {'long name': 'relative first day of the year when DHW reaches ' +
-                                str(threshold)}
-    daDOY = daDOY.rename('DoYrel_DHW' + str(threshold))
+    daDOY = relativeDOY(daDOY, referenceCells(ref, da, mask), values.shape[0])
 
+    daDOY = mask.toDataArray(daDOY, name='DoYrel_DHW' + str(threshold),
+                             attrs={'long name': 'relative first day of the year when DHW reaches ' +
+                                                 str(threshold)})
     return daDOY
 
 
 
 
-def getNDays(da, threshold):
+@profiled()
+def getNDays(da, threshold, mask=None):
     '''
     get the number of days above DHW threshold
     :param da: data array of daily DHW[time,lat,lon)
     :param threshold: threshold value to count the n days above. Exclusive
+    :param mask: GridMask of the grid. Built from da if None
     :return: dataarray with the number of days above threshold [lat,lon]
     '''
+    mask = gridMask(da, mask)
+    nDays = mask.toDataArray((mask.compress(da) > threshold).sum(axis=0), name='nDaysAbove_DHW' + str(threshold),
+                             attrs={'long name': 'number of days above DHW ' +
+                                                 str(threshold)})
+    return nDays
 
-    ## create land mask
-    mask = da[1, :, :].values
-    mask[~np.isnan(mask)] = 1
 
-    nDays = da.where(da > threshold, np.nan, drop=False).count(dim='time')
-    nDays = nDays.astype(int) * mask
+## missing value of the int16 DOY and number of days of compute_yearly_stats in packed mode
+packedFillValue = -1
+
+
+def thresholdName(threshold):
+    '''
+    Format a DHW threshold for variable names and attributes: 4.0 -> '4', 4.5 -> '4.5'
+    :param threshold: threshold value
+    :return: string
+    '''
+    return '%g' % threshold
+
+
+def quantileName(q):
+    '''
+    Format a quantile for variable names: 0.99 -> 'q99'
+    :param q: quantile
+    :return: string
+    '''
+    return 'q' + str(q).split(".")[1]
 
-    nDays.attrs = {'long name': 'number of days above DHW ' +
-                                str(threshold)}
-    nDays = nDays.rename('nDaysAbove_DHW' + str(threshold))
-    return nDays
+
+def yearlyStatsAttrs(name):
+    '''
+    Get the attributes of a variable produced by compute_yearly_stats
+    :param name: variable name, e.g. DHW_max, DHW_q99, DoY_DHW4, DoYrel_DHW8, nDays_DHW4, DoYlast_DHW4, maxRun_DHW8
+    :return: dictionary of attributes
+    '''
+    if name == 'DHW_max':
+        return {'long_name': 'Maximum yearly value of Degree Heating Week',
+                'units': 'degrees celsius-week'}
+    if name.startswith('DHW_q'):
+        return {'long_name': name[5:] + 'th quantile of the Degree Heating Week',
+                'units': 'degrees celsius-week'}
+    threshold = name.split('_DHW')[1]
+    if name.startswith('DoYrel_'):
+        return {'long_name': 'first day of the year when DHW exceeds ' + threshold +
+                             ' degree-weeks, relative to the climatological coldest DOY',
+                'units': 'day of the year',
+                'comment': 'considering the coldest climatological DoY as the first day of the year'}
+    if name.startswith('DoY_'):
+        return {'long_name': 'first day of the year when DHW exceeds ' + threshold + ' degree-weeks',
+                'units': 'day of the year',
+                'comment': 'considering January 1st the first day of the year'}
+    if name.startswith('nDays_'):
+        return {'long_name': 'number of days above ' + threshold + ' degrees-week',
+                'units': '1'}
+    if name.startswith('DoYlast_'):
+        return {'long_name': 'last day of the year when DHW exceeds ' + threshold + ' degree-weeks',
+                'units': 'day of the year',
+                'comment': 'considering January 1st the first day of the year'}
+    if name.startswith('maxRun_'):
+        return {'long_name': 'longest run of consecutive days above ' + threshold + ' degrees-week',
+                'units': '1'}
+    return {}
+
+
+@profiled()
+def compute_yearly_stats(da, thresholds=(4, 8), quantiles=(0.99,), ref=None, packed=False, mask=None,
+                         events=False):
+    '''
+    Get all the yearly DHW statistics in a single pass over the year of data:
+    max, quantiles, first day above each threshold (absolute and relative) and number of days above each threshold.
+    Works on the compressed [time,cell] values of the ocean cells, so the DHW cube is not copied once per metric
+    :param da: one-year data array of DHW daily values [time,lat,lon]
+    :param thresholds: DHW thresholds for the DOY and the number of days. Exclusive
+    :param quantiles: quantiles requested
+    :param ref: DOY data array [lat,lon] or ReferenceDOY to reference the start of the year.
+                No relative DOY if None
+    :param packed: compute in float32 and return the DOY and the number of days as int16 with
+                   packedFillValue for land and never reached, instead of float with NaN
+    :param mask: GridMask of the grid. Built from da if None
+    :param events: also get the last day above each threshold and the longest run of consecutive days above
+    :return: dataset with DHW_max, DHW_qXX, DoY_DHWX, DoYrel_DHWX and nDays_DHWX [lat,lon],
+             and DoYlast_DHWX and maxRun_DHWX with events
+    '''
+    mask = gridMask(da, mask)
+    with stage('read+compress'):
+        values = mask.compress(da)
+        if packed and values.dtype != np.float32:
+            values = values.astype('float32')
+
+    ## the land cells are not in the compressed array. Only the cells of a reef mask can be NaN on day 2
+    ocean = ~np.isnan(values[1])
+    if ref is not None:
+        ref = referenceCells(ref, da, mask)
+
+    def masked(x, valid):
+        with stage('mask'):
+            if packed:
+                return np.where(valid, x, packedFillValue).astype('int16')
+            return np.where(valid, x, np.nan)
+
+    stats = {}
+    with stage('max'):
+        stats['DHW_max'] = np.fmax.reduce(values, axis=0)
+
+    if len(quantiles) > 0:
+        ## one filled copy, partitioned in place for all the quantiles
+        with stage('quantile'):
+            valuesQ = np.nan_to_num(values, nan=0.0)
+            daQ = partitionQuantiles(valuesQ, quantiles, overwrite=True)
+            del valuesQ
+            for i, q in enumerate(quantiles):
+                stats['DHW_' + quantileName(q)] = np.where(ocean, daQ[i], np.nan).astype(values.dtype if packed
+                                                                                         else None)
+
+    ## first and last day above, days above and longest run of all the thresholds
+    detected = exceedanceEvents(values, thresholds) if len(thresholds) > 0 else None
+    for k, threshold in enumerate(thresholds):
+        nDays = detected['nDays'][k]
+        reached = ocean & (nDays > 0)
+        ## first day above threshold, missing if never reached
+        daDOY = detected['first'][k]
+        name = thresholdName(threshold)
+        stats['DoY_DHW' + name] = masked(daDOY, reached)
+        if ref is not None:
+            ## make it relative
+            daDOYrel = relativeDOY(daDOY, ref, values.shape[0])
+            stats['DoYrel_DHW' + name] = masked(daDOYrel, reached & ~np.isnan(ref))
+        stats['nDays_DHW' + name] = masked(nDays, ocean)
+        if events:
+            stats['DoYlast_DHW' + name] = masked(detected['last'][k], reached)
+            stats['maxRun_DHW' + name] = masked(detected['longestRun'][k], ocean)
+
+    ## same variable order as the processNC output
+    order = ['DHW_max', 'DHW_q', 'DoY_', 'DoYrel_', 'nDays_', 'DoYlast_', 'maxRun_']
+    names = sorted(stats, key=lambda name: [name.startswith(prefix) for prefix in order].index(True))
+    with stage('expand'):
+        ds = xr.Dataset({name: mask.toDataArray(stats[name], attrs=yearlyStatsAttrs(name),
+                                                fill=packedFillValue if stats[name].dtype.kind == 'i' else np.nan)
+                         for name in names})
+    return ds
+
+
+## views of the yearly statistics computed by compute_view_stats
+viewNames = ('raw', 'rel', 'shifted')
+
+
+def rolledCells(ref):
+    '''
+    Group the cells by reference DOY, so their time axis is rolled by slices of cells instead of one index per day
+    :param ref: reference DOY of the cells [cell], NaN for the cells without reference
+    :return: list of (reference DOY, cell index)
+    '''
+    cells = np.nonzero(~np.isnan(ref))[0]
+    cells = cells[np.argsort(ref[cells], kind='stable')]
+    refs, start = np.unique(ref[cells], return_index=True)
+    stop = np.append(start[1:], len(cells))
+    return [(int(r), cells[i0:i1]) for r, i0, i1 in zip(refs, start, stop)]
+
+
+def shiftedYear(previous, current, groups):
+    '''
+    Roll the days of every cell to its shifted year: from the day after its reference DOY in one year
+    to its reference DOY in the next year
+    :param previous: values of the first year [time,cell]
+    :param current: values of the next year [time,cell]
+    :param groups: cells by reference DOY, see rolledCells
+    :return: numpy array [time,cell] as long as the first year. NaN for the cells without reference
+    '''
+    yearLength = previous.shape[0]
+    out = np.full(previous.shape, np.nan, dtype=previous.dtype)
+    for ref, cells in groups:
+        ref = min(ref, yearLength)
+        nDays = min(ref, current.shape[0])
+        out[:yearLength - ref, cells] = previous[ref:, cells]
+        out[yearLength - ref:yearLength - ref + nDays, cells] = current[:nDays, cells]
+    return out
+
+
+@profiled()
+def compute_view_stats(da, views=('raw', 'rel'), thresholds=(4, 8), quantiles=(0.99,), ref=None, packed=False,
+                       mask=None, events=False, verbose=False, prefetch=2):
+    '''
+    Get the yearly DHW statistics of several views of a daily series in a single read of every year:
+    raw: statistics of the calendar year, as compute_yearly_stats,
+    rel: first day above each threshold relative to the reference DOY (DoYrel_DHWX),
+    shifted: statistics of the shifted year of every cell, from the day after its reference DOY to its reference DOY
+    of the next year, labelled by the year it starts in. The last year has no shifted year.
+    Every year is read and compressed once and shared by the views, the raw and rel views come from the same pass
+    :param da: data array of daily values [time,lat,lon] or [time,cell]
+    :param views: list of views, in viewNames
+    :param thresholds: DHW thresholds for the DOY and the number of days. Exclusive
+    :param quantiles: quantiles requested
+    :param ref: DOY data array [lat,lon] or ReferenceDOY. Required by the rel and shifted views
+    :param packed: float32 and int16 results, see compute_yearly_stats
+    :param mask: GridMask of the grid. Built from da if None
+    :param events: also the last day above each threshold and the longest run above, see compute_yearly_stats
+    :param verbose: print the year being processed
+    :param prefetch: number of years read and compressed ahead on a background thread, into reused buffers,
+                     while the statistics of the year are computed (see yearTools.readYears). Read in turn if 0
+    :return: dictionary view: dataset [time,lat,lon], time coordinate = year
+    '''
+    unknown = [view for view in views if view not in viewNames]
+    if unknown:
+        raise ValueError('unknown views ' + ', '.join(unknown))
+    if ref is None and ('rel' in views or 'shifted' in views):
+        raise ValueError('the rel and shifted views need a reference DOY')
+    mask = gridMask(da, mask)
+    cellMask = CellMask(mask.nCells)
+    refCells = None if ref is None else referenceCells(ref, da, mask).astype('float64')
+    groups = rolledCells(refCells) if 'shifted' in views else None
+    years, bounds = yearBounds(da)
+
+    out = {view: {} for view in views}
+    templates = {}
+
+    def collect(view, i, nYears, ds):
+        for name, var in ds.data_vars.items():
+            if (view == 'raw' and name.startswith('DoYrel_')) or (view == 'rel' and not name.startswith('DoYrel_')):
+                continue
+            var = mask.toDataArray(var.values, attrs=var.attrs, fill=packedFillValue if var.dtype.kind == 'i'
+                                   else np.nan)
+            if name not in out[view]:
+                out[view][name] = np.empty((nYears,) + var.shape, dtype=var.dtype)
+                templates[view, name] = var
+            out[view][name][i] = var.values
+
+    ## one read of every year, shared by all the views. The shifted view keeps the previous year
+    yearCells = iter(readYears(da, bounds, depth=prefetch, transform=mask.compress,
+                               keep=1 if 'shifted' in views else 0))
+    previous = None
+    for i, yy in enumerate(years):
+        if verbose:
+            print(yy)
+        ## time waiting for the reader when prefetching
+        with stage('read+compress'):
+            values = next(yearCells)
+        cells = xr.DataArray(values, dims=('time', 'cell'))
+        if 'raw' in views or 'rel' in views:
+            ds = compute_yearly_stats(cells, thresholds=thresholds, quantiles=quantiles,
+                                      ref=refCells if 'rel' in views else None, packed=packed, mask=cellMask,
+                                      events=events)
+            for view in ('raw', 'rel'):
+                if view in views:
+                    collect(view, i, len(years), ds)
+        if 'shifted' in views and previous is not None:
+            with stage('shift'):
+                shifted = xr.DataArray(shiftedYear(previous, values, groups), dims=('time', 'cell'))
+            collect('shifted', i - 1, len(years) - 1,
+                    compute_yearly_stats(shifted, thresholds=thresholds, quantiles=quantiles, packed=packed,
+                                         mask=cellMask, events=events))
+        previous = values
+
+    viewYears = {'raw': years, 'rel': years, 'shifted': years[:-1]}
+    result = {}
+    for view in views:
+        result[view] = xr.Dataset({name: xr.DataArray(values, dims=('time',) + templates[view, name].dims,
+                                                      coords=templates[view, name].coords,
+                                                      attrs=templates[view, name].attrs)
+                                   for name, values in out[view].items()},
+                                  coords={'time': viewYears[view]})
+    if 'shifted' in result:
+        for name, var in result['shifted'].data_vars.items():
+            var.attrs['comment'] = 'shifted year: from the day after the climatological coldest DoY, ' \
+                                   'labelled by the year it starts in'
+    return result
 
 
 def DHWthreshold(nc, DOYref, DHWthreshold = 4, relativeDOY=True):
     '''
     find the first day of the year that exceeds DHW threshold
-    :param relativeDOY: make the DOY relative to the reference DOY
-    :param DOYref: data array reference of the DOY of the min climatological SST
+    :param relativeDOY: make the DOY relative to the reference DOY, as getDOYrel: the day after the reference is
+                        day 1 and the days roll by the length of the year
+    :param DOYref: data array or ReferenceDOY of the DOY of the min climatological SST
     :param nc: xarray dataarray with variable[time,lat,lon]
     :param DHWthreshold: min DHW to be reached
     :return: dataset
     '''
+    ## imported here: refTools imports regionTools, which imports this module
+    from .refTools import ReferenceDOY
 
     ## prepare the data array
     nc['time'] = nc.time.dt.year
-    ncYear = nc.groupby("time")
-    years = list(ncYear.groups)
-
-    ## create the first dataarray
-    DOY = getDOY(ncYear[years[0]], DHWthreshold)
+    mask = GridMask.fromData(nc)
+    ## reference aligned to the grid once (flipped, or reindexed), instead of flipped every year
     if relativeDOY:
-        DOY = DOY - np.flipud(DOYref.values)
-    ncYearAll = DOY
+        DOYref = ReferenceDOY.fromData(DOYref).align(nc)
 
-    ## do the rest of the years
-    for yy in years[1:]:
-        print(yy)
-        DOY = getDOY(ncYear[yy], DHWthreshold)
+    def yearDOY(da):
         if relativeDOY:
-            DOY = DOY - np.flipud(DOYref.values)
+            ## leap aware relative DOY, rolled by the length of the year
+            return getDOYrel(da, DHWthreshold, DOYref, mask=mask).rename('DoY_DHW' + str(DHWthreshold))
+        return getDOY(da, DHWthreshold, mask)
 
-        ncYearAll = xr.concat([ncYearAll, DOY], dim='time')
+    ncYearAll = applyByYear(nc, yearDOY, verbose=True)
 
-    ## add 1 to the index to start the year at 1
-    ncYearAll = ncYearAll + 1
-    ## add time coordinates
-    ncYearAll = ncYearAll.assign_coords({'time': years})
+    ## add 1 to the index to start the year at 1. The relative DOY already starts at 1
+    if not relativeDOY:
+        ncYearAll = ncYearAll + 1
 
     return ncYearAll
@@ -0,0 +1,391 @@
+## Benchmark of the DHW metrics and pipeline stages on synthetic daily DHW cubes
+## every stage runs in a fresh process, so its peak RSS and its bytes read and written are its own.
+## The results are written as JSON to compare them across commits
+#
+
+import os
+import sys
+import time
+import platform
+import subprocess
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import xarray as xr
+import numpy as np
+import pandas as pd
+
+## benchmark sizes: laptop runs in a few minutes, production is the size of the CMIP6 runs (1985-2100, 1 degree)
+benchConfigs = {'laptop': dict(years=3, resolution=2.0, latRange=(-40.0, 40.0), landFraction=0.3, models=3,
+                               yearStart=2020, repeat=3, seed=0),
+                'production': dict(years=116, resolution=1.0, latRange=(-90.0, 90.0), landFraction=0.3, models=5,
+                                   yearStart=1985, repeat=3, seed=0)}
+
+## DHWtools metrics run on one year of data: function name -> uses the reference DOY
+benchMetrics = {'getDHWmax': False, 'getDHWmin': False, 'getDHWp99': False, 'getYdayDHWmax': False,
+                'getYdayDHWmax_rel': True, 'getYdayDHWmin': False, 'getDOY': False, 'getDOYrel': True,
+                'getNDays': False, 'compute_yearly_stats': True, 'exceedanceEvents': False,
+                'partitionQuantiles': False}
+
+## pipeline stages, in the order they run. clip reads the processNC output
+benchStages = ['metrics', 'processNC', 'processNC_views', 'ensemble', 'clip']
+
+
+def syntheticYear(year, lat, lon, land, phase, amplitude, trend, rng):
+    '''
+    Make one year of synthetic daily DHW: a seasonal cycle of random phase and amplitude per cell, growing with the
+    years, plus noise. NaN on land
+    :param year: year
+    :param lat: latitudes
+    :param lon: longitudes
+    :param land: boolean array [lat,lon]
+    :param phase: day of the DHW peak of every cell [lat,lon]
+    :param amplitude: DHW peak of every cell [lat,lon]
+    :param trend: DHW added per year
+    :param rng: numpy random generator
+    :return: time coordinate, numpy array float32 [time,lat,lon]
+    '''
+    time = pd.date_range(str(year) + '-01-01', str(year) + '-12-31', freq='D')
+    day = np.arange(len(time), dtype='float32')[:, None, None]
+    season = np.clip(np.cos(2 * np.pi * (day - phase) / len(time)), 0.0, None) ** 2
+    values = (amplitude + trend) * season + rng.gamma(1.0, 0.3, size=(len(time), len(lat), len(lon)))
+    values = values.astype('float32')
+    values[:, land] = np.nan
+    return time, values
+
+
+def writeSyntheticModel(fileName, years, resolution=1.0, latRange=(-90.0, 90.0), landFraction=0.3, yearStart=1985,
+                        seed=0):
+    '''
+    Write a synthetic model daily DHW file, one year at a time so the memory does not grow with the years
+    requires netCDF4
+    :param fileName: output file, named scenario_model_DHW.nc
+    :param years: number of years
+    :param resolution: cell size in degrees
+    :param latRange: latitude range
+    :param landFraction: fraction of land cells
+    :param yearStart: first year
+    :param seed: random seed, one per model
+    :return: file name
+    '''
+    import netCDF4
+
+    rng = np.random.default_rng(seed)
+    lat = np.arange(latRange[0] + resolution / 2.0, latRange[1], resolution)
+    lon = np.arange(-180.0 + resolution / 2.0, 180.0, resolution)
+    ## land in blocks of a few cells, same for all the models
+    landRng = np.random.default_rng(12345)
+    blocks = landRng.random((len(lat) // 4 + 1, len(lon) // 4 + 1)) < landFraction
+    land = np.repeat(np.repeat(blocks, 4, axis=0), 4, axis=1)[:len(lat), :len(lon)]
+    phase = rng.uniform(0, 365, (len(lat), len(lon))).astype('float32')
+    amplitude = rng.uniform(2.0, 10.0, (len(lat), len(lon))).astype('float32')
+
+    start = 0
+    for i, year in enumerate(range(yearStart, yearStart + years)):
+        time, values = syntheticYear(year, lat, lon, land, phase, amplitude, 0.05 * i, rng)
+        days = (time - pd.Timestamp(str(yearStart) + '-01-01')).days.values
+        if i == 0:
+            ds = xr.Dataset({'DHW': (('time', 'lat', 'lon'), values,
+                                     {'long_name': 'Degree Heating Week', 'units': 'degC.week'})},
+                            coords={'time': ('time', days, {'units': 'days since %d-01-01' % yearStart,
+                                                            'calendar': 'standard'}),
+                                    'lat': lat, 'lon': lon})
+            ds.to_netcdf(fileName, unlimited_dims=['time'],
+                         encoding={'DHW': {'chunksizes': (1, len(lat), len(lon)), '_FillValue': np.float32(np.nan)}})
+        else:
+            with netCDF4.Dataset(fileName, 'a') as nc:
+                nc['time'][start:start + len(days)] = days
+                nc['DHW'][start:start + len(days)] = values
+        start += len(days)
+    return fileName
+
+
+def writeSyntheticClimatology(fileName, modelFile, seed=0):
+    '''
+    Write a synthetic SST climatology with the coldest DOY (SSTmin_doy) on the grid of a model file
+    :param fileName: output file
+    :param modelFile: model daily file
+    :param seed: random seed
+    :return: file name
+    '''
+    with xr.open_dataset(modelFile) as nc:
+        lat, lon = nc.lat.values, nc.lon.values
+    rng = np.random.default_rng(seed)
+    doy = rng.integers(1, 366, (len(lat), len(lon))).astype('float32')
+    xr.Dataset({'SSTmin_doy': (('lat', 'lon'), doy)}, coords={'lat': lat, 'lon': lon}).to_netcdf(fileName)
+    return fileName
+
+
+def makeBenchData(workDir, config):
+    '''
+    Write the synthetic model files and climatology of a configuration, if they are not already there
+    :param workDir: work directory
+    :param config: configuration dictionary, see benchConfigs
+    :return: dictionary with the model files, the climatology file and the output directory
+    '''
+    dataDir = os.path.join(workDir, 'data_%dy_%gdeg_%g_%glat_%gland' % (config['years'], config['resolution'],
+                                                                         config['latRange'][0], config['latRange'][1],
+                                                                         config['landFraction']))
+    os.makedirs(dataDir, exist_ok=True)
+    models = []
+    for k in range(config['models']):
+        fileName = os.path.join(dataDir, 'bench_model%02d_DHW.nc' % k)
+        if not os.path.exists(fileName):
+            print('writing', fileName)
+            writeSyntheticModel(fileName + '.tmp', config['years'], config['resolution'], config['latRange'],
+                                config['landFraction'], config['yearStart'], seed=config['seed'] + k)
+            os.replace(fileName + '.tmp', fileName)
+        models.append(fileName)
+    climFile = os.path.join(dataDir, 'clim.nc')
+    if not os.path.exists(climFile):
+        writeSyntheticClimatology(climFile, models[0], seed=config['seed'])
+    outDir = os.path.join(workDir, 'out')
+    os.makedirs(outDir, exist_ok=True)
+    return {'models': models, 'clim': climFile, 'outDir': outDir}
+
+
+def ioCounters():
+    '''
+    Get the bytes read and written by the process so far, from /proc/self/io (Linux)
+    :return: bytes read, bytes written, or None, None if not available
+    '''
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def peakRSS():
+    '''
+    Get the peak resident set size of the process
+    :return: bytes, or None if not available
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def currentRSS():
+    '''
+    Get the resident set size of the process, from /proc/self/status (Linux)
+    :return: bytes, or None if not available
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def measure(func, repeat=1):
+    '''
+    Run a function and measure it
+    :param func: function without arguments
+    :param repeat: number of runs. The wall time is the best one
+    :return: dictionary with wall (s), peakRSS, baseRSS (before the runs, with the data and the imports),
+             readBytes and writeBytes (of all the runs)
+    '''
+    baseRSS = currentRSS()
+    read0, write0 = ioCounters()
+    wall = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        wall.append(time.perf_counter() - start)
+    read1, write1 = ioCounters()
+    return {'wall': min(wall), 'wallAll': wall, 'peakRSS': peakRSS(), 'baseRSS': baseRSS,
+            'readBytes': None if read0 is None else read1 - read0,
+            'writeBytes': None if write0 is None else write1 - write0}
+
+
+def runMetric(name, data, config):
+    '''
+    Benchmark one metric on the first year of the first model, in its own process
+    :param name: metric name, in benchMetrics
+    :param data: dictionary of makeBenchData
+    :param config: configuration dictionary
+    :return: measures
+    '''
+    from . import DHWtools
+    from .maskTools import GridMask
+    from .refTools import ReferenceDOY
+
+    with xr.open_dataset(data['models'][0]) as nc:
+        nc['time'] = nc.time.dt.year
+        da = nc.DHW.isel(time=nc.time == nc.time.values[0]).load()
+    mask = GridMask.fromData(da)
+    ref = ReferenceDOY.fromFile(data['clim'])
+    values = mask.compress(da)
+
+    func = getattr(DHWtools, name)
+    if name == 'exceedanceEvents':
+        call = lambda: func(values, [4.0, 8.0])
+    elif name == 'partitionQuantiles':
+        call = lambda: func(values, [0.5, 0.9, 0.99])
+    elif name == 'compute_yearly_stats':
+        call = lambda: func(da, ref=ref, mask=mask)
+    elif name in ('getDOY', 'getNDays'):
+        call = lambda: func(da, 4, mask=mask)
+    elif name == 'getDOYrel':
+        call = lambda: func(da, 4, ref, mask=mask)
+    elif benchMetrics[name]:
+        call = lambda: func(da, ref, mask=mask)
+    else:
+        call = lambda: func(da, mask=mask)
+    return measure(call, repeat=config['repeat'])
+
+
+def runStage(stage, data, config):
+    '''
+    Benchmark one pipeline stage, in its own process
+    :param stage: stage name, in benchStages
+    :param data: dictionary of makeBenchData
+    :param config: configuration dictionary
+    :return: measures
+    '''
+    outDir = data['outDir']
+    if stage in ('processNC', 'processNC_views'):
+        from processNC import processFile
+        from .refTools import ReferenceDOY
+        views = ('raw', 'rel', 'shifted') if stage == 'processNC_views' else None
+        stageDir = os.path.join(outDir, stage)
+        os.makedirs(stageDir, exist_ok=True)
+        return measure(lambda: processFile(data['models'][0], stageDir, ReferenceDOY.fromFile(data['clim']),
+                                           verbose=False, views=views))
+    if stage == 'ensemble':
+        from .ensembleTools import makeEnsemble
+        stageDir = os.path.join(outDir, stage)
+        os.makedirs(stageDir, exist_ok=True)
+
+        def ensemble():
+            dhwMax = makeEnsemble(data['models'], stageDir, 'bench', workers=min(4, len(data['models'])),
+                                  writeDaily=False)
+            dhwMax.to_netcdf(os.path.join(stageDir, 'bench_ensemble.nc'))
+        return measure(ensemble)
+    if stage == 'clip':
+        from .regionTools import regionStats, clipRegion
+        fileName = os.path.join(outDir, 'processNC', 'DHW_' + os.path.basename(data['models'][0]))
+        if not os.path.exists(fileName):
+            raise FileNotFoundError('clip needs the processNC stage output ' + fileName)
+        stageDir = os.path.join(outDir, stage)
+        os.makedirs(stageDir, exist_ok=True)
+
+        def clip():
+            with xr.open_dataset(fileName) as nc:
+                grid, names = boxRegions(nc.lat.values, nc.lon.values)
+                regionStats(nc.DHW_max, grid, names).to_netcdf(os.path.join(stageDir, 'stats.nc'))
+                for region, name in enumerate(names):
+                    ncClip = clipRegion(nc, grid, region)
+                    if ncClip is not None:
+                        ncClip.to_netcdf(os.path.join(stageDir, name + '.nc'))
+        return measure(clip)
+    raise ValueError('unknown stage ' + stage)
+
+
+def boxRegions(lat, lon, size=20.0):
+    '''
+    Region grid of size x size degree boxes, in place of the IPCC polygons, so the clipping runs offline
+    :param lat: latitudes
+    :param lon: longitudes
+    :param size: box size in degrees
+    :return: region-id grid [lat,lon], list of region names
+    '''
+    iLat = ((np.asarray(lat) + 90.0) // size).astype(int)
+    iLon = ((np.asarray(lon) + 180.0) % 360.0 // size).astype(int)
+    nLon = int(np.ceil(360.0 / size))
+    boxes = iLat[:, None] * nLon + iLon[None, :]
+    ids, grid = np.unique(boxes, return_inverse=True)
+    return grid.reshape(boxes.shape).astype('int16'), ['box-%d' % box for box in ids]
+
+
+def inProcess(func, *args):
+    '''
+    Run a benchmark function in a fresh process
+    :return: the result of the function
+    '''
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(func, *args).result()
+
+
+def runBenchmark(config, workDir, stages=benchStages, metrics=None, verbose=True):
+    '''
+    Run the benchmark of a configuration: every metric and every stage in its own process
+    :param config: configuration dictionary, see benchConfigs
+    :param workDir: work directory of the synthetic data and the outputs
+    :param stages: stages to run
+    :param metrics: metrics of the metrics stage. All if None
+    :param verbose: print the results as they come
+    :return: report dictionary
+    '''
+    data = makeBenchData(workDir, config)
+    results = []
+    for stage in stages:
+        if stage == 'metrics':
+            for name in (benchMetrics if metrics is None else metrics):
+                result = dict(stage='metrics', name=name, **inProcess(runMetric, name, data, config))
+                results.append(result)
+                if verbose:
+                    printResult(result)
+        else:
+            result = dict(stage=stage, name=stage, **inProcess(runStage, stage, data, config))
+            results.append(result)
+            if verbose:
+                printResult(result)
+    return {'config': config, 'commit': gitCommit(), 'date': str(datetime.now()), 'host': platform.node(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'xarray': xr.__version__,
+            'cpus': os.cpu_count(), 'results': results}
+
+
+def gitCommit():
+    '''
+    Get the commit of the working tree, to compare the reports across commits
+    :return: commit hash, with -dirty if there are local changes, or None outside a git repository
+    '''
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def formatBytes(n):
+    return '-' if n is None else '%.1f MB' % (n / 1e6)
+
+
+def printResult(result):
+    print('%-16s %-22s %10.3f s  peak %12s  base %12s  read %12s  written %12s' %
+          (result['stage'], result['name'], result['wall'], formatBytes(result['peakRSS']),
+           formatBytes(result['baseRSS']), formatBytes(result['readBytes']), formatBytes(result['writeBytes'])))
+
+
+def compareReports(old, new):
+    '''
+    Compare the wall time and peak RSS of two reports, for the results present in both
+    :param old: report dictionary, e.g. of the previous commit
+    :param new: report dictionary
+    :return: list of (stage, name, old wall, new wall, wall ratio, old peak RSS, new peak RSS)
+    '''
+    oldResults = {(result['stage'], result['name']): result for result in old['results']}
+    rows = []
+    for result in new['results']:
+        key = (result['stage'], result['name'])
+        if key in oldResults:
+            previous = oldResults[key]
+            rows.append(key + (previous['wall'], result['wall'], result['wall'] / max(previous['wall'], 1e-9),
+                               previous['peakRSS'], result['peakRSS']))
+    return rows
@@ -0,0 +1,241 @@
+## Disk cache of the per-year results of the DHW metrics
+## every (source file, variable, year, metric, parameters) cell is stored as a .npy file, with LRU size-based eviction
+#
+
+import os
+import time
+import json
+import hashlib
+import tempfile
+
+import xarray as xr
+import numpy as np
+
+from .DHWtools import compute_yearly_stats, yearlyStatsAttrs, thresholdName, quantileName
+from .yearTools import yearBounds
+from .profTools import stage
+
+## change it when the metrics change, to invalidate the cached results
+statsVersion = '2'
+
+
+def sourceSignature(fileName, content=False):
+    '''
+    Get a signature of a source file
+    :param fileName: file name
+    :param content: hash the file content instead of using its size and modification time
+    :return: string
+    '''
+    if content:
+        sha = hashlib.sha1()
+        with open(fileName, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                sha.update(block)
+        return sha.hexdigest()
+    stat = os.stat(fileName)
+    return '%s:%d:%d' % (os.path.abspath(fileName), stat.st_size, stat.st_mtime_ns)
+
+
+def arraySignature(values):
+    '''
+    Get a signature of the content of an array, e.g. the reference DOY
+    :param values: numpy array or data array
+    :return: string
+    '''
+    values = np.ascontiguousarray(np.asarray(values))
+    return hashlib.sha1(values.tobytes() + str(values.shape).encode()).hexdigest()
+
+
+class ResultCache:
+    '''
+    Disk cache of numpy arrays with LRU eviction when the total size is above maxBytes
+    the last use of an entry is its file modification time.
+    Several processes can share the directory (e.g. the bppProcess workers): every process keeps its own index and
+    size count, so together they can go above maxBytes by what the others wrote since their last scan. When its count
+    goes above maxBytes, a process scans the directory again to see all the entries before evicting, and evicts down
+    to lowWater of maxBytes so the scans are not repeated on every put. Entries removed by another process are misses
+    '''
+
+    ## fraction of maxBytes the eviction goes down to
+    lowWater = 0.9
+
+    def __init__(self, cacheDir, maxBytes=10e9):
+        '''
+        :param cacheDir: cache directory
+        :param maxBytes: max total size of the cache in bytes
+        '''
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        os.makedirs(cacheDir, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        '''
+        Build the index of the entries (key -> [size, last use]) and the total size from the directory
+        '''
+        self.index = {}
+        for root, _, files in os.walk(self.cacheDir):
+            for name in files:
+                if name.endswith('.npy'):
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue
+                    self.index[name[:-4]] = [stat.st_size, stat.st_mtime]
+        self.nBytes = sum(size for size, _ in self.index.values())
+
+    @staticmethod
+    def key(**fields):
+        '''
+        Make the key of a cache entry
+        :param fields: source, variable, year, metric, parameters...
+        :return: hex string
+        '''
+        return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cacheDir, key[:2], key + '.npy')
+
+    def get(self, key):
+        '''
+        Get an entry
+        :param key: entry key
+        :return: numpy array, or None if it is not in the cache
+        '''
+        path = self.path(key)
+        try:
+            values = np.load(path)
+        except (FileNotFoundError, ValueError):
+            self.index.pop(key, None)
+            return None
+        ## another process can evict the entry once it is loaded
+        try:
+            os.utime(path)
+            if key in self.index:
+                self.index[key][1] = os.path.getmtime(path)
+        except FileNotFoundError:
+            pass
+        return values
+
+    def put(self, key, values):
+        '''
+        Store an entry, evicting the least recently used entries if the cache is full
+        :param key: entry key
+        :param values: numpy array
+        '''
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ## write and rename, so other processes never read a partial file
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, values)
+            size = f.tell()
+        os.replace(tmpPath, path)
+        ## not stat-ed after the rename: another process can already have evicted it
+        if key in self.index:
+            self.nBytes -= self.index[key][0]
+        self.index[key] = [size, time.time()]
+        self.nBytes += size
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove the least recently used entries of the directory until the cache size is below lowWater of maxBytes,
+        if it is above maxBytes
+        '''
+        if self.nBytes <= self.maxBytes:
+            return
+        ## entries written and removed by the other processes sharing the directory
+        self.scan()
+        target = self.lowWater * self.maxBytes
+        for key in sorted(self.index, key=lambda k: self.index[k][1]):
+            if self.nBytes <= target:
+                break
+            size, _ = self.index.pop(key)
+            self.nBytes -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+
+def yearlyStatsNames(thresholds=(4, 8), quantiles=(0.99,), ref=None, events=False):
+    '''
+    Get the names of the variables produced by compute_yearly_stats, in the same order
+    :return: list of variable names
+    '''
+    names = ['DHW_max'] + ['DHW_' + quantileName(q) for q in quantiles]
+    names += ['DoY_DHW' + thresholdName(threshold) for threshold in thresholds]
+    if ref is not None:
+        names += ['DoYrel_DHW' + thresholdName(threshold) for threshold in thresholds]
+    names += ['nDays_DHW' + thresholdName(threshold) for threshold in thresholds]
+    if events:
+        names += ['DoYlast_DHW' + thresholdName(threshold) for threshold in thresholds]
+        names += ['maxRun_DHW' + thresholdName(threshold) for threshold in thresholds]
+    return names
+
+
+def cachedYearlyStats(da, cache, source, thresholds=(4, 8), quantiles=(0.99,), ref=None, packed=False,
+                      mask=None, events=False, verbose=False):
+    '''
+    compute_yearly_stats for every year of a daily series, computing only the (year, metric) cells
+    that are not in the cache. Years with all their cells in the cache are not read
+    :param da: data array of daily values [time,lat,lon]
+    :param cache: ResultCache
+    :param source: signature of the source file, see sourceSignature
+    :param thresholds: DHW thresholds for the DOY and the number of days
+    :param quantiles: quantiles requested
+    :param ref: DOY data array [lat,lon] to reference the start of the year. No relative DOY if None
+    :param packed: float32 and int16 results, see compute_yearly_stats
+    :param mask: GridMask of the grid, built once for all the years. Built from the data of each year if None
+    :param events: also the last day above each threshold and the longest run above, see compute_yearly_stats
+    :param verbose: print the year being processed and the number of metrics computed
+    :return: dataset with the yearly statistics [time,lat,lon], time coordinate = year
+    '''
+    years, bounds = yearBounds(da)
+    names = yearlyStatsNames(thresholds, quantiles, ref, events)
+    refKey = None if ref is None else arraySignature(ref)
+    dims = da.dims[1:]
+    coords = {dim: da[dim] for dim in dims if dim in da.coords}
+
+    def cellKey(yy, name):
+        return cache.key(source=source, variable=da.name, year=yy, metric=name,
+                         ref=refKey if name.startswith('DoYrel_') else None, packed=packed, version=statsVersion)
+
+    out = {}
+    for i, (yy, (start, stop)) in enumerate(zip(years, bounds)):
+        yearValues = {}
+        missing = []
+        with stage('cache get'):
+            for name in names:
+                values = cache.get(cellKey(yy, name))
+                if values is None:
+                    missing.append(name)
+                else:
+                    yearValues[name] = values
+
+        if missing:
+            ## compute only the thresholds and quantiles with missing cells
+            missingThresholds = [threshold for threshold in thresholds
+                                 if any(name.endswith('_DHW' + thresholdName(threshold)) for name in missing)]
+            missingQuantiles = [q for q in quantiles if 'DHW_' + quantileName(q) in missing]
+            missingRel = any(name.startswith('DoYrel_') for name in missing)
+            dsYear = compute_yearly_stats(da.isel(time=slice(start, stop)), thresholds=missingThresholds,
+                                          quantiles=missingQuantiles, ref=ref if missingRel else None,
+                                          packed=packed, mask=mask, events=events)
+            with stage('cache put'):
+                for name in missing:
+                    yearValues[name] = dsYear[name].values
+                    cache.put(cellKey(yy, name), yearValues[name])
+        if verbose:
+            print(yy, '%d metrics computed' % len(missing))
+
+        for name in names:
+            if name not in out:
+                out[name] = np.empty((len(years),) + yearValues[name].shape, dtype=yearValues[name].dtype)
+            out[name][i] = yearValues[name]
+
+    return xr.Dataset({name: xr.DataArray(out[name], dims=('time',) + dims, coords=coords,
+                                          attrs=yearlyStatsAttrs(name))
+                       for name in names},
+                      coords={'time': years})
@@ -0,0 +1,158 @@
+## Sparse reef-cell storage of daily DHW[time,lat,lon] series
+## only the valid cells of a GridMask are stored, as a [cell,time] .npy array read through np.memmap,
+## with the grid, the mask and the dates alongside. The metrics run on the [time,cell] view of the cells
+## and the results are scattered back to the grid only when written
+#
+
+import os
+import json
+
+import xarray as xr
+import numpy as np
+
+from .maskTools import GridMask
+from .yearTools import yearBounds
+from .DHWtools import packedFillValue
+
+## extension of the cell store directories
+cellStoreSuffix = '.cells'
+
+
+def isCellStore(fileName):
+    '''
+    Check if a file name is a cell store
+    :param fileName: file or directory name
+    :return: bool
+    '''
+    return os.path.isdir(fileName) and os.path.exists(os.path.join(fileName, 'meta.json'))
+
+
+def dateKey(time):
+    '''
+    Get the dates of a time coordinate as YYYYMMDD integers, for any calendar
+    :param time: data array of datetimes or cftime dates
+    :return: numpy array int32
+    '''
+    return (time.dt.year * 10000 + time.dt.month * 100 + time.dt.day).values.astype('int32')
+
+
+def writeCellStore(da, storeName, mask=None, dtype='float32', source=None, globalAttrs=None, verbose=False):
+    '''
+    Write the valid cells of a daily series as a cell store: storeName/values.npy [cell,time],
+    mask.npy [lat,lon], lat.npy, lon.npy, date.npy (YYYYMMDD) and meta.json
+    the series is read and written one year at a time
+    :param da: data array of daily values [time,lat,lon], with datetime or cftime time coordinate
+    :param storeName: store directory, named *.cells
+    :param mask: GridMask of the cells to keep. The ocean cells of da if None
+    :param dtype: type of the stored values
+    :param source: name of the source file, kept in the metadata
+    :param globalAttrs: global attributes of the source file, kept in the metadata
+    :param verbose: print the year being written
+    :return: storeName
+    '''
+    if mask is None:
+        mask = GridMask.fromData(da)
+    os.makedirs(storeName, exist_ok=True)
+    latDim, lonDim = da.dims[1:]
+
+    values = np.lib.format.open_memmap(os.path.join(storeName, 'values.npy'), mode='w+', dtype=dtype,
+                                       shape=(mask.nCells, da.sizes['time']))
+    years, bounds = yearBounds(da)
+    for yy, (start, stop) in zip(years, bounds):
+        if verbose:
+            print(yy)
+        values[:, start:stop] = mask.compress(da.isel(time=slice(start, stop))).T
+    values.flush()
+    del values
+
+    np.save(os.path.join(storeName, 'mask.npy'), mask.mask)
+    np.save(os.path.join(storeName, 'lat.npy'), da[latDim].values)
+    np.save(os.path.join(storeName, 'lon.npy'), da[lonDim].values)
+    np.save(os.path.join(storeName, 'date.npy'), dateKey(da.time))
+    with open(os.path.join(storeName, 'meta.json'), 'w') as f:
+        json.dump({'varName': da.name, 'dims': [latDim, lonDim], 'attrs': da.attrs,
+                   'source': source, 'globalAttrs': {} if globalAttrs is None else globalAttrs},
+                  f, indent=2, default=str)
+    return storeName
+
+
+class CellStore:
+    '''
+    Cell store opened for reading. The values are memory mapped, nothing is read until used
+    '''
+
+    def __init__(self, storeName):
+        '''
+        :param storeName: store directory written by writeCellStore
+        '''
+        self.storeName = storeName
+        with open(os.path.join(storeName, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.varName = self.meta['varName']
+        self.source = self.meta['source'] or os.path.basename(storeName)
+        self.valuesPath = os.path.join(storeName, 'values.npy')
+        self.values = np.load(self.valuesPath, mmap_mode='r')
+        self.date = np.load(os.path.join(storeName, 'date.npy'))
+        self.lat = np.load(os.path.join(storeName, 'lat.npy'))
+        self.lon = np.load(os.path.join(storeName, 'lon.npy'))
+        latDim, lonDim = self.meta['dims']
+        self.mask = GridMask(np.load(os.path.join(storeName, 'mask.npy')), dims=(latDim, lonDim),
+                             coords={latDim: self.lat, lonDim: self.lon})
+        self.nCells = self.mask.nCells
+        ## grid row and column of every cell
+        self.cellLat, self.cellLon = np.unravel_index(self.mask.index, self.mask.shape)
+
+    @property
+    def years(self):
+        return self.date // 10000
+
+    def dataArray(self):
+        '''
+        Get the daily values as a [time,cell] data array, a transposed view of the memory mapped [cell,time] array
+        the time coordinate is the year of every day and the date coordinate the YYYYMMDD date
+        :return: data array [time,cell]
+        '''
+        latDim, lonDim = self.mask.dims
+        return xr.DataArray(self.values.T, dims=('time', 'cell'), name=self.varName, attrs=self.meta['attrs'],
+                            coords={'time': self.years, 'date': ('time', self.date),
+                                    'cell': np.arange(self.nCells),
+                                    latDim: ('cell', self.lat[self.cellLat]),
+                                    lonDim: ('cell', self.lon[self.cellLon])})
+
+    def lookup(self, lat, lon):
+        '''
+        Get the cell of the grid cell nearest to a position
+        :param lat: latitude
+        :param lon: longitude
+        :return: cell id, -1 if the grid cell is not stored
+        '''
+        iLat = int(np.abs(self.lat - lat).argmin())
+        iLon = int(np.abs((self.lon - lon + 180.0) % 360.0 - 180.0).argmin())
+        flat = np.ravel_multi_index((iLat, iLon), self.mask.shape)
+        cell = int(np.searchsorted(self.mask.index, flat))
+        if cell < self.nCells and self.mask.index[cell] == flat:
+            return cell
+        return -1
+
+    def toGrid(self, ds):
+        '''
+        Scatter the cell variables of a dataset back to the grid
+        integer variables are filled with packedFillValue, float variables with NaN
+        :param ds: dataset or data array with a cell dimension [...,cell]
+        :return: dataset or data array [...,lat,lon]
+        '''
+        if isinstance(ds, xr.DataArray):
+            return self.toGrid(ds.to_dataset(name=ds.name or 'var'))[ds.name or 'var']
+        latDim, lonDim = self.mask.dims
+        out = xr.Dataset(coords={name: coord for name, coord in ds.coords.items() if 'cell' not in coord.dims})
+        out = out.assign_coords({latDim: self.lat, lonDim: self.lon})
+        for name, var in ds.data_vars.items():
+            if 'cell' not in var.dims:
+                out[name] = var
+                continue
+            var = var.transpose(..., 'cell')
+            fill = packedFillValue if var.dtype.kind == 'i' else np.nan
+            out[name] = xr.DataArray(self.mask.expand(var.values, fill=fill), dims=var.dims[:-1] + (latDim, lonDim),
+                                     attrs=var.attrs)
+        out.attrs = ds.attrs
+        return out
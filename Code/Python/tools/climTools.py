@@ -0,0 +1,258 @@
+## Decadal and moving-window climatologies of the yearly DHW products (processNC outputs)
+## every window statistic comes from the difference of two cumulative sums along the years,
+## so each step costs the same whatever the window length. Models are pooled by adding their cumulative sums
+#
+
+import warnings
+
+import xarray as xr
+import numpy as np
+
+from .DHWtools import thresholdName
+from .maskTools import GridMask
+
+
+class WindowSums:
+    '''
+    Cumulative sums along the years of a yearly variable [year,...]: number of valid years, sum, sum of squares
+    of the years, sum of year * value and number of years at or above each threshold.
+    Several models on the same grid and years are pooled by adding their sums
+    '''
+
+    def __init__(self, years, thresholds=()):
+        '''
+        :param years: list of years of all the inputs
+        :param thresholds: thresholds of the exceedance frequencies. Inclusive
+        '''
+        self.years = np.asarray(years)
+        self.thresholds = list(thresholds)
+        self.sums = {}
+
+    def add(self, values):
+        '''
+        Add the yearly values of one model
+        :param values: numpy array [year,...], e.g. [year,cell], NaN for missing values
+        '''
+        values = np.asarray(values, dtype='float64')
+        valid = ~np.isnan(values)
+        filled = np.where(valid, values, 0.0)
+        ## years relative to the first year, to keep the trend sums small
+        x = (self.years - self.years[0]).astype('float64').reshape((-1,) + (1,) * (values.ndim - 1))
+        terms = {'n': valid, 'y': filled, 'x': valid * x, 'xx': valid * x * x, 'xy': filled * x}
+        for threshold in self.thresholds:
+            terms['above' + thresholdName(threshold)] = valid & (values >= threshold)
+
+        for name, term in terms.items():
+            cumulative = np.zeros((len(self.years) + 1,) + values.shape[1:], dtype='float64')
+            np.cumsum(term, axis=0, out=cumulative[1:])
+            if name not in self.sums:
+                self.sums[name] = cumulative
+            else:
+                self.sums[name] += cumulative
+
+    def window(self, start, stop):
+        '''
+        Get the sums of the years [start, stop) by position
+        :param start: position of the first year, or array of positions
+        :param stop: position after the last year, or array of positions
+        :return: dictionary of sums [...,cell]
+        '''
+        return {name: cumulative[stop] - cumulative[start] for name, cumulative in self.sums.items()}
+
+    def stats(self, start, stop, minYears=1):
+        '''
+        Get the statistics of the windows [start, stop): mean, exceedance frequency of each threshold and trend
+        :param start: array of positions of the first year of every window
+        :param stop: array of positions after the last year of every window
+        :param minYears: min number of valid years of a window. NaN below
+        :return: dictionary of numpy arrays [window,...]
+        '''
+        sums = self.window(np.asarray(start), np.asarray(stop))
+        n = sums['n']
+        enough = n >= minYears
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = {'mean': np.where(enough, sums['y'] / n, np.nan)}
+            for threshold in self.thresholds:
+                name = thresholdName(threshold)
+                out['freq' + name] = np.where(enough, sums['above' + name] / n, np.nan)
+            ## least squares slope from the sums: (n Sxy - Sx Sy) / (n Sxx - Sx^2)
+            denominator = n * sums['xx'] - sums['x'] ** 2
+            out['trend'] = np.where(enough & (denominator > 0),
+                                    (n * sums['xy'] - sums['x'] * sums['y']) / denominator, np.nan)
+        out['nYears'] = n
+        return out
+
+
+def windowBounds(years, window=10, mode='rolling'):
+    '''
+    Get the windows of a list of consecutive years
+    :param years: list of years
+    :param window: window length in years
+    :param mode: 'rolling' for every window of consecutive years, 'decadal' for the calendar periods of window years
+                 (e.g. 2020-2029)
+    :return: first year of every window, start positions, stop positions
+    '''
+    years = np.asarray(years)
+    if np.any(np.diff(years) != 1):
+        raise ValueError('years must be consecutive')
+    if mode == 'rolling':
+        start = np.arange(0, len(years) - window + 1)
+    elif mode == 'decadal':
+        first = years[0] + (-years[0]) % window
+        start = np.arange(first - years[0], len(years), window)
+    else:
+        raise ValueError('unknown window mode ' + mode)
+    stop = np.minimum(start + window, len(years))
+    return years[start], start, stop
+
+
+def climatology(dataArrays, window=10, mode='rolling', thresholds=(), minYears=None):
+    '''
+    Get the window statistics of a yearly variable of one or many models, pooling the models:
+    mean, frequency of the years at or above each threshold, trend (per year) and number of valid years
+    :param dataArrays: list of data arrays [time,lat,lon] with time = year, on the same grid. The years of
+                       all the models are used, missing years count as missing values
+    :param window: window length in years
+    :param mode: 'rolling' or 'decadal', see windowBounds
+    :param thresholds: thresholds of the exceedance frequencies. Inclusive
+    :param minYears: min number of valid model-years of a window. Half the window of every model if None
+    :return: dataset [period,lat,lon], period = first year of the window
+    '''
+    da0 = dataArrays[0]
+    name = da0.name
+    years = np.arange(min(int(da.time.min()) for da in dataArrays), max(int(da.time.max()) for da in dataArrays) + 1)
+
+    ## the sums are kept for the cells with a value in any year of any model only
+    valid = np.zeros(da0.shape[1:], dtype=bool)
+    for da in dataArrays:
+        valid |= ~np.all(np.isnan(da.values), axis=0)
+    spaceDims = da0.dims[1:]
+    mask = GridMask(valid, dims=spaceDims, coords={dim: da0[dim] for dim in spaceDims if dim in da0.coords})
+
+    sums = WindowSums(years, thresholds)
+    for da in dataArrays:
+        sums.add(mask.compress(da.reindex(time=years)))
+
+    periods, start, stop = windowBounds(years, window, mode)
+    if minYears is None:
+        minYears = len(dataArrays) * window / 2.0
+    stats = sums.stats(start, stop, minYears=minYears)
+
+    attrs = {'mean': {'long_name': 'mean of ' + name, 'units': da0.attrs.get('units', '')},
+             'trend': {'long_name': 'least squares trend of ' + name, 'units': da0.attrs.get('units', '') + ' per year'},
+             'nYears': {'long_name': 'number of valid model-years of the window'}}
+    for threshold in thresholds:
+        attrs['freq' + thresholdName(threshold)] = {
+            'long_name': 'frequency of the years with ' + name + ' >= ' + thresholdName(threshold)}
+
+    ds = xr.Dataset({name + '_' + stat: (('period',) + spaceDims,
+                                         mask.expand(values.astype('float32'), fill=np.nan) if stat != 'nYears' else
+                                         mask.expand(values.astype('int16'), fill=0),
+                                         attrs[stat])
+                     for stat, values in stats.items()},
+                    coords=dict(mask.coords, period=periods))
+    ds.period.attrs = {'long_name': 'first year of the window', 'window': window, 'mode': mode}
+    ds.attrs = {'models': len(dataArrays)}
+    return ds
+
+
+def onsetYear(values, years, threshold=8.0, nYears=1, window=1):
+    '''
+    Get the onset year of every cell: first year from which every window of `window` years has at least nYears
+    years at or above the threshold, until the last year. nYears = window = 1 is the onset of annual severe
+    bleaching: the threshold is reached every year from the onset on
+    the window counts come from a cumulative sum and the "until the last year" from a reverse cumulative AND,
+    so all the cells and models are solved at once
+    :param values: numpy array [year,...], e.g. DHW_max [year,model,cell]. NaN years are missing: the windows
+                   without any value do not break the onset, e.g. the years after the end of a model run
+    :param years: consecutive years of the first axis
+    :param threshold: threshold value. Inclusive
+    :param nYears: min number of years at or above the threshold in each window, at most window
+    :param window: window length in years
+    :return: numpy array [...] of onset years, NaN if there is no onset
+    '''
+    if nYears > window:
+        raise ValueError('nYears %d is more than the window of %d years' % (nYears, window))
+    years = np.asarray(years)
+    values = np.asarray(values)
+    count = np.zeros((2, len(years) + 1) + values.shape[1:], dtype='int32')
+    np.cumsum(values >= threshold, axis=0, out=count[0, 1:])
+    np.cumsum(~np.isnan(values), axis=0, out=count[1, 1:])
+    nAbove, nValid = count[:, window:] - count[:, :-window]
+    hasValues = nValid > 0
+    windowOk = (nAbove >= nYears) | ~hasValues
+    ## every window from this one to the last one is ok. The onset is the first of them with values
+    okAfter = np.logical_and.accumulate(windowOk[::-1], axis=0)[::-1] & hasValues
+    return np.where(okAfter.any(axis=0), years[okAfter.argmax(axis=0)], np.nan)
+
+
+def linearTrend(values, years):
+    '''
+    Get the least squares trend of every cell over all the years, from the sums of a batched regression
+    :param values: numpy array [year,...]. NaN values are not used
+    :param years: years of the first axis
+    :return: numpy array [...] of slopes per year, NaN with less than 2 valid years
+    '''
+    sums = WindowSums(years)
+    sums.add(values)
+    return sums.stats([0], [len(years)], minYears=2)['trend'][0]
+
+
+def onsetEnsemble(dataArrays, threshold=8.0, nYears=1, window=1, models=None):
+    '''
+    Get the onset year and trend of every model and cell, and their spread across the models
+    :param dataArrays: list of yearly data arrays [time,lat,lon] with time = year, on the same grid,
+                       e.g. DHW_max of every model of a scenario. Missing years do not break the onset
+    :param threshold: threshold value. Inclusive
+    :param nYears: min number of years at or above the threshold in each window, see onsetYear
+    :param window: window length in years
+    :param models: model names. Numbered if None
+    :return: dataset with onset and trend [model,lat,lon] and the ensemble onset median, min, max, std,
+             fraction of models with onset and mean trend [lat,lon]
+    '''
+    da0 = dataArrays[0]
+    name = da0.name
+    years = np.arange(min(int(da.time.min()) for da in dataArrays), max(int(da.time.max()) for da in dataArrays) + 1)
+    spaceDims = da0.dims[1:]
+
+    ## [year,model,cell] of the cells with a value in any model
+    valid = np.zeros((len(dataArrays),) + da0.shape[1:], dtype=bool)
+    for i, da in enumerate(dataArrays):
+        valid[i] = ~np.all(np.isnan(da.values), axis=0)
+    mask = GridMask(valid.any(axis=0), dims=spaceDims,
+                    coords={dim: da0[dim] for dim in spaceDims if dim in da0.coords})
+    values = np.stack([mask.compress(da.reindex(time=years)) for da in dataArrays], axis=1)
+    validCells = mask.compress(valid)
+
+    onset = np.where(validCells, onsetYear(values, years, threshold, nYears, window), np.nan)
+    trend = linearTrend(values, years)
+    nValid = validCells.sum(axis=0)
+
+    ## all-NaN cells (no model with onset) give NaN
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        spread = {'onset_median': np.nanmedian(onset, axis=0),
+                  'onset_min': np.nanmin(onset, axis=0),
+                  'onset_max': np.nanmax(onset, axis=0),
+                  'onset_std': np.nanstd(onset, axis=0),
+                  'onset_fraction': np.where(nValid > 0, (~np.isnan(onset)).sum(axis=0) / nValid, np.nan),
+                  'trend_mean': np.nanmean(trend, axis=0)}
+
+    criterion = '%s >= %s in %d of %d years' % (name, thresholdName(threshold), nYears, window)
+    attrs = {'onset': {'long_name': 'onset year: ' + criterion + ' from this year on',
+                       'comment': 'NaN if there is no onset before ' + str(years[-1])},
+             'trend': {'long_name': 'least squares trend of ' + name, 'units': da0.attrs.get('units', '') + ' per year'},
+             'onset_median': {'long_name': 'ensemble median of the onset year, models with onset'},
+             'onset_min': {'long_name': 'ensemble earliest onset year, models with onset'},
+             'onset_max': {'long_name': 'ensemble latest onset year, models with onset'},
+             'onset_std': {'long_name': 'ensemble standard deviation of the onset year, models with onset'},
+             'onset_fraction': {'long_name': 'fraction of the models with onset'},
+             'trend_mean': {'long_name': 'ensemble mean trend of ' + name,
+                            'units': da0.attrs.get('units', '') + ' per year'}}
+    out = {'onset': (('model',) + spaceDims, mask.expand(onset.astype('float32'))),
+           'trend': (('model',) + spaceDims, mask.expand(trend.astype('float32')))}
+    out.update({stat: (spaceDims, mask.expand(values.astype('float32'))) for stat, values in spread.items()})
+    ds = xr.Dataset({stat: out[stat] + (attrs[stat],) for stat in out},
+                    coords=dict(mask.coords, model=list(models) if models is not None else np.arange(len(dataArrays))))
+    ds.attrs = {'criterion': criterion, 'first_year': int(years[0]), 'last_year': int(years[-1])}
+    return ds
@@ -0,0 +1,319 @@
+## Functions to make a model ensemble of daily DHW[time,lat,lon] files
+## every model file is opened once, the years are read by index and the models are accumulated
+## in preallocated buffers that are reused for every year
+#
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import xarray as xr
+import numpy as np
+
+from .yearTools import yearBounds, Prefetcher
+from .cellTools import CellStore, isCellStore
+from .maskTools import GridMask
+from .quantileTools import HistogramQuantiles
+from .DHWtools import quantileName
+from .regridTools import Regridder, sameGrid
+from .profTools import stage
+
+
+## model data arrays opened by each reader process
+openedModels = {}
+
+
+def openModel(fileName, varName='DHW'):
+    '''
+    Open a model daily file and index its years
+    :param fileName: model daily file, or its cell store
+    :param varName: name of the variable. DHW by default
+    :return: data array [time,lat,lon] or [time,cell], dictionary year: (start, stop), month-day key of each time step
+    '''
+    if isCellStore(fileName):
+        da = CellStore(fileName).dataArray()
+        years, bounds = yearBounds(da)
+        return da, dict(zip(years, bounds)), da.date.values % 10000
+    nc = xr.open_dataset(fileName)
+    if "time_bnds" in nc.data_vars:
+        nc = nc.drop_vars("time_bnds")
+    da = nc[varName]
+    years, bounds = yearBounds(da)
+    monthDay = (da.time.dt.month * 100 + da.time.dt.day).values
+    return da, dict(zip(years, bounds)), monthDay
+
+
+def initReader(fileList, varName):
+    '''
+    Open all the model files once in a reader process
+    :param fileList: list of model daily files
+    :param varName: name of the variable
+    '''
+    for fileName in fileList:
+        openedModels[fileName] = openModel(fileName, varName)[0]
+
+
+def readSlice(fileName, index):
+    '''
+    Read the days of a model file opened by initReader
+    :param fileName: model daily file
+    :param index: slice or integer positions along time
+    :return: numpy array [time,lat,lon]
+    '''
+    return openedModels[fileName].isel(time=index).values
+
+
+def commonDays(models, year):
+    '''
+    Get, for every model, the positions of the days of the year that are present in all the models
+    models with different calendars are matched by month and day, as an inner join on the dates
+    :param models: list of (data array, year bounds, month-day key) as returned by openModel
+    :param year: year
+    :return: list of slices or integer positions along time, one per model
+    '''
+    keys = [monthDay[slice(*bounds[year])] for _, bounds, monthDay in models]
+    if all(len(key) == len(keys[0]) and np.array_equal(key, keys[0]) for key in keys):
+        return [slice(*bounds[year]) for _, bounds, _ in models]
+
+    common = keys[0]
+    for key in keys[1:]:
+        common = np.intersect1d(common, key)
+    return [bounds[year][0] + np.nonzero(np.isin(key, common))[0] for key, (_, bounds, _) in zip(keys, models)]
+
+
+def modelRegridders(models, fileList, regrid=None, cacheDir=None):
+    '''
+    Check that the models are on the grid of the first one, or get their regridders to it
+    :param models: list of (data array, year bounds, month-day key) as returned by openModel
+    :param fileList: list of model files, for the error message
+    :param regrid: regridding method of the models on another grid, 'conservative' or 'bilinear'.
+                   Models on another grid are an error if None
+    :param cacheDir: cache directory of the regridding weights
+    :return: list of Regridder, or None for the models on the grid of the first one
+    '''
+    da0 = models[0][0]
+    regridders = []
+    for fileName, (da, _, _) in zip(fileList, models):
+        if da.dims[1:] == ('cell',) or sameGrid(da, da0):
+            regridders.append(None)
+        elif regrid is None:
+            raise ValueError(os.path.basename(fileName) + ' is not on the grid of ' +
+                             os.path.basename(fileList[0]) + '. Regrid the models')
+        else:
+            regridders.append(Regridder.fromData(da, da0, method=regrid, cacheDir=cacheDir))
+    return regridders
+
+
+def makeEnsemble(fileList, outDir, scenario, varName='DHW', years=None, workers=4, executor='thread',
+                 quantiles=(0.1, 0.5, 0.9), writeDaily=True, regrid=None, weightsDir=None, prefetch=1):
+    '''
+    Make the model ensemble of daily DHW and its yearly DHWmax
+    the models of each year are read in parallel and accumulated in running buffers:
+    mean, min, max and standard deviation (Welford) of the daily values across models.
+    The spread across models of the yearly DHWmax is given by its min, max, standard deviation and quantiles
+    :param fileList: list of model daily files of the scenario, or their cell stores written with the same mask.
+                     The cell results are put back on the grid of the first store
+    :param outDir: output directory
+    :param scenario: scenario name, used for the output file names
+    :param varName: name of the variable. DHW by default
+    :param years: list of years. All the years present in all the models if None
+    :param workers: number of parallel model readers
+    :param executor: 'thread' or 'process' pool of readers
+    :param quantiles: quantiles of the model spread of the yearly DHWmax
+    :param writeDaily: write the ensemble daily values, one file per year
+    :param regrid: regridding method of the models that are not on the grid of the first one,
+                   'conservative' or 'bilinear'. They are an error if None
+    :param weightsDir: cache directory of the regridding weights
+    :param prefetch: number of years whose model slices are queued to the readers ahead of the year being
+                     accumulated, so the readers do not wait for the accumulation. At most prefetch + 1 years
+                     of every model are in memory
+    :return: dataset with the yearly ensemble DHWmax and its model spread [year,lat,lon]
+    '''
+    models = [openModel(fileName, varName) for fileName in fileList]
+    if years is None:
+        years = sorted(set.intersection(*[set(bounds) for _, bounds, _ in models]))
+    da0 = models[0][0]
+    spaceDims = da0.dims[1:]
+    spaceCoords = {dim: da0[dim] for dim in spaceDims if dim in da0.coords}
+    nModels = len(models)
+    store = None
+    if spaceDims == ('cell',):
+        store = CellStore(fileList[0])
+        spaceCoords = {}
+        for da, _, _ in models[1:]:
+            if da.dims[1:] != spaceDims or da.shape[1:] != da0.shape[1:]:
+                raise ValueError('cell stores of the ensemble must be written with the same mask')
+    regridders = modelRegridders(models, fileList, regrid, weightsDir)
+
+    ## running buffers, allocated once for the longest year and reused
+    shape = (366,) + da0.shape[1:]
+    dayMean = np.empty(shape, dtype='float64')
+    dayM2 = np.empty(shape, dtype='float64')
+    dayMin = np.empty(shape, dtype='float32')
+    dayMax = np.empty(shape, dtype='float32')
+    modelMax = np.empty((nModels,) + da0.shape[1:], dtype='float32')
+
+    ## yearly output
+    yearShape = (len(years),) + da0.shape[1:]
+    yearly = {name: np.empty(yearShape, dtype='float32')
+              for name in ['DHW', 'DHWmax_min', 'DHWmax_max', 'DHWmax_std'] +
+              ['DHWmax_q' + str(q).split(".")[1] for q in quantiles]}
+
+    if executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=initReader, initargs=(fileList, varName))
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        for fileName, model in zip(fileList, models):
+            openedModels[fileName] = model[0]
+
+    def submitYear(yy):
+        index = commonDays(models, yy)
+        return index, [pool.submit(readSlice, fileName, idx) for fileName, idx in zip(fileList, index)]
+
+    ## the slices of the next years are read while the current one is accumulated
+    queued = deque(submitYear(yy) for yy in years[:prefetch + 1])
+    for iy, yy in enumerate(years):
+        index, futures = queued.popleft()
+        if iy + prefetch + 1 < len(years):
+            queued.append(submitYear(years[iy + prefetch + 1]))
+
+        ## accumulate the models as they arrive
+        for n, future in enumerate(futures, start=1):
+            ## waiting for the readers
+            with stage('read'):
+                values = future.result()
+            if regridders[n - 1] is not None:
+                with stage('regrid'):
+                    values = regridders[n - 1].regridValues(values)
+            nDays = values.shape[0]
+            with stage('fold'):
+                mean, m2 = dayMean[:nDays], dayM2[:nDays]
+                if n == 1:
+                    mean[:] = values
+                    m2[:] = 0.0
+                    dayMin[:nDays] = values
+                    dayMax[:nDays] = values
+                else:
+                    delta = values - mean
+                    mean += delta / n
+                    m2 += delta * (values - mean)
+                    np.minimum(dayMin[:nDays], values, out=dayMin[:nDays])
+                    np.maximum(dayMax[:nDays], values, out=dayMax[:nDays])
+                modelMax[n - 1] = values.max(axis=0)
+            del values
+
+        ## yearly DHWmax of the ensemble mean and model spread of the yearly DHWmax
+        with stage('fold'):
+            yearly['DHW'][iy] = dayMean[:nDays].max(axis=0)
+            yearly['DHWmax_min'][iy] = modelMax.min(axis=0)
+            yearly['DHWmax_max'][iy] = modelMax.max(axis=0)
+            yearly['DHWmax_std'][iy] = modelMax.std(axis=0)
+            modelQ = np.quantile(modelMax, quantiles, axis=0)
+            for q, values in zip(quantiles, modelQ):
+                yearly['DHWmax_q' + str(q).split(".")[1]][iy] = values
+
+        if writeDaily:
+            with stage('write'):
+                if store is None:
+                    time = da0.time[index[0]]
+                else:
+                    time = ('time', da0.date.values[index[0]], {'long_name': 'date', 'units': 'YYYYMMDD'})
+                dsDay = xr.Dataset({varName: (('time',) + spaceDims, dayMean[:nDays].astype('float32')),
+                                    varName + '_min': (('time',) + spaceDims, dayMin[:nDays]),
+                                    varName + '_max': (('time',) + spaceDims, dayMax[:nDays]),
+                                    varName + '_std': (('time',) + spaceDims,
+                                                       np.sqrt(dayM2[:nDays] / nModels).astype('float32'))},
+                                   coords=dict(spaceCoords, time=time))
+                if store is not None:
+                    dsDay = store.toGrid(dsDay)
+                dsDay[varName].attrs = dict(description='Ensemble mean of the daily Degree Heating Week',
+                                            longname='Degree Heating Week', units='degC.week')
+                for stat in ['min', 'max', 'std']:
+                    dsDay[varName + '_' + stat].attrs = dict(description='Ensemble ' + stat + ' of the daily Degree Heating Week',
+                                                             units='degC.week')
+                dsDay.attrs = dict(comment='this ensemble corresponds to the {0} scenario'.format(scenario),
+                                   models=', '.join(os.path.basename(fileName) for fileName in fileList))
+                comp = dict(zlib=True, complevel=5)
+                dsDay.to_netcdf(os.path.join(outDir, scenario + '_ensemble_daily_' + str(yy) + '.nc'),
+                                encoding={var: comp for var in dsDay.data_vars})
+
+    pool.shutdown()
+    for fileName, model in zip(fileList, models):
+        openedModels.pop(fileName, None)
+        model[0].close()
+
+    dhwMax = xr.Dataset({name: (('year',) + spaceDims, values) for name, values in yearly.items()},
+                        coords=dict(spaceCoords, year=years))
+    if store is not None:
+        dhwMax = store.toGrid(dhwMax)
+    dhwMax.DHW.attrs = dict(description='Ensemble maximum value of the Degree Heating Week of the year',
+                            longname='Degree Heating Week', units='degC.week',
+                            comment='this ensemble corresponds to the {0} scenario'.format(scenario))
+    for name in yearly:
+        if name != 'DHW':
+            dhwMax[name].attrs = dict(description='Model spread (' + name.split('_')[1] +
+                                                  ') of the maximum value of the Degree Heating Week of the year',
+                                      units='degC.week')
+    return dhwMax
+
+
+def ensembleQuantiles(fileList, periods, quantiles=(0.05, 0.5, 0.95), varName='DHW', vmax=40.0, binWidth=0.1,
+                      regrid=None, weightsDir=None, prefetch=2):
+    '''
+    Get the percentile bands of the daily DHW across all the models and the days of every period
+    the days are streamed into fixed-bin histograms of the ocean cells (see HistogramQuantiles), one year of one
+    model at a time, so the memory does not grow with the number of models and years
+    :param fileList: list of model daily files of the scenario, or their cell stores
+    :param periods: list of (first year, last year), e.g. decades
+    :param quantiles: quantiles of the bands
+    :param varName: name of the variable. DHW by default
+    :param vmax: upper bound of the histograms. Values above are counted in the last bin
+    :param binWidth: bin width of the histograms, and precision of the quantiles
+    :param regrid: regridding method of the models that are not on the grid of the first one
+    :param weightsDir: cache directory of the regridding weights
+    :param prefetch: number of model years read, regridded and compressed ahead on a background thread, into
+                     reused buffers, while the histograms are updated. Read in turn if 0
+    :return: dataset DHW_qXX [period,lat,lon], period = first year of the period
+    '''
+    models = [openModel(fileName, varName) for fileName in fileList]
+    da0 = models[0][0]
+    store = CellStore(fileList[0]) if da0.dims[1:] == ('cell',) else None
+    mask = store.mask if store is not None else GridMask.fromData(da0)
+    regridders = modelRegridders(models, fileList, regrid, weightsDir)
+
+    bands = np.empty((len(periods), len(quantiles), mask.nCells), dtype='float32')
+
+    def readCells(task, buffer):
+        ## one year of one model, regridded and compressed to the cells of the mask
+        n, yy = task
+        da, bounds, _ = models[n]
+        values = da.isel(time=slice(*bounds[yy])).values
+        if regridders[n] is not None:
+            values = regridders[n].regridValues(values)
+        nDays = values.shape[0]
+        if buffer is None or buffer.dtype != values.dtype:
+            buffer = np.empty((366, mask.nCells), dtype=values.dtype)
+        return mask.compress(values, out=buffer[:nDays]), buffer
+    for ip, (yearStart, yearEnd) in enumerate(periods):
+        histogram = HistogramQuantiles(mask.nCells, vmax=vmax, binWidth=binWidth)
+        tasks = [(n, yy) for n, (_, bounds, _) in enumerate(models) for yy in range(yearStart, yearEnd + 1)
+                 if yy in bounds]
+        for values in Prefetcher(readCells, tasks, depth=prefetch):
+            with stage('fold'):
+                histogram.update(values)
+        with stage('fold'):
+            bands[ip] = histogram.quantiles(quantiles)
+
+    for da, _, _ in models:
+        da.close()
+    latDim, lonDim = mask.dims
+    ds = xr.Dataset({'DHW_' + quantileName(q):
+                         (('period', latDim, lonDim), mask.expand(bands[:, i]),
+                          {'description': 'quantile ' + str(q) + ' of the daily DHW of all the models in the period',
+                           'units': 'degC.week'})
+                     for i, q in enumerate(quantiles)},
+                    coords={'period': [yearStart for yearStart, _ in periods],
+                            latDim: mask.coords[latDim], lonDim: mask.coords[lonDim]})
+    ds.period.attrs = {'long_name': 'first year of the period',
+                       'comment': 'periods: ' + ', '.join('%d-%d' % period for period in periods)}
+    return ds
@@ -0,0 +1,121 @@
+## Functions to write the yearly DHW products as compressed NetCDF or Zarr
+## the chunks are aligned to (1 year, lat tile, lon tile), so a map or a region reads only the chunks it needs
+#
+
+from importlib.util import find_spec
+
+import numpy as np
+
+from .DHWtools import packedFillValue
+from .profTools import profiled
+
+
+def chunkSizes(var, latTile=90, lonTile=90):
+    '''
+    Get the chunk sizes of a variable: one step along the first dimension, lat/lon tiles along the others
+    :param var: data array [time,lat,lon]
+    :param latTile: tile size along the second dimension
+    :param lonTile: tile size along the third dimension
+    :return: tuple of chunk sizes
+    '''
+    if var.ndim < 3:
+        return tuple(min(size, tile) for size, tile in zip(var.shape, (latTile, lonTile)))
+    return (1, min(var.shape[1], latTile), min(var.shape[2], lonTile)) + var.shape[3:]
+
+
+def netcdfEncoding(ds, latTile=90, lonTile=90, complevel=5):
+    '''
+    zlib encoding of all the variables of a dataset, with chunks aligned to one year and lat/lon tiles
+    :param ds: dataset
+    :param latTile: lat tile size
+    :param lonTile: lon tile size
+    :param complevel: zlib compression level
+    :return: encoding dictionary
+    '''
+    return {var: dict(zlib=True, complevel=complevel, chunksizes=chunkSizes(ds[var], latTile, lonTile))
+            for var in ds.data_vars}
+
+
+def zarrEncoding(ds, latTile=90, lonTile=90, clevel=5):
+    '''
+    Blosc/zstd encoding of all the variables of a dataset, with chunks aligned to one year and lat/lon tiles
+    requires zarr
+    :param ds: dataset
+    :param latTile: lat tile size
+    :param lonTile: lon tile size
+    :param clevel: zstd compression level
+    :return: encoding dictionary
+    '''
+    import zarr
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        from zarr.codecs import BloscCodec
+        comp = {'compressors': [BloscCodec(cname='zstd', clevel=clevel, shuffle='bitshuffle')]}
+    else:
+        from numcodecs import Blosc
+        comp = {'compressor': Blosc(cname='zstd', clevel=clevel, shuffle=Blosc.BITSHUFFLE)}
+    return {var: dict(comp, chunks=chunkSizes(ds[var], latTile, lonTile)) for var in ds.data_vars}
+
+
+def packedEncoding(ds):
+    '''
+    int16 encoding of the DHW products: DHW values with scale_factor 0.1,
+    DOY and number of days (int16 in packed mode) with their _FillValue
+    :param ds: dataset, e.g. from compute_yearly_stats with packed=True
+    :return: encoding dictionary
+    '''
+    encoding = {}
+    for var in ds.data_vars:
+        if ds[var].dtype.kind == 'f' and var.startswith('DHW'):
+            encoding[var] = dict(dtype='int16', scale_factor=0.1, _FillValue=np.int16(-32768))
+        elif ds[var].dtype.kind in 'iu':
+            encoding[var] = dict(dtype=ds[var].dtype.name, _FillValue=ds[var].dtype.type(packedFillValue))
+    return encoding
+
+
+def outputName(fileName, format='netcdf'):
+    '''
+    Name of the output for a format: .nc for netcdf, .zarr for zarr
+    :param fileName: output file name
+    :param format: 'netcdf' or 'zarr'
+    :return: file name
+    '''
+    root = fileName[:-3] if fileName.endswith('.nc') else fileName
+    return root + ('.zarr' if format == 'zarr' else '.nc')
+
+
+@profiled('write')
+def writeDataset(ds, fileName, format='netcdf', latTile=90, lonTile=90, packed=False):
+    '''
+    Write a dataset as compressed NetCDF (zlib) or Zarr (Blosc/zstd), chunked by one year and lat/lon tiles
+    Zarr chunks are written in parallel by the dask workers when dask is available
+    :param ds: dataset [time,lat,lon]
+    :param fileName: output file name. The extension is set by the format
+    :param format: 'netcdf' or 'zarr'
+    :param latTile: lat tile size
+    :param lonTile: lon tile size
+    :param packed: store the DHW values as int16 with a scale factor and the DOY and days with a _FillValue,
+                   see packedEncoding
+    :return: name of the output file or store
+    '''
+    fileName = outputName(fileName, format)
+    ds = ds.copy()
+    packing = packedEncoding(ds) if packed else {}
+    if format == 'zarr':
+        encoding = zarrEncoding(ds, latTile, lonTile)
+        for var in packing:
+            encoding[var].update(packing[var])
+        if find_spec('dask') is not None:
+            ## one dask chunk per zarr chunk, so the workers write whole chunks
+            ds = ds.chunk({dim: size for var in ds.data_vars
+                           for dim, size in zip(ds[var].dims, encoding[var]['chunks'])})
+        for var in ds.variables:
+            ds[var].encoding = {}
+        ds.to_zarr(fileName, mode='w', encoding=encoding, consolidated=True)
+    elif format == 'netcdf':
+        encoding = netcdfEncoding(ds, latTile, lonTile)
+        for var in packing:
+            encoding[var].update(packing[var])
+        ds.to_netcdf(fileName, encoding=encoding)
+    else:
+        raise ValueError('unknown output format ' + format)
+    return fileName
@@ -0,0 +1,131 @@
+## Land/reef mask of a model grid, built once per grid and shared by all the metrics
+## the metrics run on the compressed [time,cell] array of the valid cells instead of the whole [time,lat,lon] grid
+#
+
+import xarray as xr
+import numpy as np
+
+
+class GridMask:
+    '''
+    Boolean mask of the valid (ocean or reef) cells of a grid and the flat index of these cells
+    compress() takes the valid cells of a [...,lat,lon] array and expand() puts them back on the grid
+    '''
+
+    def __init__(self, mask, dims=('lat', 'lon'), coords=None):
+        '''
+        :param mask: boolean array [lat,lon], True for the valid cells
+        :param dims: names of the grid dimensions
+        :param coords: dictionary of the grid coordinates
+        '''
+        self.mask = np.asarray(mask, dtype=bool)
+        self.dims = tuple(dims)
+        self.coords = {} if coords is None else dict(coords)
+        self.shape = self.mask.shape
+        self.index = np.flatnonzero(self.mask)
+        self.nCells = len(self.index)
+
+    @classmethod
+    def fromData(cls, da, reef=None):
+        '''
+        Build the mask of a daily series: the cells with a value on the second day are ocean
+        :param da: data array [time,lat,lon]
+        :param reef: optional boolean array [lat,lon] of the reef cells, combined with the ocean mask
+        :return: GridMask
+        '''
+        mask = ~np.isnan(np.asarray(da[1].values))
+        if reef is not None:
+            mask &= np.asarray(reef, dtype=bool)
+        dims = da.dims[1:]
+        return cls(mask, dims=dims, coords={dim: da[dim] for dim in dims if dim in da.coords})
+
+    def matches(self, da):
+        '''
+        Check that a data array is on the grid of the mask
+        :param da: data array [...,lat,lon]
+        :return: bool
+        '''
+        return tuple(da.shape[-2:]) == self.shape
+
+    def compress(self, values, out=None):
+        '''
+        Take the valid cells of an array
+        :param values: numpy or data array [...,lat,lon]
+        :param out: numpy array [...,cell] where to put the cells, e.g. a reused buffer. A new array if None
+        :return: numpy array [...,cell]
+        '''
+        values = np.asarray(values.values if isinstance(values, xr.DataArray) else values)
+        if values.shape[-2:] != self.shape:
+            raise ValueError('array of shape %s is not on the mask grid %s' % (values.shape, self.shape))
+        if out is not None:
+            return np.take(values.reshape(values.shape[:-2] + (-1,)), self.index, axis=-1, out=out)
+        return values.reshape(values.shape[:-2] + (-1,))[..., self.index]
+
+    def expand(self, values, fill=np.nan):
+        '''
+        Put the values of the valid cells back on the grid
+        :param values: numpy array [...,cell]
+        :param fill: value of the masked cells
+        :return: numpy array [...,lat,lon]
+        '''
+        values = np.asarray(values)
+        dtype = np.result_type(values.dtype, np.min_scalar_type(fill)) if np.isnan(fill) else values.dtype
+        out = np.full(values.shape[:-1] + (self.mask.size,), fill, dtype=dtype)
+        out[..., self.index] = values
+        return out.reshape(values.shape[:-1] + self.shape)
+
+    def toDataArray(self, values, name=None, attrs=None, fill=np.nan):
+        '''
+        Put the values of the valid cells back on the grid as a data array
+        :param values: numpy array [cell]
+        :param name: variable name
+        :param attrs: variable attributes
+        :param fill: value of the masked cells
+        :return: data array [lat,lon]
+        '''
+        return xr.DataArray(self.expand(values, fill=fill), dims=self.dims, coords=self.coords,
+                            name=name, attrs={} if attrs is None else attrs)
+
+
+class CellMask:
+    '''
+    Mask of data already compressed to the valid cells [time,cell], e.g. read from a CellStore
+    same interface as GridMask, but compress() takes the values as they are and the results stay on the cells
+    '''
+
+    def __init__(self, nCells, coords=None):
+        '''
+        :param nCells: number of cells
+        :param coords: dictionary of the coordinates along the cell dimension
+        '''
+        self.nCells = nCells
+        self.coords = {} if coords is None else dict(coords)
+
+    @classmethod
+    def fromData(cls, da):
+        '''
+        Build the mask of a compressed series
+        :param da: data array [...,cell]
+        :return: CellMask
+        '''
+        return cls(da.sizes['cell'], coords={name: coord for name, coord in da.coords.items()
+                                             if coord.dims == ('cell',)})
+
+    def matches(self, da):
+        return da.dims[-1] == 'cell' and da.shape[-1] == self.nCells
+
+    def compress(self, values, out=None):
+        values = np.asarray(values.values if isinstance(values, xr.DataArray) else values)
+        if values.shape[-1] != self.nCells:
+            raise ValueError('array of shape %s has not %d cells' % (values.shape, self.nCells))
+        if out is not None:
+            out[...] = values
+            return out
+        return values
+
+    def expand(self, values, fill=np.nan):
+        return np.asarray(values)
+
+    def toDataArray(self, values, name=None, attrs=None, fill=np.nan):
+        return xr.DataArray(values, dims=('cell',), coords=self.coords, name=name,
+                            attrs={} if attrs is None else attrs)
@@ -0,0 +1,177 @@
+## Lightweight instrumentation of the processing stages: time of every stage (read and decode, quantiles,
+## exceedance, expand, write...) and, optionally, its tracemalloc peak of memory
+## the stages cost a flag test when no profile is running
+#
+
+import json
+import time
+import functools
+import tracemalloc
+
+## profile collecting the stages, None when not profiling
+activeProfile = [None]
+
+
+class Profile:
+    '''
+    Time, number of calls and tracemalloc peak of every stage. Stages can be nested, the time of a stage
+    includes the time of the stages inside it
+    '''
+
+    def __init__(self, memory=False):
+        '''
+        :param memory: track the peak of memory allocated by every stage with tracemalloc. Slows down the allocations
+        '''
+        self.memory = memory
+        self.stages = {}
+        self.order = []
+        ## running peaks of the stages being timed
+        self.peaks = []
+        self.start = time.perf_counter()
+        self.wall = None
+
+    def begin(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def end(self):
+        self.wall = time.perf_counter() - self.start
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return self
+
+    def enter(self):
+        if self.memory:
+            ## the peak of the running stages so far, before it is reset for the new one
+            current, peak = tracemalloc.get_traced_memory()
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1], peak)
+            tracemalloc.reset_peak()
+            self.peaks.append(current)
+        return time.perf_counter()
+
+    def exit(self, name, start):
+        seconds = time.perf_counter() - start
+        if name not in self.stages:
+            self.stages[name] = {'calls': 0, 'seconds': 0.0, 'peakBytes': None}
+            self.order.append(name)
+        stage = self.stages[name]
+        stage['calls'] += 1
+        stage['seconds'] += seconds
+        if self.memory:
+            peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+            stage['peakBytes'] = max(stage['peakBytes'] or 0, peak)
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1], peak)
+
+    def report(self):
+        '''
+        Get the stages as a dictionary, for the JSON report
+        :return: dictionary with the wall time and the stages in the order they first ran
+        '''
+        wall = self.wall if self.wall is not None else time.perf_counter() - self.start
+        return {'wall': wall, 'memory': self.memory,
+                'stages': [dict(name=name, **self.stages[name]) for name in self.order]}
+
+    def table(self):
+        '''
+        Get the per-stage breakdown as a text table
+        :return: string
+        '''
+        report = self.report()
+        lines = ['%-22s %7s %10s %7s %10s %10s' % ('stage', 'calls', 'total_s', '%wall', 'mean_ms', 'peak_MB')]
+        for stage in report['stages']:
+            lines.append('%-22s %7d %10.3f %7.1f %10.2f %10s' %
+                         (stage['name'], stage['calls'], stage['seconds'],
+                          100.0 * stage['seconds'] / max(report['wall'], 1e-9),
+                          1e3 * stage['seconds'] / stage['calls'],
+                          '-' if stage['peakBytes'] is None else '%.1f' % (stage['peakBytes'] / 1e6)))
+        lines.append('%-22s %7s %10.3f' % ('wall', '', report['wall']))
+        return '\n'.join(lines)
+
+    def write(self, reportName, **info):
+        '''
+        Write the report as JSON
+        :param reportName: JSON file name
+        :param info: other fields of the report, e.g. the processed file
+        '''
+        with open(reportName, 'w') as f:
+            json.dump(dict(info, **self.report()), f, indent=2)
+
+
+class stage:
+    '''
+    Context manager timing a stage of the active profile. Nothing is done when no profile is running
+    use: with stage('quantile'): ...
+    '''
+    __slots__ = ('name', 'profile', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.profile = activeProfile[0]
+        if self.profile is not None:
+            self.start = self.profile.enter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.exit(self.name, self.start)
+        return False
+
+
+def profiled(name=None):
+    '''
+    Decorator timing every call of a function as a stage of the active profile
+    :param name: stage name. The function name if None
+    :return: decorator
+    '''
+    def decorator(func):
+        stageName = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if activeProfile[0] is None:
+                return func(*args, **kwargs)
+            with stage(stageName):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def startProfile(memory=False):
+    '''
+    Start collecting the stages
+    :param memory: also track the tracemalloc peak of every stage
+    :return: Profile
+    '''
+    activeProfile[0] = Profile(memory=memory).begin()
+    return activeProfile[0]
+
+
+def stopProfile():
+    '''
+    Stop collecting the stages
+    :return: the Profile that was running, or None
+    '''
+    profile = activeProfile[0]
+    activeProfile[0] = None
+    if profile is not None:
+        profile.end()
+    return profile
+
+
+def profileName(outFileName):
+    '''
+    Name of the profile report of an output file
+    :param outFileName: output file or store
+    :return: JSON file name
+    '''
+    root = outFileName.rstrip('/')
+    for ext in ('.nc', '.zarr'):
+        if root.endswith(ext):
+            root = root[:-len(ext)]
+    return root + '.profile.json'
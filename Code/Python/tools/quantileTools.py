@@ -0,0 +1,99 @@
+## Quantiles of daily DHW along time
+## exact: several quantiles at once by selection (np.partition) instead of a full sort
+## approximate: streaming fixed-bin histograms on the bounded DHW range, merged across years and models
+#
+
+import numpy as np
+
+
+def partitionQuantiles(values, quantiles, overwrite=False):
+    '''
+    Get several quantiles along the first axis with a single selection of the order statistics they need
+    same result as np.quantile with the default linear interpolation. The values must not have NaN
+    :param values: numpy array [time,...], e.g. [time,cell]
+    :param quantiles: list of quantiles
+    :param overwrite: partition the values in place instead of a copy
+    :return: numpy array [quantile,...]
+    '''
+    quantiles = np.asarray(quantiles, dtype='float64')
+    n = values.shape[0]
+    position = quantiles * (n - 1)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, n - 1)
+    kth = np.unique(np.concatenate([lower, upper]))
+    if overwrite:
+        values.partition(kth, axis=0)
+        part = values
+    else:
+        part = np.partition(values, kth, axis=0)
+    weight = (position - lower).reshape((-1,) + (1,) * (values.ndim - 1))
+    low = part[lower]
+    return low + weight * (part[upper] - low)
+
+
+class HistogramQuantiles:
+    '''
+    Streaming approximate quantiles along time of every cell, from fixed-bin histograms on [vmin, vmax]
+    the days are added as they are read, by year and by model, and never kept in memory.
+    Values above vmax are counted in the last bin. The quantiles are within one bin width of the
+    inverted CDF quantile of the values (np.quantile method='inverted_cdf')
+    '''
+
+    def __init__(self, nCells, vmin=0.0, vmax=40.0, binWidth=0.1):
+        '''
+        :param nCells: number of cells
+        :param vmin: lower bound of the values
+        :param vmax: upper bound of the histograms
+        :param binWidth: bin width
+        '''
+        self.nCells = nCells
+        self.vmin = vmin
+        self.binWidth = binWidth
+        self.nBins = int(np.ceil((vmax - vmin) / binWidth))
+        self.counts = np.zeros((nCells, self.nBins), dtype='uint32')
+
+    def update(self, values):
+        '''
+        Add days to the histograms. NaN values are not counted
+        :param values: numpy array [time,cell]
+        '''
+        values = np.asarray(values)
+        valid = ~np.isnan(values)
+        bins = ((np.where(valid, values, self.vmin) - self.vmin) / self.binWidth).astype('int64')
+        np.clip(bins, 0, self.nBins - 1, out=bins)
+        ## count by blocks of cells, to bound the size of the bincount
+        block = max(1, (1 << 22) // self.nBins)
+        for start in range(0, self.nCells, block):
+            stop = min(start + block, self.nCells)
+            index = ((np.arange(stop - start) * self.nBins) + bins[:, start:stop])[valid[:, start:stop]]
+            self.counts[start:stop] += np.bincount(index, minlength=(stop - start) * self.nBins).reshape(
+                stop - start, self.nBins).astype('uint32')
+
+    def merge(self, other):
+        '''
+        Add the histograms of another HistogramQuantiles with the same cells and bins, e.g. from another worker
+        :param other: HistogramQuantiles
+        '''
+        if other.counts.shape != self.counts.shape or other.vmin != self.vmin or other.binWidth != self.binWidth:
+            raise ValueError('histograms with different cells or bins')
+        self.counts += other.counts
+
+    def quantiles(self, quantiles):
+        '''
+        Get the quantiles of every cell, interpolated within the bins
+        :param quantiles: list of quantiles
+        :return: numpy array [quantile,cell], NaN for the cells without values
+        '''
+        cumulative = np.cumsum(self.counts, axis=1, dtype='float64')
+        total = cumulative[:, -1]
+        out = np.full((len(quantiles), self.nCells), np.nan)
+        cells = np.arange(self.nCells)
+        for i, q in enumerate(quantiles):
+            target = q * total
+            ## first bin where the cumulative count reaches the target
+            iBin = np.minimum((cumulative < target[:, None]).sum(axis=1), self.nBins - 1)
+            before = np.where(iBin > 0, cumulative[cells, iBin - 1], 0.0)
+            inBin = self.counts[cells, iBin]
+            fraction = np.where(inBin > 0, (target - before) / np.maximum(inBin, 1), 0.0)
+            out[i] = np.where(total > 0, self.vmin + (iBin + fraction) * self.binWidth, np.nan)
+        return out
@@ -0,0 +1,363 @@
+## On-demand queries over the processed DHW products (processNC, ensemble and overview outputs, NetCDF or Zarr)
+## point time series across models, bbox maps and region statistics. The datasets are opened lazily and kept open
+## in an LRU, and the decoded blocks (all the years of a lat/lon tile) are kept in an LRU of bounded size,
+## so a point query reads at most one block per model
+#
+
+import os
+import glob
+import threading
+from collections import OrderedDict
+
+import xarray as xr
+import numpy as np
+
+from .regionTools import regionGrid
+
+## product of the output file name prefixes
+productPrefixes = [('DHW_shifted_', 'shifted'), ('DHW_', 'yearly')]
+
+## lat/lon size of the blocks when the variable is not chunked on disk
+defaultBlock = 64
+
+
+class LRUCache:
+    '''
+    Thread-safe least recently used cache, bounded by the number of items and/or their total size in bytes
+    the evicted items are passed to onEvict, e.g. to close the datasets
+    '''
+
+    def __init__(self, maxItems=None, maxBytes=None, sizeOf=None, onEvict=None):
+        '''
+        :param maxItems: max number of items. Not bounded if None
+        :param maxBytes: max total size of the items. Not bounded if None
+        :param sizeOf: function giving the size of an item in bytes, with maxBytes
+        :param onEvict: function called with every evicted item
+        '''
+        self.maxItems = maxItems
+        self.maxBytes = maxBytes
+        self.sizeOf = sizeOf or (lambda item: getattr(item, 'nbytes', 0))
+        self.onEvict = onEvict
+        self.items = OrderedDict()
+        self.nBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        '''
+        Get an item, loaded with load() and kept if it is not in the cache
+        :param key: hashable key
+        :param load: function without arguments returning the item
+        :return: item
+        '''
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+        item = load()
+        evicted = []
+        with self.lock:
+            if key not in self.items:
+                self.items[key] = item
+                self.nBytes += self.sizeOf(item)
+            while self.items and ((self.maxItems is not None and len(self.items) > self.maxItems) or
+                                  (self.maxBytes is not None and self.nBytes > self.maxBytes and len(self.items) > 1)):
+                oldKey, oldItem = self.items.popitem(last=False)
+                self.nBytes -= self.sizeOf(oldItem)
+                evicted.append(oldItem)
+        if self.onEvict is not None:
+            for oldItem in evicted:
+                self.onEvict(oldItem)
+        return item
+
+    def clear(self):
+        with self.lock:
+            items = list(self.items.values())
+            self.items.clear()
+            self.nBytes = 0
+        if self.onEvict is not None:
+            for item in items:
+                self.onEvict(item)
+
+    def stats(self):
+        return {'items': len(self.items), 'bytes': self.nBytes, 'hits': self.hits, 'misses': self.misses}
+
+
+def productEntry(fileName):
+    '''
+    Get the product, scenario and model of an output file from its name:
+    DHW_<scenario>_<model>_*.nc (processNC), DHW_shifted_<scenario>_<model>_*.nc,
+    <scenario>_ensemble.nc (makeEnsemble), with a _<res>deg suffix for the overview levels
+    :param fileName: file or store name
+    :return: dictionary with product, scenario, model, resolution and path, or None if not a DHW product
+    '''
+    name = os.path.basename(fileName.rstrip('/'))
+    root = os.path.splitext(name)[0]
+    resolution = None
+    if root.endswith('deg') and '_' in root:
+        root, level = root.rsplit('_', 1)
+        resolution = float(level[:-3].replace('p', '.'))
+    for prefix, product in productPrefixes:
+        if root.startswith(prefix):
+            parts = root[len(prefix):].split('_')
+            if len(parts) < 2:
+                return None
+            return {'product': product, 'scenario': parts[0], 'model': parts[1], 'resolution': resolution,
+                    'path': fileName}
+    if root.endswith('_ensemble'):
+        return {'product': 'yearly', 'scenario': root[:-len('_ensemble')], 'model': 'ensemble',
+                'resolution': resolution, 'path': fileName}
+    return None
+
+
+class OpenProduct:
+    '''
+    Product dataset opened lazily, with its coordinates loaded once
+    '''
+
+    def __init__(self, path):
+        '''
+        :param path: NetCDF file or Zarr store
+        '''
+        self.path = path
+        if path.rstrip('/').endswith('.zarr'):
+            self.ds = xr.open_zarr(path, chunks=None, decode_timedelta=False)
+        else:
+            self.ds = xr.open_dataset(path, decode_timedelta=False)
+        var = self.ds[[name for name in self.ds.data_vars if self.ds[name].ndim == 3][0]]
+        self.timeDim, self.latDim, self.lonDim = var.dims
+        self.time = self.ds[self.timeDim].values
+        self.lat = self.ds[self.latDim].values
+        self.lon = self.ds[self.lonDim].values
+
+    def close(self):
+        self.ds.close()
+
+    def nearest(self, lat, lon):
+        '''
+        Get the grid cell nearest to a position
+        :param lat: latitude
+        :param lon: longitude, -180..180 or 0..360
+        :return: lat index, lon index
+        '''
+        iLat = int(np.abs(self.lat - lat).argmin())
+        iLon = int(np.abs((self.lon - lon + 180.0) % 360.0 - 180.0).argmin())
+        return iLat, iLon
+
+    def blockShape(self, varName):
+        '''
+        Get the lat/lon size of the blocks of a variable: its chunks on disk, or defaultBlock
+        :param varName: variable name
+        :return: lat size, lon size
+        '''
+        encoding = self.ds[varName].encoding
+        chunks = encoding.get('chunksizes') or encoding.get('chunks') or encoding.get('preferred_chunks')
+        if isinstance(chunks, dict):
+            chunks = tuple(chunks.get(dim, defaultBlock) for dim in self.ds[varName].dims)
+        if chunks is None or len(chunks) != 3:
+            return defaultBlock, defaultBlock
+        return int(chunks[1]), int(chunks[2])
+
+
+class ProductStore:
+    '''
+    Queries over the DHW products of a directory tree
+    the catalog comes from the file names, the datasets are opened on the first query and kept in an LRU of open
+    datasets (their file handles are pooled by xarray), and the blocks read are kept in an LRU of decoded blocks
+    '''
+
+    def __init__(self, root, maxDatasets=32, maxBytes=512e6, regions=None, cacheDir=None):
+        '''
+        :param root: directory of the products, searched recursively
+        :param maxDatasets: max number of open datasets
+        :param maxBytes: max size of the decoded blocks in memory
+        :param regions: shapefile of the regions of the region queries. No region queries if None
+        :param cacheDir: cache directory of the region grids
+        '''
+        self.root = root
+        self.regions = regions
+        self.cacheDir = cacheDir
+        self.entries = None
+        self.datasets = LRUCache(maxItems=maxDatasets, onEvict=lambda product: product.close())
+        self.blocks = LRUCache(maxBytes=maxBytes, sizeOf=lambda block: block[0].nbytes)
+        self.regionGrids = LRUCache(maxItems=16)
+        ## xarray keeps the file handles of the open datasets in its own LRU
+        xr.set_options(file_cache_maxsize=max(maxDatasets, 8))
+
+    def catalog(self, refresh=False):
+        '''
+        Get the products of the directory tree
+        :param refresh: scan the directory again
+        :return: list of dictionaries with product, scenario, model, resolution and path
+        '''
+        if self.entries is None or refresh:
+            paths = glob.glob(os.path.join(self.root, '**', '*.nc'), recursive=True) + \
+                    glob.glob(os.path.join(self.root, '**', '*.zarr'), recursive=True)
+            entries = [productEntry(path) for path in sorted(paths)]
+            self.entries = [entry for entry in entries if entry is not None]
+        return self.entries
+
+    def find(self, scenario, product='yearly', models=None, resolution=None):
+        '''
+        Get the products of a scenario
+        :param scenario: scenario name
+        :param product: 'yearly' or 'shifted'
+        :param models: list of model names. All the models, with the ensemble, if None
+        :param resolution: overview resolution in degrees. The native grid if None
+        :return: list of catalog entries
+        '''
+        entries = [entry for entry in self.catalog() if entry['scenario'] == scenario and
+                   entry['product'] == product and entry['resolution'] == resolution and
+                   (models is None or entry['model'] in models)]
+        if not entries:
+            raise KeyError('no %s product for scenario %s' % (product, scenario))
+        return entries
+
+    def open(self, path):
+        '''
+        Get an open product, from the LRU of open datasets
+        :param path: file or store
+        :return: OpenProduct
+        '''
+        return self.datasets.get(path, lambda: OpenProduct(path))
+
+    def block(self, product, varName, iLat, iLon):
+        '''
+        Get the decoded block of all the times of the lat/lon tile holding a cell, from the LRU of blocks
+        :param product: OpenProduct
+        :param varName: variable name
+        :param iLat: lat index of the cell
+        :param iLon: lon index of the cell
+        :return: numpy array [time,lat,lon], lat index and lon index of the first cell of the block
+        '''
+        latSize, lonSize = product.blockShape(varName)
+        lat0 = iLat // latSize * latSize
+        lon0 = iLon // lonSize * lonSize
+
+        def load():
+            var = product.ds[varName]
+            values = var.isel({product.latDim: slice(lat0, lat0 + latSize),
+                               product.lonDim: slice(lon0, lon0 + lonSize)}).values
+            return values, lat0, lon0
+        return self.blocks.get((product.path, varName, lat0, lon0), load)
+
+    def point(self, scenario, varName, lat, lon, product='yearly', models=None, years=None, resolution=None):
+        '''
+        Time series of a variable at the grid cell nearest to a position, for every model of a scenario
+        :param scenario: scenario name
+        :param varName: variable name, e.g. DHW_max
+        :param lat: latitude
+        :param lon: longitude
+        :param product: 'yearly' or 'shifted'
+        :param models: list of model names. All if None
+        :param years: (first year, last year). All if None
+        :param resolution: overview resolution. The native grid if None
+        :return: dictionary with the series of every model and the cell of every model
+        '''
+        out = {'scenario': scenario, 'variable': varName, 'lat': lat, 'lon': lon, 'models': {}}
+        for entry in self.find(scenario, product, models, resolution):
+            opened = self.open(entry['path'])
+            if varName not in opened.ds.data_vars:
+                continue
+            iLat, iLon = opened.nearest(lat, lon)
+            values, lat0, lon0 = self.block(opened, varName, iLat, iLon)
+            series = values[:, iLat - lat0, iLon - lon0]
+            time = opened.time
+            if years is not None:
+                keep = (time >= years[0]) & (time <= years[1])
+                time, series = time[keep], series[keep]
+            out['models'][entry['model']] = {'cellLat': float(opened.lat[iLat]), 'cellLon': float(opened.lon[iLon]),
+                                             'time': time.tolist(), 'values': jsonValues(series)}
+        return out
+
+    def bbox(self, scenario, model, varName, latRange, lonRange, year=None, product='yearly', resolution=None):
+        '''
+        Map of a variable in a lat/lon box, for a year or all the years
+        :param scenario: scenario name
+        :param model: model name, or ensemble
+        :param varName: variable name
+        :param latRange: (min, max) latitude
+        :param lonRange: (min, max) longitude, in the convention of the product
+        :param year: year. All the years if None
+        :param product: 'yearly' or 'shifted'
+        :param resolution: overview resolution. The native grid if None
+        :return: dictionary with the lat, lon, time and values [time,lat,lon] or [lat,lon]
+        '''
+        entry = self.find(scenario, product, [model], resolution)[0]
+        opened = self.open(entry['path'])
+        iLat = np.nonzero((opened.lat >= latRange[0]) & (opened.lat <= latRange[1]))[0]
+        iLon = np.nonzero((opened.lon >= lonRange[0]) & (opened.lon <= lonRange[1]))[0]
+        if len(iLat) == 0 or len(iLon) == 0:
+            raise ValueError('empty box')
+        box = {opened.latDim: slice(iLat[0], iLat[-1] + 1), opened.lonDim: slice(iLon[0], iLon[-1] + 1)}
+        if year is not None:
+            box[opened.timeDim] = int(np.nonzero(opened.time == year)[0][0]) if np.any(opened.time == year) else None
+            if box[opened.timeDim] is None:
+                raise KeyError('year %s not in the product' % year)
+        values = opened.ds[varName].isel(box).values
+        return {'scenario': scenario, 'model': model, 'variable': varName,
+                'lat': opened.lat[box[opened.latDim]].tolist(), 'lon': opened.lon[box[opened.lonDim]].tolist(),
+                'time': year if year is not None else opened.time.tolist(), 'values': jsonValues(values)}
+
+    def region(self, scenario, varName, region, product='yearly', models=None, years=None, resolution=None):
+        '''
+        Mean and max of a variable over the cells of a region, by year, for every model of a scenario
+        :param scenario: scenario name
+        :param varName: variable name
+        :param region: region name, as in clipIPCC (IPCC-XXX)
+        :param product: 'yearly' or 'shifted'
+        :param models: list of model names. All if None
+        :param years: (first year, last year). All if None
+        :param resolution: overview resolution. The native grid if None
+        :return: dictionary with the mean and max series of every model
+        '''
+        if self.regions is None:
+            raise ValueError('no region shapefile')
+        out = {'scenario': scenario, 'variable': varName, 'region': region, 'models': {}}
+        for entry in self.find(scenario, product, models, resolution):
+            opened = self.open(entry['path'])
+            if varName not in opened.ds.data_vars:
+                continue
+            grid, names = self.regionGrids.get((opened.lat.tobytes(), opened.lon.tobytes()), lambda: regionGrid(
+                self.regions, opened.lat, opened.lon, cacheDir=self.cacheDir))
+            if region not in names:
+                raise KeyError('unknown region ' + region)
+            inside = grid == names.index(region)
+            iLat = np.nonzero(inside.any(axis=1))[0]
+            iLon = np.nonzero(inside.any(axis=0))[0]
+            if len(iLat) == 0:
+                continue
+            box = (slice(iLat[0], iLat[-1] + 1), slice(iLon[0], iLon[-1] + 1))
+            values = opened.ds[varName].isel({opened.latDim: box[0], opened.lonDim: box[1]}).values
+            values = values[:, inside[box]]
+            time = opened.time
+            if years is not None:
+                keep = (time >= years[0]) & (time <= years[1])
+                time, values = time[keep], values[keep]
+            valid = ~np.isnan(values)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.where(valid.any(axis=1), np.nansum(values, axis=1) / valid.sum(axis=1), np.nan)
+            maxVal = np.where(valid.any(axis=1), np.nanmax(np.where(valid, values, -np.inf), axis=1), np.nan)
+            out['models'][entry['model']] = {'time': time.tolist(), 'mean': jsonValues(mean),
+                                             'max': jsonValues(maxVal), 'nCells': int(inside.sum())}
+        return out
+
+    def stats(self):
+        return {'datasets': self.datasets.stats(), 'blocks': self.blocks.stats()}
+
+    def close(self):
+        self.datasets.clear()
+        self.blocks.clear()
+
+
+def jsonValues(values):
+    '''
+    Convert an array to nested lists for JSON, NaN as None
+    :param values: numpy array
+    :return: list, or float for a scalar
+    '''
+    values = np.asarray(values, dtype='float64')
+    return np.where(np.isnan(values), None, np.round(values, 4).astype(object)).tolist()
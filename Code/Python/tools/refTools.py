@@ -0,0 +1,119 @@
+## Reference day of the year (the climatological coldest DOY, SSTmin_doy) of the relative DOY metrics
+## the climatology is loaded once, checked against the model grid, flipped or reindexed if needed,
+## and the aligned reference is kept for every grid it is used on
+#
+
+import xarray as xr
+import numpy as np
+
+from .regionTools import gridSignature
+
+## references loaded by each process: (file name, variable name) -> ReferenceDOY
+openedReferences = {}
+
+
+class ReferenceDOY:
+    '''
+    Reference DOY field [lat,lon] aligned once per model grid:
+    used as is when its coordinates are the ones of the grid, flipped when the latitudes are in the opposite order,
+    and reindexed to the nearest cell (within half a cell, longitudes modulo 360) otherwise
+    '''
+
+    def __init__(self, ref):
+        '''
+        :param ref: data array of the reference DOY [lat,lon]
+        '''
+        self.ref = ref
+        ## aligned reference of every grid signature, and compressed reference of every mask
+        self.aligned = {}
+        self.compressed = {}
+
+    @classmethod
+    def fromFile(cls, fileName, varName='SSTmin_doy'):
+        '''
+        Load the reference of a climatology file, once per process
+        :param fileName: climatology file
+        :param varName: variable of the reference DOY
+        :return: ReferenceDOY
+        '''
+        key = (fileName, varName)
+        if key not in openedReferences:
+            with xr.open_dataset(fileName) as nc:
+                openedReferences[key] = cls(nc[varName].load())
+        return openedReferences[key]
+
+    @classmethod
+    def fromData(cls, ref):
+        '''
+        Get a ReferenceDOY from a data array, or the ReferenceDOY itself
+        :param ref: data array [lat,lon], numpy array used by position, or ReferenceDOY
+        :return: ReferenceDOY
+        '''
+        if isinstance(ref, cls):
+            return ref
+        if not isinstance(ref, xr.DataArray):
+            ref = xr.DataArray(np.asarray(ref), dims=('lat', 'lon'))
+        return cls(ref)
+
+    def align(self, target):
+        '''
+        Get the reference on the grid of a data array, aligned the first time the grid is seen
+        :param target: data array [...,lat,lon]
+        :return: data array [lat,lon] with the coordinates of the target
+        '''
+        latDim, lonDim = target.dims[-2:]
+        lat = target[latDim].values if latDim in target.coords else np.arange(target.shape[-2])
+        lon = target[lonDim].values if lonDim in target.coords else np.arange(target.shape[-1])
+        key = gridSignature(lat, lon)
+        if key not in self.aligned:
+            values = self.alignValues(lat, lon)
+            self.aligned[key] = xr.DataArray(values, dims=(latDim, lonDim),
+                                             coords={latDim: target[latDim], lonDim: target[lonDim]}
+                                             if latDim in target.coords and lonDim in target.coords else None,
+                                             name=self.ref.name, attrs=self.ref.attrs)
+        return self.aligned[key]
+
+    def alignValues(self, lat, lon):
+        '''
+        Align the reference to a lat/lon grid
+        :param lat: latitudes of the grid
+        :param lon: longitudes of the grid
+        :return: numpy array [lat,lon]
+        '''
+        ref = self.ref
+        refLatDim, refLonDim = ref.dims[-2:]
+        sameShape = ref.shape[-2:] == (len(lat), len(lon))
+        if refLatDim not in ref.coords or refLonDim not in ref.coords:
+            if not sameShape:
+                raise ValueError('reference without coordinates and of shape %s on a grid of shape %s' %
+                                 (ref.shape, (len(lat), len(lon))))
+            return ref.values
+
+        refLat = ref[refLatDim].values
+        refLon = ref[refLonDim].values
+        if sameShape and np.allclose(refLon, lon):
+            if np.allclose(refLat, lat):
+                return ref.values
+            if np.allclose(refLat[::-1], lat):
+                return ref.values[::-1]
+
+        ## reindex to the nearest cell, with the longitudes in the range of the grid
+        halfCell = max(np.abs(np.diff(lat)).max() if len(lat) > 1 else 0.5,
+                       np.abs(np.diff(lon)).max() if len(lon) > 1 else 0.5) / 2.0
+        ref = ref.assign_coords({refLonDim: (refLon - lon.min()) % 360.0 + lon.min()}).sortby(refLonDim).sortby(refLatDim)
+        values = ref.reindex({refLatDim: lat, refLonDim: lon}, method='nearest', tolerance=halfCell).values
+        if np.all(np.isnan(values)):
+            raise ValueError('reference grid does not overlap the model grid')
+        return values
+
+    def cells(self, target, mask):
+        '''
+        Get the reference of the cells of a mask, aligned and compressed once per grid and mask
+        :param target: data array [...,lat,lon] on the grid of the mask
+        :param mask: GridMask of the target
+        :return: numpy array [cell]
+        '''
+        key = id(mask)
+        if key not in self.compressed or self.compressed[key][0] is not mask:
+            self.compressed[key] = (mask, mask.compress(self.align(target).values))
+        return self.compressed[key][1]
@@ -0,0 +1,295 @@
+## Functions to clip and summarise DHW products by regions, e.g. the IPCC coral regions
+## the region polygons are rasterized once into an integer region-id grid of the model grid, cached on disk,
+## and every clip or statistic is a slice and a mask of that grid
+#
+
+import os
+import hashlib
+
+import xarray as xr
+import numpy as np
+import pandas as pd
+
+from .DHWtools import thresholdName, quantileName
+
+
+def gridSignature(lat, lon):
+    '''
+    Get a signature of a lat/lon grid
+    :param lat: latitudes
+    :param lon: longitudes
+    :return: hex string
+    '''
+    lat = np.ascontiguousarray(np.asarray(lat, dtype='float64'))
+    lon = np.ascontiguousarray(np.asarray(lon, dtype='float64'))
+    return hashlib.sha1(lat.tobytes() + b'|' + lon.tobytes()).hexdigest()
+
+
+def shapeSignature(shapeFile):
+    '''
+    Get a signature of the content of a shapefile and its companion files
+    :param shapeFile: .shp file name
+    :return: hex string
+    '''
+    sha = hashlib.sha1()
+    root = os.path.splitext(shapeFile)[0]
+    for ext in ['.shp', '.shx', '.dbf', '.prj']:
+        if os.path.exists(root + ext):
+            with open(root + ext, 'rb') as f:
+                sha.update(f.read())
+    return sha.hexdigest()
+
+
+def regionNames(ipcc, nameField='Acronym', prefix='IPCC-'):
+    '''
+    Names of the exploded polygons, as in the clipped file names: a second polygon of the same region gets "-1"
+    :param ipcc: geodataframe of exploded polygons
+    :param nameField: field with the region acronym
+    :param prefix: prefix of the names
+    :return: list of names
+    '''
+    names = []
+    oldAcronym = ""
+    for acronym in ipcc[nameField]:
+        name = acronym + "-1" if acronym == oldAcronym else acronym
+        names.append(prefix + name)
+        oldAcronym = acronym
+    return names
+
+
+def rasterizeRegions(geometries, lat, lon):
+    '''
+    Rasterize polygons into a region-id grid. A cell belongs to a polygon if its centre is inside it,
+    as in rio.clip. Polygons later in the list win where they overlap
+    requires shapely 2
+    :param geometries: list of shapely polygons in lon/lat
+    :param lat: latitudes of the grid
+    :param lon: longitudes of the grid, -180..180 or 0..360
+    :return: numpy array int16 [lat,lon], region index or -1 outside all the regions
+    '''
+    import shapely
+
+    lat = np.asarray(lat)
+    ## polygons are in -180..180
+    lon = (np.asarray(lon) + 180.0) % 360.0 - 180.0
+    grid = np.full((len(lat), len(lon)), -1, dtype='int16')
+    for region, geometry in enumerate(geometries):
+        ## test only the cells in the bounding box of the polygon
+        lonMin, latMin, lonMax, latMax = geometry.bounds
+        iLat = np.nonzero((lat >= latMin) & (lat <= latMax))[0]
+        iLon = np.nonzero((lon >= lonMin) & (lon <= lonMax))[0]
+        if len(iLat) == 0 or len(iLon) == 0:
+            continue
+        lon2d, lat2d = np.meshgrid(lon[iLon], lat[iLat])
+        inside = shapely.contains_xy(geometry, lon2d, lat2d)
+        grid[np.ix_(iLat, iLon)] = np.where(inside, region, grid[np.ix_(iLat, iLon)])
+    return grid
+
+
+def regionGrid(shapeFile, lat, lon, cacheDir=None, nameField='Acronym'):
+    '''
+    Get the region-id grid of the exploded polygons of a shapefile on a lat/lon grid
+    the grid is cached in cacheDir, keyed by the grid signature and the shapefile signature
+    requires geopandas
+    :param shapeFile: shapefile of the regions
+    :param lat: latitudes of the grid
+    :param lon: longitudes of the grid
+    :param cacheDir: cache directory. No cache if None
+    :param nameField: field with the region acronym
+    :return: numpy array int16 [lat,lon] with the region index or -1, list of region names
+    '''
+    if cacheDir is not None:
+        cacheFile = os.path.join(cacheDir, 'regions_' + hashlib.sha1(
+            (gridSignature(lat, lon) + shapeSignature(shapeFile) + nameField).encode()).hexdigest() + '.npz')
+        if os.path.exists(cacheFile):
+            cached = np.load(cacheFile)
+            return cached['grid'], [str(name) for name in cached['names']]
+
+    import geopandas
+    ipcc = geopandas.read_file(shapeFile).explode(ignore_index=True)
+    grid = rasterizeRegions(list(ipcc.geometry), lat, lon)
+    names = regionNames(ipcc, nameField)
+
+    if cacheDir is not None:
+        os.makedirs(cacheDir, exist_ok=True)
+        np.savez(cacheFile, grid=grid, names=np.array(names))
+    return grid, names
+
+
+def clipRegion(nc, grid, region):
+    '''
+    Clip a dataset or data array to a region: slice of the bounding box of the region, masked outside it
+    :param nc: xarray dataset or data array [...,lat,lon], on the grid of the region grid
+    :param grid: region-id grid [lat,lon]
+    :param region: region index
+    :return: clipped dataset or data array, or None if the region has no cell in the grid
+    '''
+    inside = grid == region
+    iLat = np.nonzero(inside.any(axis=1))[0]
+    iLon = np.nonzero(inside.any(axis=0))[0]
+    if len(iLat) == 0:
+        return None
+    dims = nc.dims if isinstance(nc, xr.DataArray) else nc[list(nc.data_vars)[0]].dims
+    latDim, lonDim = dims[-2:]
+    box = {latDim: slice(iLat[0], iLat[-1] + 1), lonDim: slice(iLon[0], iLon[-1] + 1)}
+    mask = xr.DataArray(inside[box[latDim], box[lonDim]], dims=(latDim, lonDim))
+    return nc.isel(box).where(mask)
+
+
+def regionSegments(grid):
+    '''
+    Sort the cells of the region grid by region
+    :param grid: region-id grid [lat,lon]
+    :return: flat index of the region cells sorted by region, region ids, start and stop of each region in the cells
+    '''
+    flatGrid = grid.ravel()
+    cells = np.nonzero(flatGrid >= 0)[0]
+    cells = cells[np.argsort(flatGrid[cells], kind='stable')]
+    regions, start = np.unique(flatGrid[cells], return_index=True)
+    stop = np.append(start[1:], len(cells))
+    return cells, regions, start, stop
+
+
+def regionStats(da, grid, names, quantiles=(0.1, 0.5, 0.9)):
+    '''
+    Statistics of a variable in every region and year in one pass: mean, max and quantiles over the region cells
+    the cells are sorted by region once and every statistic is a reduction over the region segments
+    :param da: data array [time,lat,lon], e.g. DHW_max
+    :param grid: region-id grid [lat,lon]
+    :param names: region names, by region index
+    :param quantiles: quantiles
+    :return: dataset [region,time] with var_mean, var_max and var_qXX
+    '''
+    cells, regions, start, stop = regionSegments(grid)
+
+    values = da.values.reshape(da.shape[0], -1)[:, cells]
+    valid = ~np.isnan(values)
+    nValid = np.add.reduceat(valid, start, axis=1)
+    sums = np.add.reduceat(np.where(valid, values, 0.0), start, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(nValid > 0, sums / nValid, np.nan)
+    maxVal = np.fmax.reduceat(values, start, axis=1)
+
+    quant = np.full((len(quantiles),) + mean.shape, np.nan)
+    for i, (i0, i1) in enumerate(zip(start, stop)):
+        segment = values[:, i0:i1]
+        hasValues = valid[:, i0:i1].any(axis=1)
+        if hasValues.any():
+            quant[:, hasValues, i] = np.nanquantile(segment[hasValues], quantiles, axis=1)
+
+    name = da.name
+    coords = {'region': [names[r] for r in regions], 'time': da[da.dims[0]].values}
+    ds = xr.Dataset({name + '_mean': (('region', 'time'), mean.T),
+                     name + '_max': (('region', 'time'), maxVal.T)},
+                    coords=coords)
+    for q, values in zip(quantiles, quant):
+        ds[name + '_q' + str(q).split(".")[1]] = (('region', 'time'), values.T)
+    for var in ds.data_vars:
+        ds[var].attrs = {'long_name': var.split('_')[-1] + ' of ' + name + ' in the region',
+                         'units': da.attrs.get('units', '')}
+    ds['nCells'] = ('region', (stop - start).astype('int32'))
+    return ds
+
+
+## default statistics of zonal_stats: (variable, statistic, parameter)
+zonalStatsDefault = [('DHW_max', 'mean'),
+                     ('DHW_max', 'frac_above', 4),
+                     ('DHW_max', 'frac_above', 8),
+                     ('DoY_DHW4', 'median')]
+
+
+def weightedQuantile(values, weights, q):
+    '''
+    Weighted quantile along the cells, ignoring NaN. Takes the first value where the cumulative weight reaches q
+    :param values: numpy array [time,cells]
+    :param weights: numpy array [cells]
+    :param q: quantile
+    :return: numpy array [time]
+    '''
+    order = np.argsort(values, axis=1)
+    sortedValues = np.take_along_axis(values, order, axis=1)
+    cumWeights = np.cumsum(np.where(np.isnan(sortedValues), 0.0, weights[order]), axis=1)
+    total = cumWeights[:, -1]
+    index = np.minimum((cumWeights < q * total[:, None]).sum(axis=1), values.shape[1] - 1)
+    result = sortedValues[np.arange(values.shape[0]), index]
+    return np.where(total > 0, result, np.nan)
+
+
+def zonal_stats(ds, region_grid, stats=None, names=None):
+    '''
+    Area weighted statistics of yearly variables for every region and year, as a tidy table
+    the cells are weighted by cos(lat) and the cells with NaN are left out. Statistics:
+    ('var', 'mean'), ('var', 'min'), ('var', 'max'), ('var', 'median'), ('var', 'quantile', q)
+    and ('var', 'frac_above', threshold): fraction of the region area with var > threshold
+    :param ds: dataset of yearly variables [time,lat,lon], e.g. a processNC output
+    :param region_grid: region-id grid [lat,lon], see regionGrid
+    :param stats: list of (variable, statistic[, parameter]). zonalStatsDefault if None
+    :param names: region names, by region index. The region index if None
+    :return: pandas dataframe with columns region, year, variable, statistic, value
+    '''
+    if stats is None:
+        stats = zonalStatsDefault
+    cells, regions, start, stop = regionSegments(region_grid)
+    regionLabels = np.array([names[r] for r in regions] if names is not None else regions)
+
+    firstVar = ds[stats[0][0]]
+    timeDim, latDim = firstVar.dims[0], firstVar.dims[-2]
+    years = ds[timeDim].values
+    lat = ds[latDim].values
+    weights = np.broadcast_to(np.cos(np.deg2rad(lat))[:, None], region_grid.shape).ravel()[cells]
+
+    flatValues = {}
+    frames = []
+    for stat in stats:
+        var, kind = stat[0], stat[1]
+        param = stat[2] if len(stat) > 2 else None
+        if var not in flatValues:
+            flatValues[var] = ds[var].values.reshape(len(years), -1)[:, cells]
+        values = flatValues[var]
+        valid = ~np.isnan(values)
+        validWeights = np.where(valid, weights, 0.0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if kind == 'mean':
+                result = (np.add.reduceat(np.where(valid, values, 0.0) * weights, start, axis=1) /
+                          np.add.reduceat(validWeights, start, axis=1))
+            elif kind == 'frac_above':
+                result = (np.add.reduceat(np.where(values > param, validWeights, 0.0), start, axis=1) /
+                          np.add.reduceat(validWeights, start, axis=1))
+            elif kind == 'max':
+                result = np.fmax.reduceat(values, start, axis=1)
+            elif kind == 'min':
+                result = np.fmin.reduceat(values, start, axis=1)
+            elif kind in ('median', 'quantile'):
+                q = 0.5 if kind == 'median' else param
+                result = np.stack([weightedQuantile(values[:, i0:i1], weights[i0:i1], q)
+                                   for i0, i1 in zip(start, stop)], axis=1)
+            else:
+                raise ValueError('unknown statistic ' + kind)
+
+        if kind == 'frac_above':
+            statName = kind + '_' + thresholdName(param)
+        elif kind == 'quantile':
+            statName = quantileName(param)
+        else:
+            statName = kind
+        frames.append(pd.DataFrame({'region': np.tile(regionLabels, len(years)),
+                                    'year': np.repeat(years, len(regions)),
+                                    'variable': var,
+                                    'statistic': statName,
+                                    'value': result.ravel()}))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def writeTable(df, fileName):
+    '''
+    Write a table as Parquet if the file name ends with .parquet, as CSV otherwise
+    Parquet requires pyarrow or fastparquet
+    :param df: pandas dataframe
+    :param fileName: output file name
+    '''
+    if fileName.endswith('.parquet'):
+        df.to_parquet(fileName, index=False)
+    else:
+        df.to_csv(fileName, index=False)
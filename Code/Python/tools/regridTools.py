@@ -0,0 +1,357 @@
+## Regridding of DHW[...,lat,lon] fields between model grids with sparse weight matrices
+## the weights of a (source grid, target grid, method) are built once and cached on disk, then regridding is one
+## sparse matrix product over the [cell,time] array. Also the coarsened overview levels (0.5, 1, 2 degrees)
+## requires scipy
+#
+
+import os
+import hashlib
+
+import xarray as xr
+import numpy as np
+
+from .regionTools import gridSignature
+
+## weight matrices loaded by each process: cache key -> sparse matrix [target cell,source cell]
+loadedWeights = {}
+
+## resolutions of the overview levels, in degrees
+overviewResolutions = (0.5, 1.0, 2.0)
+
+
+def isGlobal(lon):
+    '''
+    Check if the longitudes of a regular grid go around the globe
+    :param lon: longitudes
+    :return: bool
+    '''
+    if len(lon) < 2:
+        return False
+    step = np.abs(np.diff(lon)).mean()
+    return abs(step * len(lon) - 360.0) < step / 2.0
+
+
+def cellEdges(centres, clip=None):
+    '''
+    Get the edges of the cells from their centres, half way between the centres
+    :param centres: cell centres, increasing or decreasing
+    :param clip: (min, max) of the edges, e.g. (-90, 90) for the latitudes
+    :return: numpy array of len(centres) + 1 edges
+    '''
+    centres = np.asarray(centres, dtype='float64')
+    if len(centres) == 1:
+        edges = centres + np.array([-0.5, 0.5])
+    else:
+        middle = (centres[1:] + centres[:-1]) / 2.0
+        edges = np.concatenate([[2 * centres[0] - middle[0]], middle, [2 * centres[-1] - middle[-1]]])
+    if clip is not None:
+        edges = np.clip(edges, *clip)
+    return edges
+
+
+def overlapWeights(srcEdges, dstEdges, periodic=False):
+    '''
+    Fraction of every target cell covered by every source cell along one axis
+    :param srcEdges: source cell edges
+    :param dstEdges: target cell edges
+    :param periodic: longitudes, the cells also overlap 360 degrees apart
+    :return: numpy array [target,source]
+    '''
+    srcLow = np.minimum(srcEdges[:-1], srcEdges[1:])
+    srcHigh = np.maximum(srcEdges[:-1], srcEdges[1:])
+    dstLow = np.minimum(dstEdges[:-1], dstEdges[1:])[:, None]
+    dstHigh = np.maximum(dstEdges[:-1], dstEdges[1:])[:, None]
+    overlap = np.zeros((len(dstLow), len(srcLow)))
+    for shift in ((-360.0, 0.0, 360.0) if periodic else (0.0,)):
+        overlap += np.clip(np.minimum(dstHigh, srcHigh + shift) - np.maximum(dstLow, srcLow + shift), 0.0, None)
+    return overlap / np.maximum(dstHigh - dstLow, 1e-12)
+
+
+def conservativeWeights(srcLat, srcLon, dstLat, dstLon):
+    '''
+    First order conservative weights: area fraction of every target cell covered by every source cell
+    the latitude overlaps are taken in sin(latitude), proportional to the area on the sphere
+    :param srcLat: source latitudes
+    :param srcLon: source longitudes
+    :param dstLat: target latitudes
+    :param dstLon: target longitudes
+    :return: scipy.sparse csr matrix [target cell,source cell], rows sum to the covered fraction of the target cell
+    '''
+    import scipy.sparse
+
+    latWeights = overlapWeights(np.sin(np.deg2rad(cellEdges(srcLat, (-90.0, 90.0)))),
+                                np.sin(np.deg2rad(cellEdges(dstLat, (-90.0, 90.0)))))
+    lonWeights = overlapWeights(cellEdges(srcLon), cellEdges(dstLon), periodic=True)
+    ## the grid weights are the outer product of the axis weights, flattened as [lat,lon]
+    return scipy.sparse.kron(scipy.sparse.csr_matrix(latWeights), scipy.sparse.csr_matrix(lonWeights), format='csr')
+
+
+def linearWeights(src, dst, periodic=False):
+    '''
+    Linear interpolation along one axis: the two source cells around every target cell and the weight of the second
+    targets beyond the first or last source centre take the nearest cell, up to half a cell away
+    :param src: source centres
+    :param dst: target centres
+    :param periodic: longitudes around the globe, the last cell is followed by the first one
+    :return: first and second source index, weight of the second, target inside the source grid [target]
+    '''
+    src = np.asarray(src, dtype='float64')
+    dst = np.asarray(dst, dtype='float64')
+    order = np.argsort(src)
+    sortedSrc = src[order]
+    if periodic:
+        dst = sortedSrc[0] + (dst - sortedSrc[0]) % 360.0
+        sortedSrc = np.append(sortedSrc, sortedSrc[0] + 360.0)
+        order = np.append(order, order[0])
+    elif len(src) > 1 and sortedSrc[-1] - sortedSrc[0] < 360.0:
+        ## longitudes of a regional grid, in the range of the source
+        dst = np.where(np.abs(dst - 360.0 - sortedSrc.mean()) < np.abs(dst - sortedSrc.mean()), dst - 360.0, dst)
+        dst = np.where(np.abs(dst + 360.0 - sortedSrc.mean()) < np.abs(dst - sortedSrc.mean()), dst + 360.0, dst)
+    if len(sortedSrc) == 1:
+        zeros = np.zeros(len(dst), dtype='int64')
+        return order[zeros], order[zeros], np.zeros(len(dst)), np.ones(len(dst), dtype=bool)
+
+    halfCell = np.abs(np.diff(sortedSrc)).max() / 2.0
+    i = np.clip(np.searchsorted(sortedSrc, dst, side='right') - 1, 0, len(sortedSrc) - 2)
+    weight = np.clip((dst - sortedSrc[i]) / (sortedSrc[i + 1] - sortedSrc[i]), 0.0, 1.0)
+    inside = (dst >= sortedSrc[0] - halfCell) & (dst <= sortedSrc[-1] + halfCell)
+    return order[i], order[i + 1], weight, inside
+
+
+def bilinearWeights(srcLat, srcLon, dstLat, dstLon):
+    '''
+    Bilinear interpolation weights from the four source cells around every target cell
+    :param srcLat: source latitudes
+    :param srcLon: source longitudes
+    :param dstLat: target latitudes
+    :param dstLon: target longitudes
+    :return: scipy.sparse csr matrix [target cell,source cell], rows sum to 1 inside the source grid
+    '''
+    import scipy.sparse
+
+    lat0, lat1, wLat, inLat = linearWeights(srcLat, dstLat)
+    lon0, lon1, wLon, inLon = linearWeights(srcLon, dstLon, periodic=isGlobal(srcLon))
+    nLon = len(srcLon)
+    rows, cols, weights = [], [], []
+    dstCells = np.arange(len(dstLat) * len(dstLon)).reshape(len(dstLat), len(dstLon))
+    inside = (inLat[:, None] & inLon[None, :]).ravel()
+    for iLat, fLat in ((lat0, 1.0 - wLat), (lat1, wLat)):
+        for iLon, fLon in ((lon0, 1.0 - wLon), (lon1, wLon)):
+            rows.append(dstCells.ravel()[inside])
+            cols.append((iLat[:, None] * nLon + iLon[None, :]).ravel()[inside])
+            weights.append((fLat[:, None] * fLon[None, :]).ravel()[inside])
+    matrix = scipy.sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                                     shape=(dstCells.size, len(srcLat) * nLon))
+    matrix.eliminate_zeros()
+    return matrix
+
+
+## weight builders by method
+weightMethods = {'conservative': conservativeWeights, 'bilinear': bilinearWeights}
+
+
+def regridWeights(srcLat, srcLon, dstLat, dstLon, method='conservative', cacheDir=None):
+    '''
+    Get the weights of a source and target grid pair, built once and cached on disk in cacheDir
+    keyed by the signatures of the two grids and the method
+    :param srcLat: source latitudes
+    :param srcLon: source longitudes
+    :param dstLat: target latitudes
+    :param dstLon: target longitudes
+    :param method: 'conservative' or 'bilinear'
+    :param cacheDir: cache directory. Only kept in memory if None
+    :return: scipy.sparse csr matrix [target cell,source cell]
+    '''
+    import scipy.sparse
+
+    if method not in weightMethods:
+        raise ValueError('unknown regridding method ' + method)
+    key = method + '_' + hashlib.sha1((gridSignature(srcLat, srcLon) + gridSignature(dstLat, dstLon)).encode()
+                                      ).hexdigest()
+    if key in loadedWeights:
+        return loadedWeights[key]
+    cacheFile = None if cacheDir is None else os.path.join(cacheDir, 'weights_' + key + '.npz')
+    if cacheFile is not None and os.path.exists(cacheFile):
+        weights = scipy.sparse.load_npz(cacheFile).tocsr()
+    else:
+        weights = weightMethods[method](srcLat, srcLon, dstLat, dstLon)
+        if cacheFile is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+            scipy.sparse.save_npz(cacheFile, weights)
+    loadedWeights[key] = weights
+    return weights
+
+
+def regularGrid(lat, lon, resolution):
+    '''
+    Get a regular grid at a resolution covering the extent of a grid, aligned on multiples of the resolution
+    the latitudes are in the same order as the source
+    :param lat: latitudes of the source grid
+    :param lon: longitudes of the source grid
+    :param resolution: cell size in degrees
+    :return: latitudes, longitudes
+    '''
+    latEdges = cellEdges(lat, (-90.0, 90.0))
+    lonEdges = cellEdges(lon)
+    latStart = np.floor(latEdges.min() / resolution + 1e-9) * resolution
+    latStop = np.ceil(latEdges.max() / resolution - 1e-9) * resolution
+    newLat = np.arange(latStart, latStop - resolution / 2, resolution) + resolution / 2.0
+    if isGlobal(lon):
+        lonStart = np.floor(lonEdges.min() / resolution + 1e-9) * resolution
+        lonStop = lonStart + 360.0
+    else:
+        lonStart = np.floor(lonEdges.min() / resolution + 1e-9) * resolution
+        lonStop = np.ceil(lonEdges.max() / resolution - 1e-9) * resolution
+    newLon = np.arange(lonStart, lonStop - resolution / 2, resolution) + resolution / 2.0
+    if len(lat) > 1 and lat[0] > lat[-1]:
+        newLat = newLat[::-1]
+    return newLat, newLon
+
+
+class Regridder:
+    '''
+    Regridding from a source grid to a target grid with a sparse weight matrix
+    missing source values (land, NaN) are left out and the weights of the valid ones renormalised,
+    target cells with less than minCoverage of their weight on valid values are NaN
+    '''
+
+    def __init__(self, srcLat, srcLon, dstLat, dstLon, method='conservative', cacheDir=None, minCoverage=0.0):
+        '''
+        :param srcLat: source latitudes
+        :param srcLon: source longitudes
+        :param dstLat: target latitudes
+        :param dstLon: target longitudes
+        :param method: 'conservative' or 'bilinear'
+        :param cacheDir: cache directory of the weights. Only kept in memory if None
+        :param minCoverage: min fraction of the weight of a target cell on valid source values
+        '''
+        self.srcShape = (len(srcLat), len(srcLon))
+        self.dstLat = np.asarray(dstLat)
+        self.dstLon = np.asarray(dstLon)
+        self.dstShape = (len(dstLat), len(dstLon))
+        self.method = method
+        self.minCoverage = minCoverage
+        self.weights = regridWeights(srcLat, srcLon, dstLat, dstLon, method=method, cacheDir=cacheDir)
+        self.rowSums = np.asarray(self.weights.sum(axis=1)).ravel()
+
+    @classmethod
+    def fromData(cls, src, dst, method='conservative', cacheDir=None, minCoverage=0.0):
+        '''
+        Get the regridder between the grids of two data arrays or datasets [...,lat,lon]
+        :param src: source data array or dataset
+        :param dst: target data array or dataset, or (latitudes, longitudes)
+        :return: Regridder
+        '''
+        srcLat, srcLon = gridCoords(src)
+        dstLat, dstLon = dst if isinstance(dst, tuple) else gridCoords(dst)
+        return cls(srcLat, srcLon, dstLat, dstLon, method=method, cacheDir=cacheDir, minCoverage=minCoverage)
+
+    def regridValues(self, values):
+        '''
+        Regrid a numpy array with one sparse matrix product over its [cell,time] view
+        :param values: numpy array [...,lat,lon] on the source grid
+        :return: numpy array float [...,lat,lon] on the target grid
+        '''
+        values = np.asarray(values)
+        leading = values.shape[:-2]
+        flat = values.reshape((-1, self.srcShape[0] * self.srcShape[1])).T
+        dtype = values.dtype if values.dtype.kind == 'f' else np.dtype('float64')
+        valid = ~np.isnan(flat) if values.dtype.kind == 'f' else np.ones(flat.shape, dtype=bool)
+        if valid.all():
+            total = self.weights @ flat.astype(dtype, copy=False)
+            coverage = np.broadcast_to(self.rowSums[:, None], total.shape)
+        else:
+            ## weights renormalised on the valid values of every cell and time
+            total = self.weights @ np.where(valid, flat, 0.0).astype(dtype, copy=False)
+            coverage = self.weights @ valid.astype(dtype)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = np.where((coverage > 0) & (coverage >= self.minCoverage * self.rowSums[:, None]),
+                           total / coverage, np.nan)
+        return out.T.reshape(leading + self.dstShape).astype(dtype, copy=False)
+
+    def __call__(self, da):
+        '''
+        Regrid a data array or the [...,lat,lon] variables of a dataset
+        :param da: data array or dataset on the source grid
+        :return: data array or dataset on the target grid
+        '''
+        if isinstance(da, xr.Dataset):
+            latDim, lonDim = gridDims(da)
+            out = xr.Dataset({name: self(var) for name, var in da.data_vars.items()
+                              if var.dims[-2:] == (latDim, lonDim)},
+                             coords={name: coord for name, coord in da.coords.items()
+                                     if latDim not in coord.dims and lonDim not in coord.dims})
+            out.attrs = da.attrs
+            return out
+        latDim, lonDim = da.dims[-2:]
+        return xr.DataArray(self.regridValues(da.values), dims=da.dims, name=da.name, attrs=da.attrs,
+                            coords=dict({name: coord for name, coord in da.coords.items()
+                                         if latDim not in coord.dims and lonDim not in coord.dims},
+                                        **{latDim: self.dstLat, lonDim: self.dstLon}))
+
+
+def gridDims(ds):
+    '''
+    Get the lat/lon dimensions of a data array or dataset: the last two dimensions of its first [...,lat,lon] variable
+    :param ds: data array or dataset
+    :return: lat and lon dimension names
+    '''
+    if isinstance(ds, xr.DataArray):
+        return ds.dims[-2:]
+    return ds[list(ds.data_vars)[0]].dims[-2:]
+
+
+def gridCoords(ds):
+    '''
+    Get the lat/lon coordinates of a data array or dataset
+    :param ds: data array or dataset
+    :return: latitudes, longitudes
+    '''
+    latDim, lonDim = gridDims(ds)
+    return ds[latDim].values, ds[lonDim].values
+
+
+def sameGrid(ds, other):
+    '''
+    Check if two data arrays or datasets are on the same lat/lon grid
+    :param ds: data array or dataset
+    :param other: data array or dataset
+    :return: bool
+    '''
+    lat, lon = gridCoords(ds)
+    otherLat, otherLon = gridCoords(other)
+    return lat.shape == otherLat.shape and lon.shape == otherLon.shape and \
+        np.allclose(lat, otherLat) and np.allclose(lon, otherLon)
+
+
+def overviews(ds, resolutions=overviewResolutions, method='conservative', cacheDir=None, minCoverage=0.0):
+    '''
+    Get the coarsened overview levels of a dataset, e.g. the yearly DHW products for the portal
+    the levels finer than the source grid are skipped
+    :param ds: dataset or data array [...,lat,lon]
+    :param resolutions: cell sizes of the levels in degrees
+    :param method: 'conservative' or 'bilinear'
+    :param cacheDir: cache directory of the weights
+    :param minCoverage: min fraction of a level cell on valid source values
+    :return: dictionary resolution: dataset or data array
+    '''
+    lat, lon = gridCoords(ds)
+    sourceResolution = max(np.abs(np.diff(lat)).mean() if len(lat) > 1 else 0.0,
+                           np.abs(np.diff(lon)).mean() if len(lon) > 1 else 0.0)
+    levels = {}
+    for resolution in resolutions:
+        if resolution < sourceResolution * (1 - 1e-6):
+            continue
+        regridder = Regridder.fromData(ds, regularGrid(lat, lon, resolution), method=method, cacheDir=cacheDir,
+                                       minCoverage=minCoverage)
+        levels[resolution] = regridder(ds)
+    return levels
+
+
+def resolutionName(resolution):
+    '''
+    Name of a resolution in the file names, e.g. 0p5deg
+    :param resolution: cell size in degrees
+    :return: string
+    '''
+    return ('%g' % resolution).replace('.', 'p') + 'deg'
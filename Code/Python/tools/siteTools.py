@@ -0,0 +1,200 @@
+## Extraction of the DHW products at reef sites: every site is snapped once per grid to the nearest valid (ocean)
+## cell with a KD-tree of the valid cell centres, and all the years and variables of a file are read for all the
+## sites at once with fancy indexing of the distinct cells
+#
+
+import os
+import hashlib
+
+import xarray as xr
+import numpy as np
+import pandas as pd
+
+from .regionTools import gridSignature
+
+## Earth radius, km
+earthRadius = 6371.0
+
+## site indexes built by each process: cache key -> SiteIndex
+siteIndexes = {}
+
+
+def readSites(fileName, idField='site', latField='lat', lonField='lon'):
+    '''
+    Read a table of sites, .parquet or .csv
+    :param fileName: table file name
+    :param idField: field with the site id. The row number if not in the table
+    :param latField: field with the latitude
+    :param lonField: field with the longitude
+    :return: pandas dataframe with the columns site, lat and lon
+    '''
+    df = pd.read_parquet(fileName) if fileName.endswith('.parquet') else pd.read_csv(fileName)
+    sites = pd.DataFrame({'site': df[idField].values if idField in df else np.arange(len(df)),
+                          'lat': df[latField].values.astype('float64'),
+                          'lon': df[lonField].values.astype('float64')})
+    return sites
+
+
+def unitVectors(lat, lon):
+    '''
+    Get the points on the unit sphere of positions, so the euclidean nearest neighbour is the great circle one
+    :param lat: latitudes
+    :param lon: longitudes
+    :return: numpy array [point,3]
+    '''
+    lat = np.radians(np.asarray(lat, dtype='float64'))
+    lon = np.radians(np.asarray(lon, dtype='float64'))
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def validCells(ds, varName=None):
+    '''
+    Get the valid cells of a product or a daily file: the cells with a value at the first time
+    :param ds: xarray dataset
+    :param varName: variable name. The first [time,lat,lon] variable if None
+    :return: boolean numpy array [lat,lon]
+    '''
+    if varName is None:
+        varName = [name for name in ds.data_vars if ds[name].ndim == 3][0]
+    da = ds[varName]
+    return ~np.isnan(np.asarray(da.isel({da.dims[0]: 0}).values, dtype='float64'))
+
+
+class SiteIndex:
+    '''
+    Index of the sites in a grid: cell of the nearest valid cell centre of every site and its distance
+    '''
+
+    def __init__(self, iLat, iLon, distance, snapped):
+        '''
+        :param iLat: lat index of the cell of every site, -1 if no valid cell within the max distance
+        :param iLon: lon index of the cell of every site
+        :param distance: great circle distance from the site to the centre of its cell, km
+        :param snapped: True if the cell is not the grid cell of the site, e.g. a coastal site in a land cell
+        '''
+        self.iLat = np.asarray(iLat)
+        self.iLon = np.asarray(iLon)
+        self.distance = np.asarray(distance)
+        self.snapped = np.asarray(snapped, dtype=bool)
+        self.found = self.iLat >= 0
+        ## distinct cells, read once even when shared by several sites
+        cells = self.iLat[self.found].astype('int64') * 1048576 + self.iLon[self.found]
+        _, first, self.inverse = np.unique(cells, return_index=True, return_inverse=True)
+        self.cellLat = self.iLat[self.found][first]
+        self.cellLon = self.iLon[self.found][first]
+
+    @classmethod
+    def build(cls, siteLat, siteLon, lat, lon, valid, maxDistance=None, cacheDir=None):
+        '''
+        Snap the sites to the nearest valid cell of a grid, with a KD-tree of the valid cell centres
+        the index is kept for the process and cached in cacheDir, keyed by the grid, the valid cells and the sites
+        requires scipy
+        :param siteLat: latitudes of the sites
+        :param siteLon: longitudes of the sites
+        :param lat: latitudes of the grid
+        :param lon: longitudes of the grid
+        :param valid: boolean array [lat,lon] of the valid cells, e.g. validCells(ds)
+        :param maxDistance: max distance to the cell, km. Sites farther than that get no cell. Not bounded if None
+        :param cacheDir: cache directory. No disk cache if None
+        :return: SiteIndex
+        '''
+        siteLat = np.asarray(siteLat, dtype='float64')
+        siteLon = np.asarray(siteLon, dtype='float64')
+        valid = np.asarray(valid, dtype=bool)
+        key = hashlib.sha1((gridSignature(lat, lon) + gridSignature(siteLat, siteLon) + str(maxDistance)).encode() +
+                           np.packbits(valid).tobytes()).hexdigest()
+        if key in siteIndexes:
+            return siteIndexes[key]
+        cacheFile = None if cacheDir is None else os.path.join(cacheDir, 'sites_' + key + '.npz')
+        if cacheFile is not None and os.path.exists(cacheFile):
+            cached = np.load(cacheFile)
+            index = cls(cached['iLat'], cached['iLon'], cached['distance'], cached['snapped'])
+        else:
+            import scipy.spatial
+            lat = np.asarray(lat, dtype='float64')
+            lon = np.asarray(lon, dtype='float64')
+            validLat, validLon = np.nonzero(valid)
+            tree = scipy.spatial.cKDTree(unitVectors(lat[validLat], lon[validLon]))
+            chord, nearest = tree.query(unitVectors(siteLat, siteLon))
+            distance = 2.0 * earthRadius * np.arcsin(np.minimum(chord / 2.0, 1.0))
+            iLat, iLon = validLat[nearest], validLon[nearest]
+            ## grid cell of the site, to flag the sites moved to another cell
+            gridLat = np.abs(lat[None, :] - siteLat[:, None]).argmin(axis=1)
+            gridLon = np.abs((lon[None, :] - siteLon[:, None] + 180.0) % 360.0 - 180.0).argmin(axis=1)
+            snapped = (gridLat != iLat) | (gridLon != iLon)
+            if maxDistance is not None:
+                far = distance > maxDistance
+                iLat, iLon = np.where(far, -1, iLat), np.where(far, -1, iLon)
+            index = cls(iLat, iLon, distance, snapped)
+            if cacheFile is not None:
+                os.makedirs(cacheDir, exist_ok=True)
+                np.savez(cacheFile, iLat=index.iLat, iLon=index.iLon, distance=index.distance, snapped=index.snapped)
+        siteIndexes[key] = index
+        return index
+
+    def extract(self, ds, varNames):
+        '''
+        Read the variables at the sites, all the times of all the variables in one read of the distinct cells
+        :param ds: xarray dataset [time,lat,lon]
+        :param varNames: list of variable names, on the same grid
+        :return: dictionary variable -> numpy array [time,site], NaN for the sites without cell
+        '''
+        da = ds[varNames[0]]
+        latDim, lonDim = da.dims[-2:]
+        points = ds[varNames].isel({latDim: xr.DataArray(self.cellLat, dims='point'),
+                                    lonDim: xr.DataArray(self.cellLon, dims='point')}).load()
+        out = {}
+        for varName in varNames:
+            values = np.full((da.shape[0], len(self.iLat)), np.nan)
+            values[:, self.found] = points[varName].transpose(da.dims[0], 'point').values[:, self.inverse]
+            out[varName] = values
+        return out
+
+
+def siteTable(sites, index, times, values, lat, lon):
+    '''
+    Make the tidy table of the values at the sites: one row per site, time and variable
+    :param sites: dataframe of the sites (site, lat, lon)
+    :param index: SiteIndex of the sites
+    :param times: times (years) of the values
+    :param values: dictionary variable -> numpy array [time,site]
+    :param lat: latitudes of the grid
+    :param lon: longitudes of the grid
+    :return: pandas dataframe with columns site, lat, lon, cellLat, cellLon, distance_km, snapped, year, variable, value
+    '''
+    nTimes = len(times)
+    cellLat = np.where(index.found, np.asarray(lat)[np.maximum(index.iLat, 0)], np.nan)
+    cellLon = np.where(index.found, np.asarray(lon)[np.maximum(index.iLon, 0)], np.nan)
+    frames = []
+    for varName, data in values.items():
+        frames.append(pd.DataFrame({'site': np.tile(sites['site'].values, nTimes),
+                                    'lat': np.tile(sites['lat'].values, nTimes),
+                                    'lon': np.tile(sites['lon'].values, nTimes),
+                                    'cellLat': np.tile(cellLat, nTimes),
+                                    'cellLon': np.tile(cellLon, nTimes),
+                                    'distance_km': np.tile(np.round(index.distance, 2), nTimes),
+                                    'snapped': np.tile(index.snapped, nTimes),
+                                    'year': np.repeat(np.asarray(times), len(sites)),
+                                    'variable': varName,
+                                    'value': data.ravel()}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def extractSites(ds, sites, varNames=None, maxDistance=None, cacheDir=None):
+    '''
+    Extract the variables of a product at the sites, as a tidy table
+    :param ds: xarray dataset [time,lat,lon], a processNC or ensemble output
+    :param sites: dataframe of the sites (site, lat, lon), e.g. readSites()
+    :param varNames: list of variable names. All the [time,lat,lon] variables if None
+    :param maxDistance: max distance from a site to its cell, km. Not bounded if None
+    :param cacheDir: cache directory of the site indexes
+    :return: pandas dataframe, see siteTable()
+    '''
+    if varNames is None:
+        varNames = [name for name in ds.data_vars if ds[name].ndim == 3]
+    da = ds[varNames[0]]
+    timeDim, latDim, lonDim = da.dims
+    index = SiteIndex.build(sites['lat'].values, sites['lon'].values, ds[latDim].values, ds[lonDim].values,
+                            validCells(ds, varNames[0]), maxDistance=maxDistance, cacheDir=cacheDir)
+    return siteTable(sites, index, ds[timeDim].values, index.extract(ds, varNames), ds[latDim].values,
+                     ds[lonDim].values)
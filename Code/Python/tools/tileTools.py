@@ -0,0 +1,180 @@
+## Functions to render XYZ web map tiles (web mercator, 256x256 px) of yearly DHW layers
+## the map reads only the visible tiles at each zoom instead of the whole raster
+#
+
+import os
+import json
+
+import numpy as np
+
+## fixed colour range of each variable, so all the years and scenarios share the colour scale
+tileRanges = {'DHW_max': (0.0, 20.0),
+              'DHW_q99': (0.0, 20.0),
+              'DHW': (0.0, 20.0),
+              'DoY': (1.0, 366.0),
+              'DoYrel': (1.0, 366.0),
+              'nDays': (0.0, 366.0),
+              'DoYlast': (1.0, 366.0),
+              'maxRun': (0.0, 366.0)}
+
+
+def tileRange(varName):
+    '''
+    Get the fixed colour range of a variable
+    :param varName: variable name, e.g. DHW_max, DoY_DHW4, nDays_DHW8
+    :return: (vmin, vmax)
+    '''
+    if varName in tileRanges:
+        return tileRanges[varName]
+    return tileRanges.get(varName.split('_')[0], (0.0, 20.0))
+
+
+def colorTable(cmapName='hot_r'):
+    '''
+    Get a 256 colours RGBA table of a matplotlib colormap
+    requires matplotlib
+    :param cmapName: colormap name
+    :return: numpy array uint8 [256,4]
+    '''
+    from matplotlib import colormaps
+    return (colormaps[cmapName](np.linspace(0, 1, 256)) * 255).astype('uint8')
+
+
+def tileLonLat(z, x, y, size=256):
+    '''
+    Get the lon of the pixel columns and the lat of the pixel rows of a web mercator tile
+    :param z: zoom
+    :param x: tile column
+    :param y: tile row
+    :param size: tile size in pixels
+    :return: lon [size], lat [size]
+    '''
+    n = 2 ** z
+    pixels = (np.arange(size) + 0.5) / size
+    lon = (x + pixels) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * (y + pixels) / n))))
+    return lon, lat
+
+
+def tileRow(lat, z):
+    '''
+    Get the tile row of a latitude
+    :param lat: latitude
+    :param z: zoom
+    :return: tile row
+    '''
+    n = 2 ** z
+    lat = np.clip(lat, -85.0511, 85.0511)
+    return int(np.clip(np.floor((1.0 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2.0 * n), 0, n - 1))
+
+
+def nearestIndex(coord, grid, period=None):
+    '''
+    Get the index of the nearest grid cell of every coordinate, -1 if it is more than half a cell away
+    :param coord: coordinates
+    :param grid: grid cell centres, sorted ascending or descending
+    :param period: 360 for longitudes
+    :return: numpy array of indices
+    '''
+    grid = np.asarray(grid, dtype='float64')
+    descending = grid[0] > grid[-1]
+    if descending:
+        grid = grid[::-1]
+    if period is not None:
+        ## bring the coordinates to the range of the grid
+        coord = (coord - grid[0]) % period + grid[0]
+    halfCell = np.abs(np.diff(grid)).max() / 2.0 if len(grid) > 1 else 0.5
+    index = np.clip(np.searchsorted(grid, coord), 1, len(grid) - 1)
+    index = np.where(np.abs(coord - grid[index - 1]) <= np.abs(coord - grid[index]), index - 1, index)
+    distance = np.abs(coord - grid[index])
+    if period is not None:
+        ## the first cell, across the date line
+        wrapDistance = np.abs(coord - grid[0] - period)
+        index = np.where(wrapDistance < distance, 0, index)
+        distance = np.minimum(distance, wrapDistance)
+    outside = distance > halfCell
+    if descending:
+        index = len(grid) - 1 - index
+    return np.where(outside, -1, index)
+
+
+def renderTile(values, iLat, iLon, colors, vmin, vmax):
+    '''
+    Colour a tile
+    :param values: layer [lat,lon]
+    :param iLat: grid row of every pixel row, -1 outside the grid
+    :param iLon: grid column of every pixel column, -1 outside the grid
+    :param colors: RGBA colour table [256,4]
+    :param vmin: value of the first colour
+    :param vmax: value of the last colour
+    :return: RGBA image uint8 [size,size,4], or None if all the pixels are NaN or outside the grid
+    '''
+    tile = values[np.ix_(np.maximum(iLat, 0), np.maximum(iLon, 0))]
+    transparent = np.isnan(tile) | (iLat[:, None] < 0) | (iLon[None, :] < 0)
+    if transparent.all():
+        return None
+    level = np.clip((np.nan_to_num(tile) - vmin) / (vmax - vmin) * 255.0, 0, 255).astype('uint8')
+    image = colors[level]
+    image[transparent] = 0
+    return image
+
+
+def renderLayer(values, lat, lon, outDir, zooms=range(0, 6), varName='DHW_max', cmapName='hot_r', format='png'):
+    '''
+    Render all the tiles of a layer in outDir/z/x/y.png, skipping the tiles that are all land, NaN or outside the grid
+    requires Pillow
+    :param values: layer [lat,lon]
+    :param lat: latitudes of the grid
+    :param lon: longitudes of the grid
+    :param outDir: output directory of the layer
+    :param zooms: zoom levels
+    :param varName: variable name, for the colour range
+    :param cmapName: matplotlib colormap
+    :param format: 'png' or 'webp'
+    :return: number of tiles written
+    '''
+    from PIL import Image
+
+    colors = colorTable(cmapName)
+    vmin, vmax = tileRange(varName)
+    latValid = np.asarray(lat)[~np.all(np.isnan(values), axis=1)]
+    if len(latValid) == 0:
+        return 0
+
+    nTiles = 0
+    for z in zooms:
+        n = 2 ** z
+        ## only the rows of tiles that cover the latitudes with data
+        yMin, yMax = sorted([tileRow(latValid.max(), z), tileRow(latValid.min(), z)])
+        for y in range(yMin, yMax + 1):
+            _, tileLat = tileLonLat(z, 0, y)
+            iLat = nearestIndex(tileLat, lat)
+            if np.all(iLat < 0):
+                continue
+            for x in range(n):
+                tileLon, _ = tileLonLat(z, x, y)
+                iLon = nearestIndex(tileLon, lon, period=360.0)
+                image = renderTile(values, iLat, iLon, colors, vmin, vmax)
+                if image is None:
+                    continue
+                tileDir = os.path.join(outDir, str(z), str(x))
+                os.makedirs(tileDir, exist_ok=True)
+                Image.fromarray(image, 'RGBA').save(os.path.join(tileDir, str(y) + '.' + format))
+                nTiles += 1
+    return nTiles
+
+
+def writeTileMetadata(outDir, varName, zooms, cmapName='hot_r', format='png'):
+    '''
+    Write the description of a tile pyramid for the portal: url template, zooms and colour scale
+    :param outDir: output directory of the variable
+    :param varName: variable name
+    :param zooms: zoom levels
+    :param cmapName: matplotlib colormap
+    :param format: tile format
+    '''
+    vmin, vmax = tileRange(varName)
+    with open(os.path.join(outDir, 'tiles.json'), 'w') as f:
+        json.dump({'variable': varName, 'url': '{year}/{z}/{x}/{y}.' + format,
+                   'minzoom': min(zooms), 'maxzoom': max(zooms),
+                   'colormap': cmapName, 'vmin': vmin, 'vmax': vmax}, f, indent=2)
@@ -0,0 +1,229 @@
+## Functions to run yearly computations over a daily DHW[time,lat,lon] series
+## the yearly results are written in place into preallocated [year,lat,lon] arrays instead of growing them with xr.concat
+#
+
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import xarray as xr
+import numpy as np
+
+from .profTools import stage
+
+
+def yearBounds(da):
+    '''
+    Get the index range of each year along the time axis
+    the time coordinate can be datetimes or the years themselves. It must be sorted
+    :param da: data array of daily values [time,lat,lon]
+    :return: list of years, list of (start, stop) index pairs
+    '''
+    if np.issubdtype(da.time.dtype, np.integer):
+        years = da.time.values
+    else:
+        years = da.time.dt.year.values
+    if np.any(np.diff(years) < 0):
+        raise ValueError('time axis must be sorted')
+
+    yearList, start = np.unique(years, return_index=True)
+    stop = np.append(start[1:], len(years))
+    return [int(yy) for yy in yearList], list(zip(start.tolist(), stop.tolist()))
+
+
+class Prefetcher:
+    '''
+    Iterate over the results of read(task, buffer) for a list of tasks, read ahead on a pool of threads, in the order
+    of the tasks. At most depth tasks are read ahead of the one being used, into a bounded pool of reusable buffers,
+    so the file reads and decompression overlap the computation without holding more than a few slices in memory.
+    The consumer must not keep a result after the next iteration, or keep the last results it holds with keep
+    '''
+
+    def __init__(self, read, tasks, depth=2, workers=1, keep=0):
+        '''
+        :param read: function of a task and a buffer from the pool, None the first time it is used, returning the
+                     result and the buffer to put back in the pool (None if the result is not in a reusable buffer)
+        :param tasks: list of tasks
+        :param depth: number of tasks read ahead. The tasks are read when they are used if 0
+        :param workers: number of reader threads
+        :param keep: number of previous results the consumer keeps while using the next one
+        '''
+        self.read = read
+        self.tasks = list(tasks)
+        self.depth = depth
+        self.workers = workers
+        self.keep = keep
+
+    def __iter__(self):
+        if self.depth <= 0:
+            buffer = None
+            for task in self.tasks:
+                result, buffer = self.read(task, buffer if not self.keep else None)
+                yield result
+            return
+
+        ## free buffers: one per task read ahead, per result kept and for the result being used
+        free = queue.Queue()
+        for _ in range(self.depth + self.keep + 1):
+            free.put(None)
+
+        def readTask(task):
+            return self.read(task, free.get())
+
+        pending = deque()
+        held = deque()
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for task in self.tasks[:self.depth]:
+                pending.append(pool.submit(readTask, task))
+            for i in range(len(self.tasks)):
+                result, buffer = pending.popleft().result()
+                if i + self.depth < len(self.tasks):
+                    pending.append(pool.submit(readTask, self.tasks[i + self.depth]))
+                held.append(buffer)
+                yield result
+                if len(held) > self.keep:
+                    free.put(held.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+
+
+def readYears(da, bounds, depth=2, transform=None, keep=0, workers=1):
+    '''
+    Iterate over the year slices of a daily series, read ahead on background threads (see Prefetcher)
+    with a transform, e.g. GridMask.compress, the slices are transformed by the reader into reusable buffers
+    :param da: data array of daily values [time,...]
+    :param bounds: list of (start, stop) index pairs of the years, see yearBounds
+    :param depth: number of years read ahead. Read when used if 0
+    :param transform: function of a numpy array [time,...] and an out array, e.g. GridMask.compress.
+                      The years are yielded as in-memory data arrays if None
+    :param keep: number of previous years the consumer keeps while using the next one
+    :param workers: number of reader threads
+    :return: iterator of numpy arrays, or of data arrays without transform
+    '''
+    maxDays = max(stop - start for start, stop in bounds)
+
+    def read(bound, buffer):
+        start, stop = bound
+        daYear = da.isel(time=slice(start, stop))
+        if transform is None:
+            return daYear.load(), None
+        values = np.asarray(daYear.values)
+        nDays = stop - start
+        if buffer is None:
+            first = transform(values)
+            buffer = np.empty((maxDays,) + first.shape[1:], dtype=first.dtype)
+            buffer[:nDays] = first
+        else:
+            transform(values, out=buffer[:nDays])
+        return buffer[:nDays], buffer
+
+    return Prefetcher(read, bounds, depth=depth, workers=workers, keep=keep)
+
+
+def applyByYear(da, func, *args, verbose=False, prefetch=0, **kwargs):
+    '''
+    Apply a function to every year of a daily series and collect the results in [year,lat,lon] arrays
+    the output arrays are allocated once, after the first year, and filled in place
+    :param da: data array of daily values [time,lat,lon]
+    :param func: function of a one-year data array [time,lat,lon] that returns a data array or a dataset [lat,lon]
+    :param args: extra arguments to func
+    :param verbose: print the year being processed
+    :param prefetch: number of years read ahead on a background thread while func runs. Read by func if 0
+    :param kwargs: extra keyword arguments to func
+    :return: data array or dataset, as returned by func, with a time dimension holding the year
+    '''
+    years, bounds = yearBounds(da)
+    if prefetch > 0:
+        yearSlices = iter(readYears(da, bounds, depth=prefetch))
+    else:
+        yearSlices = (da.isel(time=slice(start, stop)) for start, stop in bounds)
+
+    out = None
+    for i, yy in enumerate(years):
+        if verbose:
+            print(yy)
+        with stage('read wait'):
+            daYear = next(yearSlices)
+        res = func(daYear, *args, **kwargs)
+        isArray = isinstance(res, xr.DataArray)
+        if isArray:
+            arrayName = res.name
+            res = res.to_dataset(name='var' if arrayName is None else arrayName)
+        if out is None:
+            ## allocate the output with the shape and type of the first year
+            template = res
+            out = {name: np.empty((len(years),) + var.shape, dtype=var.dtype)
+                   for name, var in res.data_vars.items()}
+        with stage('collect'):
+            for name, var in res.data_vars.items():
+                out[name][i] = var.values
+
+    ds = xr.Dataset({name: xr.DataArray(out[name], dims=('time',) + var.dims,
+                                        coords={dim: template[dim] for dim in var.dims if dim in template.coords},
+                                        attrs=var.attrs)
+                     for name, var in template.data_vars.items()},
+                    coords={'time': years})
+    if isArray:
+        da = ds[list(ds.data_vars)[0]]
+        da.name = arrayName
+        return da
+    return ds
+
+
+def applyByYearLazy(da, func, *args, **kwargs):
+    '''
+    Lazy version of applyByYear for dask data arrays
+    the daily series is chunked by spatial tiles, keeping the time axis in one chunk, and each tile
+    is processed with applyByYear only when the result is computed or written
+    requires dask
+    :param da: data array of daily values [time,lat,lon], chunked along lat and lon
+    :param func: function of a one-year data array [time,lat,lon] that returns a data array or a dataset [lat,lon]
+    :param args: extra arguments to func. Data arrays must be on the same grid as da
+    :param kwargs: extra keyword arguments to func. Data arrays must be on the same grid as da
+    :return: dask backed data array or dataset, as returned by func, with a time dimension holding the year
+    '''
+    import dask.array as dsa
+
+    da = da.chunk({'time': -1})
+    spaceDims = da.dims[1:]
+    spaceChunks = dict(zip(spaceDims, da.chunks[1:]))
+    years, bounds = yearBounds(da)
+
+    def isXarray(arg):
+        return isinstance(arg, (xr.DataArray, xr.Dataset))
+
+    ## map_blocks only splits positional xarray arguments by tiles
+    xrNames = [name for name, arg in kwargs.items() if isXarray(arg)]
+    plainKwargs = {name: arg for name, arg in kwargs.items() if name not in xrNames}
+    tileArgs = [arg.chunk({dim: spaceChunks[dim] for dim in arg.dims if dim in spaceChunks}) if isXarray(arg) else arg
+                for arg in list(args) + [kwargs[name] for name in xrNames]]
+    nArgs = len(args)
+
+    def tileFunc(daTile, *tileArgs):
+        tileKwargs = dict(zip(xrNames, tileArgs[nArgs:]), **plainKwargs)
+        return applyByYear(daTile, func, *tileArgs[:nArgs], **tileKwargs)
+
+    ## process one cell to get the names, types and attributes of the output
+    cell = {dim: slice(0, 1) for dim in spaceDims}
+    cellArgs = [arg.isel({dim: cell[dim] for dim in arg.dims if dim in cell}).load() if isXarray(arg) else arg
+                for arg in tileArgs]
+    sample = tileFunc(da.isel(cell).load(), *cellArgs)
+
+    ## lazy template of the output
+    chunks = ((len(years),),) + da.chunks[1:]
+    shape = (len(years),) + da.shape[1:]
+    coords = {dim: da[dim] for dim in spaceDims if dim in da.coords}
+    coords['time'] = years
+    sampleDs = sample.to_dataset(name='var') if isinstance(sample, xr.DataArray) else sample
+    template = xr.Dataset({name: xr.DataArray(dsa.empty(shape, dtype=var.dtype, chunks=chunks),
+                                              dims=var.dims, attrs=var.attrs)
+                           for name, var in sampleDs.data_vars.items()},
+                          coords=coords)
+    if isinstance(sample, xr.DataArray):
+        template = template['var']
+        template.name = sample.name
+
+    return xr.map_blocks(tileFunc, da, args=tileArgs, template=template)
@@ -0,0 +1,34 @@
+## Per-region yearly statistics of the processNC outputs, as one tidy table for the portal charts
+## use: python3 zonalStats.py 'Data/DHWmax/*/DHW_*.nc' --out Data/IPCC_zonal_stats.parquet
+
+import os
+import glob
+import argparse
+import pandas as pd
+import xarray as xr
+
+from tools.regionTools import regionGrid, zonal_stats, writeTable
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='area weighted statistics of the yearly DHW products by IPCC region')
+    parser.add_argument('inputs', nargs='+', help='processNC output files or glob patterns')
+    parser.add_argument('--out', required=True, help='output table, .parquet or .csv')
+    parser.add_argument('--shapefile', default='GIS/IPPC_corals.shp', help='IPCC polygons')
+    parser.add_argument('--cachedir', default='Data/cache', help='cache of the region grids')
+    args = parser.parse_args()
+
+    fileList = sorted(set(fileName for item in args.inputs for fileName in glob.glob(item)))
+    tables = []
+    for fileName in fileList:
+        print(fileName)
+        with xr.open_dataset(fileName) as ds:
+            latDim, lonDim = ds['DHW_max'].dims[-2:]
+            grid, names = regionGrid(args.shapefile, ds[latDim].values, ds[lonDim].values, cacheDir=args.cachedir)
+            table = zonal_stats(ds, grid, names=names)
+            table.insert(0, 'model', ds.attrs.get('model_name', ''))
+            table.insert(0, 'scenario', ds.attrs.get('IPCC_scenario', ''))
+            table.insert(0, 'file', os.path.basename(fileName))
+        tables.append(table)
+
+    writeTable(pd.concat(tables, ignore_index=True), args.out)